@@ -0,0 +1,46 @@
+"""Add list indexes
+
+Revision ID: 4f2b9c1d7e3a
+Revises: 836227680059
+Create Date: 2026-10-17 10:12:41.208315
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4f2b9c1d7e3a'
+down_revision: Union[str, None] = '836227680059'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # trigram indexes back the `q` search of the list endpoints
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_farms_owner_created_at', 'farms', ['owner_id', 'created_at'], unique=False)
+    op.create_index('ix_farms_assigned_customer', 'farms', ['assigned_customer'], unique=False)
+    op.create_index('ix_farms_name_trgm', 'farms', ['name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_assets_owner_created_at', 'assets', ['owner_id', 'created_at'], unique=False)
+    op.create_index('ix_assets_name_trgm', 'assets', ['name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_devices_asset_created_at', 'devices', ['asset_id', 'created_at'], unique=False)
+    op.create_index('ix_devices_name_trgm', 'devices', ['name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_devices_label_trgm', 'devices', ['label'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'label': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_devices_label_trgm', table_name='devices')
+    op.drop_index('ix_devices_name_trgm', table_name='devices')
+    op.drop_index('ix_devices_asset_created_at', table_name='devices')
+    op.drop_index('ix_assets_name_trgm', table_name='assets')
+    op.drop_index('ix_assets_owner_created_at', table_name='assets')
+    op.drop_index('ix_farms_name_trgm', table_name='farms')
+    op.drop_index('ix_farms_assigned_customer', table_name='farms')
+    op.drop_index('ix_farms_owner_created_at', table_name='farms')
@@ -0,0 +1,46 @@
+"""Add alerts
+
+Revision ID: 7c3e5a9b2d41
+Revises: 4f2b9c1d7e3a
+Create Date: 2026-10-17 14:05:12.531870
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c3e5a9b2d41'
+down_revision: Union[str, None] = '4f2b9c1d7e3a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('alerts',
+    sa.Column('alert_id', sa.UUID(), nullable=False),
+    sa.Column('device_id', sa.UUID(), nullable=False),
+    sa.Column('asset_id', sa.UUID(), nullable=False),
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('kind', sa.String(length=10), nullable=False),
+    sa.Column('value', sa.Float(), nullable=False),
+    sa.Column('threshold_min', sa.Float(), nullable=True),
+    sa.Column('threshold_max', sa.Float(), nullable=True),
+    sa.Column('raised_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('cleared_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('cleared_value', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['asset_id'], ['assets.asset_id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['device_id'], ['devices.device_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('alert_id')
+    )
+    op.create_index('ix_alerts_asset_raised_at', 'alerts', ['asset_id', 'raised_at'], unique=False)
+    op.create_index('ix_alerts_open', 'alerts', ['device_id'], unique=False,
+                    postgresql_where=sa.text('cleared_at IS NULL'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_alerts_open', table_name='alerts')
+    op.drop_index('ix_alerts_asset_raised_at', table_name='alerts')
+    op.drop_table('alerts')
@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Optional
+from uuid import UUID
+
+from sqlalchemy import or_, select
+
+from . import models
+from .config import settings
+
+USER_COLUMNS = [column.key for column in models.User.__table__.columns]
+
+
+def user_statement(username: str):
+    return select(models.User).where(models.User.username == username)
+
+
+def access_statement(user_id: UUID):
+    # every farm, asset and device reachable by the user, see Access
+    return (select(models.Farm.farm_id, models.Farm.owner_id, models.Farm.assigned_customer,
+                   models.Asset.asset_id, models.Asset.owner_id.label("asset_owner_id"), models.Device.device_id)
+            .join(models.Asset, models.Asset.farm_id == models.Farm.farm_id, isouter=True)
+            .join(models.Device, models.Device.asset_id == models.Asset.asset_id, isouter=True)
+            .where(or_(models.Farm.owner_id == user_id, models.Farm.assigned_customer == user_id,
+                       models.Asset.owner_id == user_id)))
+
+
+class Access:
+    """
+    Ids of the farms, assets and devices a user passes the ownership checks of
+    `get_farm_by_id`, `check_asset_access` and `check_device_access` for.
+    """
+    __slots__ = ("farms", "assets", "devices", "loaded_at")
+
+    def __init__(self, user: models.User, rows):
+        self.farms = set()
+        self.assets = set()
+        self.devices = set()
+        for farm_id, owner_id, customer_id, asset_id, asset_owner_id, device_id in rows:
+            if (user.role == "tenant" and owner_id == user.user_id
+                    or user.role == "customer" and customer_id == user.user_id):
+                self.farms.add(farm_id)
+            if asset_id is not None and user.user_id in (asset_owner_id, customer_id):
+                self.assets.add(asset_id)
+            if device_id is not None and user.user_id in (owner_id, customer_id):
+                self.devices.add(device_id)
+        self.loaded_at = time.monotonic()
+
+
+class AccessCache:
+    """
+    User rows by username and the farm/asset/device ids each user can access,
+    so that authenticating and authorizing a request does not touch Postgres.
+
+    Both maps are LRU bounded to `max_size` users and entries expire after `ttl`
+    seconds. The routes that change users, farms, assets, devices or assignments
+    clear the entries of this process and broadcast the change to the other
+    processes over the control channel (REALTIME_RELAY); without it `ttl` bounds
+    how long other processes see a revoked access. An id missing from the sets is
+    not a denial: the callers fall back to their query, which also covers access
+    granted by another process.
+    """
+
+    def __init__(self, ttl: float = settings.auth_cache_ttl, max_size: int = settings.auth_cache_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._users: OrderedDict = OrderedDict()
+        self._access: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = defaultdict(int)
+
+    def _get(self, entries: OrderedDict, key):
+        with self._lock:
+            entry = entries.get(key)
+            if entry is None or time.monotonic() - entry[0] >= self.ttl:
+                self._stats["misses"] += 1
+                return None
+            entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def _put(self, entries: OrderedDict, key, value):
+        with self._lock:
+            entries[key] = (time.monotonic(), value)
+            entries.move_to_end(key)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+        return value
+
+    def _user(self, columns: Optional[dict]) -> Optional[models.User]:
+        # a fresh transient row per request, routes only read its columns
+        return models.User(**columns) if columns is not None else None
+
+    def _columns(self, user: Optional[models.User]) -> Optional[dict]:
+        return {key: getattr(user, key) for key in USER_COLUMNS} if user is not None else None
+
+    def get_user(self, username: str, db) -> Optional[models.User]:
+        columns = self._get(self._users, username)
+        if columns is None:
+            columns = self._put(self._users, username, self._columns(db.scalar(user_statement(username))))
+        return self._user(columns)
+
+    async def get_user_async(self, username: str, db) -> Optional[models.User]:
+        columns = self._get(self._users, username)
+        if columns is None:
+            columns = self._put(self._users, username, self._columns(await db.scalar(user_statement(username))))
+        return self._user(columns)
+
+    def access(self, user: models.User, db) -> Access:
+        access = self._get(self._access, user.user_id)
+        if access is None:
+            access = self._put(self._access, user.user_id, Access(user, db.execute(access_statement(user.user_id))))
+        return access
+
+    async def access_async(self, user: models.User, db) -> Access:
+        access = self._get(self._access, user.user_id)
+        if access is None:
+            rows = (await db.execute(access_statement(user.user_id))).all()
+            access = self._put(self._access, user.user_id, Access(user, rows))
+        return access
+
+    def invalidate_access(self, user_id=None):
+        # None: the farms, assets or devices of several users changed
+        with self._lock:
+            if user_id is None:
+                self._access.clear()
+            else:
+                self._access.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._access.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, users=len(self._users), access=len(self._access))
+
+
+access_cache = AccessCache()
@@ -0,0 +1,268 @@
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+
+import numpy as np
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.orm import Session
+
+from . import models
+from .config import settings
+
+
+def rules_statement():
+    return select(models.Threshold.asset_id, models.Threshold.key,
+                  models.Threshold.threshold_min, models.Threshold.threshold_max)
+
+
+def open_alerts_statement():
+    return select(models.Alert).where(models.Alert.cleared_at.is_(None))
+
+
+class ThresholdRules:
+    """
+    Every Threshold row as arrays: `index` maps asset_id to {key: position in
+    them}. A missing bound is NaN, which never compares out of range.
+    """
+    __slots__ = ("index", "minimum", "maximum", "clear_minimum", "clear_maximum", "loaded_at")
+
+    def __init__(self, rows, hysteresis: float):
+        self.index = {}
+        minimum = []
+        maximum = []
+        for asset_id, key, threshold_min, threshold_max in rows:
+            self.index.setdefault(asset_id, {})[key] = len(minimum)
+            minimum.append(np.nan if threshold_min is None else threshold_min)
+            maximum.append(np.nan if threshold_max is None else threshold_max)
+        self.minimum = np.array(minimum, dtype=np.float64)
+        self.maximum = np.array(maximum, dtype=np.float64)
+        # an alert clears once the value is back inside the range by `hysteresis` of its width
+        width = self.maximum - self.minimum
+        margin = np.where(np.isnan(width), 0.0, width * hysteresis)
+        self.clear_minimum = self.minimum + margin
+        self.clear_maximum = self.maximum - margin
+        self.loaded_at = time.monotonic()
+
+    def bounds(self, position: int):
+        return tuple(None if np.isnan(bound) else float(bound)
+                     for bound in (self.minimum[position], self.maximum[position]))
+
+
+class _Series:
+    # state of one (device_id, key), only kept while it is breaching or alerting;
+    # `batch` is the evaluate call that changed it last
+    __slots__ = ("alert", "breaches", "recoveries", "batch")
+
+    def __init__(self, alert: Optional[dict] = None, breaches: int = 0, recoveries: int = 0, batch: int = 0):
+        self.alert = alert
+        self.breaches = breaches
+        self.recoveries = recoveries
+        self.batch = batch
+
+
+class ThresholdEngine:
+    """
+    Checks ingest batches against the thresholds of the devices' assets.
+
+    Out of range values are found for the whole batch with a few NumPy comparisons;
+    only the readings of series that breach in the batch or are already breaching
+    or alerting are then walked in arrival order. A series raises an alert after `debounce`
+    consecutive out of range readings and clears it after `debounce` consecutive
+    readings inside the range narrowed by the hysteresis margin, so a value
+    flapping around a bound raises a single alert.
+
+    Events are dicts with `status` "raised" or "cleared"; `record_alerts` persists
+    them in the alerts table. `evaluate` also returns what the series looked like
+    before, which `restore` puts back when that transaction rolls back. The rules
+    are reloaded after `ttl` seconds or when the threshold routes invalidate them;
+    open alerts of the devices this process ingests (`owns`) are picked up from the
+    table on the first load so a restart does not raise them again.
+    """
+
+    def __init__(self, ttl: float = settings.metadata_cache_ttl, hysteresis: float = settings.alert_hysteresis,
+                 debounce: int = settings.alert_debounce):
+        self.ttl = ttl
+        self.hysteresis = hysteresis
+        self.debounce = max(debounce, 1)
+        self._rules: Optional[ThresholdRules] = None
+        self._series: Dict[Tuple[str, str], _Series] = {}
+        self._seeded = False
+        self._batches = 0
+        # replaced by the MQTT subscriber when the ingest is partitioned
+        self.owns: Callable[[str], bool] = lambda device_id: True
+        self._lock = threading.Lock()
+        self._stats = defaultdict(int)
+
+    def _load(self, db: Session, snapshot: dict) -> List[dict]:
+        if not self._seeded:
+            for alert in db.scalars(open_alerts_statement()):
+                if not self.owns(str(alert.device_id)):
+                    continue
+                self._series[(str(alert.device_id), alert.key)] = _Series(self._event(
+                    alert.alert_id, str(alert.device_id), alert.asset_id, alert.key, alert.kind, alert.value,
+                    alert.threshold_min, alert.threshold_max, alert.raised_at))
+            self._seeded = True
+        self._rules = ThresholdRules(db.execute(rules_statement()), self.hysteresis)
+        self._stats["loads"] += 1
+
+        # alerts of removed thresholds are cleared right away
+        events = []
+        now = datetime.now(timezone.utc)
+        for series_key, series in list(self._series.items()):
+            alert = series.alert
+            if alert is not None and alert["key"] not in self._rules.index.get(alert["asset_id"], ()):
+                events.append(dict(alert, status="cleared", value=None, timestamp=now))
+                self._snapshot(snapshot, series_key)
+                del self._series[series_key]
+        return events
+
+    @staticmethod
+    def _event(alert_id, device_id: str, asset_id, key: str, kind: str, value: float,
+               threshold_min, threshold_max, timestamp: datetime, status: str = "raised") -> dict:
+        return {"alert_id": alert_id, "device_id": device_id, "asset_id": asset_id, "key": key, "kind": kind,
+                "status": status, "value": value, "threshold_min": threshold_min,
+                "threshold_max": threshold_max, "timestamp": timestamp}
+
+    def _snapshot(self, snapshot: dict, series_key):
+        # state of the series before the current batch first changed it
+        if series_key not in snapshot:
+            series = self._series.get(series_key)
+            snapshot[series_key] = (None if series is None else
+                                    (series.alert, series.breaches, series.recoveries, series.batch))
+
+    def evaluate(self, rows, devices: dict, db: Session) -> Tuple[List[dict], tuple]:
+        # rows: (device_id, key, value, timestamp) in arrival order, devices: device_id -> DeviceMetadata
+        # -> events, and the undo state to hand to `restore` if they are not committed
+        with self._lock:
+            self._batches += 1
+            batch = self._batches
+            snapshot = {}
+            undo = (batch, snapshot)
+            rules = self._rules
+            events = []
+            if rules is None or time.monotonic() - rules.loaded_at >= self.ttl:
+                events = self._load(db, snapshot)
+                rules = self._rules
+            if not rules.index or not rows:
+                return events, undo
+
+            # resolved once per device, the device ids hash cheaper than the asset UUIDs
+            device_rules = {device_id: rules.index.get(device.asset_id, {}) for device_id, device in devices.items()}
+            positions = np.fromiter((device_rules[device_id].get(key, -1) for device_id, key, _, _ in rows),
+                                    dtype=np.int64, count=len(rows))
+            ruled = positions >= 0
+            if not ruled.any():
+                return events, undo
+            values = np.fromiter((value for _, _, value, _ in rows), dtype=np.float64, count=len(rows))
+            rule = np.where(ruled, positions, 0)
+
+            low = ruled & (values < rules.minimum[rule])
+            high = ruled & (values > rules.maximum[rule])
+            breached = low | high
+            inside = (values >= rules.clear_minimum[rule]) | np.isnan(rules.clear_minimum[rule])
+            inside &= (values <= rules.clear_maximum[rule]) | np.isnan(rules.clear_maximum[rule])
+            # every reading of a breaching or alerting series is walked, an in range
+            # reading between two breaches of the batch resets the debounce
+            breaching = {(rows[row][0], rows[row][1]) for row in np.flatnonzero(breached).tolist()}
+            if self._series or breaching:
+                series = self._series
+                watched = np.array([(device_id, key) in series or (device_id, key) in breaching
+                                    for device_id, key, _, _ in rows], dtype=bool)
+                candidates = np.flatnonzero(watched & ruled)
+            else:
+                candidates = np.empty(0, dtype=np.int64)
+            self._stats["evaluated"] += int(np.count_nonzero(ruled))
+
+            for row, is_breached, is_low, is_inside, position in zip(
+                    candidates.tolist(), breached[candidates].tolist(), low[candidates].tolist(),
+                    inside[candidates].tolist(), rule[candidates].tolist()):
+                device_id, key, value, timestamp = rows[row]
+                value = float(value)
+                self._snapshot(snapshot, (device_id, key))
+                series = self._series.get((device_id, key))
+                if series is None:
+                    series = self._series[(device_id, key)] = _Series()
+                series.batch = batch
+
+                if is_breached:
+                    series.recoveries = 0
+                    if series.alert is None:
+                        series.breaches += 1
+                        if series.breaches >= self.debounce:
+                            threshold_min, threshold_max = rules.bounds(position)
+                            series.alert = self._event(uuid.uuid4(), device_id, devices[device_id].asset_id, key,
+                                                       "low" if is_low else "high", value,
+                                                       threshold_min, threshold_max, timestamp)
+                            series.breaches = 0
+                            events.append(series.alert)
+                elif is_inside:
+                    series.breaches = 0
+                    if series.alert is not None:
+                        series.recoveries += 1
+                        if series.recoveries >= self.debounce:
+                            events.append(dict(series.alert, status="cleared", value=value, timestamp=timestamp))
+                            series.alert = None
+                else:
+                    # back in range but within the hysteresis margin
+                    series.breaches = 0
+                    series.recoveries = 0
+
+                if series.alert is None and series.breaches == 0:
+                    del self._series[(device_id, key)]
+
+            for event in events:
+                self._stats[event["status"]] += 1
+            return events, undo
+
+    def restore(self, undo: tuple):
+        # the batch's transaction rolled back: its alerts were not inserted or closed.
+        # Series another batch changed since are left alone.
+        batch, snapshot = undo
+        with self._lock:
+            for series_key, state in snapshot.items():
+                series = self._series.get(series_key)
+                if series is not None and series.batch != batch:
+                    continue
+                if state is None:
+                    self._series.pop(series_key, None)
+                else:
+                    self._series[series_key] = _Series(*state)
+            self._stats["restored"] += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._rules = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, rules=len(self._rules.minimum) if self._rules is not None else None,
+                        open_alerts=sum(series.alert is not None for series in self._series.values()))
+
+
+def record_alerts(events: List[dict], db: Session):
+    """
+    Insert the raised alerts and close the cleared ones, the caller commits. A
+    cleared alert whose device was deleted since just updates nothing.
+    """
+    raised = [{"alert_id": event["alert_id"], "device_id": UUID(event["device_id"]), "asset_id": event["asset_id"],
+               "key": event["key"], "kind": event["kind"], "value": event["value"],
+               "threshold_min": event["threshold_min"], "threshold_max": event["threshold_max"],
+               "raised_at": event["timestamp"]}
+              for event in events if event["status"] == "raised"]
+    cleared = [{"b_alert_id": event["alert_id"], "b_cleared_at": event["timestamp"], "b_cleared_value": event["value"]}
+               for event in events if event["status"] == "cleared"]
+    if raised:
+        db.execute(insert(models.Alert.__table__), raised)
+    if cleared:
+        table = models.Alert.__table__
+        db.execute(update(table)
+                   .where(table.c.alert_id == bindparam("b_alert_id"))
+                   .values(cleared_at=bindparam("b_cleared_at"), cleared_value=bindparam("b_cleared_value")),
+                   cleared)
+
+
+threshold_engine = ThresholdEngine()
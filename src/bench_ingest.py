@@ -0,0 +1,385 @@
+"""
+Ingest throughput and latency with a simulated device fleet.
+
+    python -m src.bench_ingest [--devices 100] [--keys 5] [--rate 1000] [--duration 30]
+        [--format json|msgpack] [--samples 1] [--broker HOST:PORT] [--database-url URL]
+        [--cassandra-latency-ms 0] [--output results.json]
+
+`--devices` devices publish samples with `--keys` keys, `--rate` samples per
+second in total, for `--duration` seconds. A payload carries `--samples` samples
+in the batched `{ts, values}` format, or is a flat JSON object for single JSON
+samples; compare `--samples 1` with `--samples 50 --format msgpack` to see what
+batching devices save. Payloads go straight into `MQTTSubscriber.on_message`
+unless `--broker` names a broker to publish through.
+Postgres is replaced by a scratch SQLite database unless `--database-url` points
+somewhere else, and Cassandra by an in-process session that acknowledges every
+statement after `--cassandra-latency-ms`, so the default run needs no services.
+The usual settings are still read from the environment, nothing connects to the
+configured servers.
+
+The `k0` value of every sample is its sequence number, which is how the latency
+from publishing a sample to the end of the batch write that stored it is
+measured. See `src.bench_payloads` for the parse cost alone. Results are printed, or written to `--output`, as JSON.
+"""
+import argparse
+import heapq
+import json
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import paho.mqtt.client as mqtt
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.compiler import compiles
+
+from . import models, ts_counter, ts_rollup
+from .alerts import threshold_engine
+from .cassandra_db import cassandra_manager
+from .cassandra_writer import cassandra_writer
+from .config import settings
+from .database import Base, IngestSessionLocal
+from .ingest import finish_telemetry_batch
+from .mqtt import TELEMETRY_TOPIC, MQTTSubscriber
+from .payloads import PAYLOAD_FORMATS, encode_samples
+from .ts_counter import telemetry_counter
+from .ts_rollup import rollup_accumulator
+
+# the tables the ingest path touches, SQLite cannot create the others
+SQLITE_TABLES = [models.TimeSeriesKey.__table__, models.Asset.__table__, models.Device.__table__,
+                 models.key_usages, models.Threshold.__table__, models.TimeSeries.__table__,
+                 models.Alert.__table__]
+
+
+@compiles(UUID, "sqlite")
+def _sqlite_uuid(type_, compiler, **kw):
+    # values are bound as 32 character hex strings on dialects without a uuid type
+    return "CHAR(32)"
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            self.count += 1
+
+
+class _Completions(threading.Thread):
+    # runs the callbacks of the fake Cassandra requests once their latency passed
+    def __init__(self):
+        super().__init__(name="fake-cassandra", daemon=True)
+        self._due = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+
+    def schedule(self, delay: float, callback, *args):
+        with self._condition:
+            self._sequence += 1
+            heapq.heappush(self._due, (time.monotonic() + delay, self._sequence, callback, args))
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._condition.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                _, _, callback, args = heapq.heappop(self._due)
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Fake Cassandra callback failed: {str(e)}")
+
+
+class FakeResponseFuture:
+    has_more_pages = False
+
+    def __init__(self, session):
+        self.session = session
+
+    def add_callbacks(self, callback, errback=None, callback_args=(), callback_kwargs=None,
+                      errback_args=(), errback_kwargs=None):
+        if self.session.latency > 0:
+            self.session.completions.schedule(self.session.latency,
+                                              lambda: callback([], *callback_args, **(callback_kwargs or {})))
+        else:
+            callback([], *callback_args, **(callback_kwargs or {}))
+
+    def result(self):
+        return []
+
+
+class FakePreparedStatement:
+    def __init__(self, query: str):
+        self.query = query
+
+    def bind(self, values):
+        return self, values
+
+
+class FakeCassandraSession:
+    """
+    Stands in for a cassandra-driver session: statements are counted per CQL
+    command and acknowledged with an empty result. Only the concurrent write mode
+    is supported, unlogged batches need real prepared statements, and
+    execute_concurrent_with_args is swapped for fake_execute_concurrent_with_args.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.statements = defaultdict(int)
+        self._lock = threading.Lock()
+        self.completions = _Completions()
+        if latency > 0:
+            self.completions.start()
+
+    def prepare(self, query: str):
+        return FakePreparedStatement(query)
+
+    def _count(self, statement):
+        # bound statements are (prepared, values), execute_concurrent passes the prepared one
+        if isinstance(statement, tuple):
+            statement = statement[0]
+        command = statement.query if isinstance(statement, FakePreparedStatement) else str(statement)
+        with self._lock:
+            self.statements[" ".join(command.split()[:3])] += 1
+
+    def execute_async(self, statement, parameters=None, *args, **kwargs):
+        self._count(statement)
+        return FakeResponseFuture(self)
+
+    def execute(self, statement, parameters=None, *args, **kwargs):
+        self._count(statement)
+        return []
+
+
+def fake_execute_concurrent_with_args(session, statement, parameters, *args, **kwargs):
+    # replaces the driver helper, which needs real response futures; one round trip for the whole set
+    parameters = list(parameters)
+    for _ in parameters:
+        session._count(statement)
+    time.sleep(session.latency)
+    return [(True, []) for _ in parameters]
+
+
+def create_fleet(engine, device_count: int, assets: int, keys: int):
+    # -> ids of the created devices, every asset has a 5..95 threshold on the random keys
+    if engine.dialect.name == "sqlite":
+        Base.metadata.create_all(engine, tables=SQLITE_TABLES)
+    else:
+        Base.metadata.create_all(engine)
+
+    db = IngestSessionLocal()
+    try:
+        owner_id, farm_id, profile_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        if engine.dialect.name != "sqlite":
+            db.add(models.User(user_id=owner_id, username=f"bench-{owner_id}", password="-", role="tenant",
+                               created_by=owner_id))
+            db.flush()
+            db.add(models.Farm(farm_id=farm_id, name="bench", location=[0.0, 0.0], owner_id=owner_id))
+            db.add(models.DeviceProfile(profile_id=profile_id, name="bench", owner_id=owner_id))
+            db.flush()
+        now = datetime.now(timezone.utc)
+        asset_ids = [uuid.uuid4() for _ in range(assets)]
+        db.add_all(models.Asset(asset_id=asset_id, name=f"bench-{i}", type="Greenhouse", farm_id=farm_id,
+                                owner_id=owner_id, created_at=now) for i, asset_id in enumerate(asset_ids))
+        db.flush()
+        device_ids = [uuid.uuid4() for _ in range(device_count)]
+        db.add_all(models.Device(device_id=device_id, name=f"bench-{i}", asset_id=asset_ids[i % assets],
+                                 device_profile_id=profile_id, is_gateway=False, created_at=now)
+                   for i, device_id in enumerate(device_ids))
+        threshold_keys = [f"k{i}" for i in range(1, keys)]
+        for key in threshold_keys:
+            # ts_keys are shared with earlier runs against the same database
+            db.merge(models.TimeSeriesKey(ts_key=key, created_at=now))
+        db.flush()
+        db.add_all(models.Threshold(asset_id=asset_id, key=key, threshold_min=5, threshold_max=95,
+                                    modified_by=owner_id, modified_at=now)
+                   for asset_id in asset_ids for key in threshold_keys)
+        db.commit()
+    finally:
+        db.close()
+    return [str(device_id) for device_id in device_ids]
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = np.asarray(values) * 1000
+    return {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)),
+            "p99": float(np.percentile(values, 99)), "max": float(values.max()), "mean": float(values.mean())}
+
+
+def run(args):
+    database_url = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    engine = create_engine(database_url)
+    IngestSessionLocal.configure(bind=engine)
+    device_ids = create_fleet(engine, args.devices, max(1, args.devices // 10), args.keys)
+    sql_statements = StatementCounter()
+    event.listen(engine, "before_cursor_execute", sql_statements)
+
+    session = FakeCassandraSession(args.cassandra_latency_ms / 1000)
+    cassandra_manager.session = session
+    cassandra_writer.mode = "concurrent"
+    ts_counter.execute_concurrent_with_args = fake_execute_concurrent_with_args
+    ts_rollup.execute_concurrent_with_args = fake_execute_concurrent_with_args
+
+    subscriber = MQTTSubscriber()
+    sent = {}
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def finish(committed):
+        finish_telemetry_batch(committed, publish)
+        done = time.perf_counter()
+        with latencies_lock:
+            latencies.extend(done - sent.pop(message.data["k0"]) for message in committed.messages)
+
+    subscriber.ingest.after_commit = finish
+    depths = []
+    sampling = threading.Event()
+
+    def sample_depth():
+        while not sampling.wait(0.1):
+            depths.append(subscriber.ingest.stats()["depth"])
+
+    if args.broker:
+        host, port = args.broker.split(":")
+        publish = subscriber.client.publish
+        subscriber.client.on_connect = subscriber.on_connect
+        subscriber.client.on_message = subscriber.on_message
+        subscriber.client.connect(host, int(port), 10)
+        subscriber.start()
+        publisher = mqtt.Client()
+        publisher.connect(host, int(port), 10)
+        publisher.loop_start()
+        time.sleep(1)
+
+        def deliver(topic, payload):
+            publisher.publish(topic, payload)
+    else:
+        def publish(topic, payload):
+            pass
+
+        subscriber.known_devices = set(device_ids)
+        subscriber.ingest.start()
+        if settings.telemetry_rollups_enabled:
+            rollup_accumulator.start()
+        if settings.telemetry_counters_enabled:
+            telemetry_counter.start()
+
+        def deliver(topic, payload):
+            subscriber.on_message(subscriber.client, None, SimpleNamespace(topic=topic, payload=payload))
+
+    threading.Thread(target=sample_depth, daemon=True).start()
+    total = int(args.rate * args.duration)
+    started = time.perf_counter()
+    topic_suffix = "/msgpack" if args.format == "msgpack" else ""
+    for first in range(0, total, args.samples):
+        delay = started + first / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        device_id = device_ids[first // args.samples % len(device_ids)]
+        samples = []
+        for sequence in range(first, min(first + args.samples, total)):
+            values = {"k0": sequence}
+            values.update((f"k{i}", round(random.uniform(0, 100), 2)) for i in range(1, args.keys))
+            samples.append(values)
+        now = datetime.now(timezone.utc)
+        if args.samples == 1 and args.format == "json":
+            payload = json.dumps(samples[0]).encode()
+        else:
+            payload = encode_samples([(now - timedelta(milliseconds=len(samples) - i), values)
+                                      for i, values in enumerate(samples)], args.format)
+        published_at = time.perf_counter()
+        for values in samples:
+            sent[values["k0"]] = published_at
+        deliver(TELEMETRY_TOPIC.format(device_id) + topic_suffix, payload)
+    published_in = time.perf_counter() - started
+
+    deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < deadline:
+        stats = subscriber.ingest.stats()
+        if stats.get("processed", 0) + stats.get("failed", 0) + stats.get("dropped", 0) >= total:
+            break
+        time.sleep(0.05)
+    ingested_in = time.perf_counter() - started
+    sampling.set()
+
+    if args.broker:
+        publisher.loop_stop()
+        subscriber.stop()
+    else:
+        subscriber.ingest.stop()
+        if settings.telemetry_rollups_enabled:
+            rollup_accumulator.stop()
+        if settings.telemetry_counters_enabled:
+            telemetry_counter.stop()
+
+    ingest = subscriber.ingest.stats()
+    processed = ingest.get("processed", 0)
+    batches = ingest.get("batches", 0)
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {"devices": args.devices, "keys": args.keys, "rate": args.rate, "duration": args.duration,
+                   "format": args.format, "samples_per_payload": args.samples,
+                   "transport": "broker" if args.broker else "direct", "database": engine.dialect.name,
+                   "cassandra_latency_ms": args.cassandra_latency_ms, "ingest_workers": settings.ingest_workers,
+                   "ingest_batch_size": settings.ingest_batch_size,
+                   "ingest_flush_interval": settings.ingest_flush_interval,
+                   "rollups": settings.telemetry_rollups_enabled, "counters": settings.telemetry_counters_enabled},
+        "published": total,
+        "payloads": -(-total // args.samples),
+        "publish_rate": total / published_in,
+        "processed": processed,
+        "lost": total - processed,
+        "throughput": {"messages_per_s": processed / ingested_in,
+                       "rows_per_s": processed * args.keys / ingested_in},
+        "latency_ms": percentiles(latencies),
+        "sql_statements": {"total": sql_statements.count,
+                           "per_batch": sql_statements.count / batches if batches else None},
+        "cassandra_statements": dict(session.statements),
+        "queue_depth": {"max": max(depths, default=0), "mean": float(np.mean(depths)) if depths else 0.0},
+        "ingest": ingest,
+        "cassandra_writer": cassandra_writer.stats(),
+        "alerts": threshold_engine.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark telemetry ingestion with a simulated device fleet")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--keys", type=int, default=5, help="keys per payload, k0 carries the sequence number")
+    parser.add_argument("--rate", type=float, default=1000, help="samples per second over all devices")
+    parser.add_argument("--format", choices=PAYLOAD_FORMATS, default="json")
+    parser.add_argument("--samples", type=int, default=1,
+                        help="samples per payload, more than one (or msgpack) sends the batched {ts, values} format")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of publishing")
+    parser.add_argument("--broker", default=None, help="HOST:PORT of an MQTT broker to publish through")
+    parser.add_argument("--database-url", default=None, help="defaults to a scratch SQLite database")
+    parser.add_argument("--cassandra-latency-ms", type=float, default=0)
+    parser.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for the queue to drain")
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    args = parser.parse_args()
+    if args.keys < 1:
+        parser.error("--keys must be at least 1")
+    if args.samples < 1:
+        parser.error("--samples must be at least 1")
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+    print(json.dumps(results, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
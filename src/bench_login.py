@@ -0,0 +1,73 @@
+"""
+Latency of an unrelated endpoint while the API handles a burst of logins.
+
+    python -m src.bench_login --url http://localhost:8000 --username tenant --password secret \
+        [--logins 200] [--concurrency 32] [--probe /api/health/database]
+
+The probe endpoint is timed on its own first, then again while `--concurrency`
+clients log in `--logins` times. With bcrypt off the request threads the probe
+latency should stay close to the baseline; compare runs with
+PASSWORD_HASH_WORKERS=0 to see the difference.
+"""
+import argparse
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def login(url: str, data: bytes):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(f"{url}/api/login", data=data)) as response:
+            response.read()
+    except urllib.error.HTTPError as e:
+        raise SystemExit(f"Login failed with {e.code}, check --username and --password")
+
+
+def probe(url: str, path: str, stop: threading.Event, count: int = None):
+    latencies = []
+    while not stop.is_set() and (count is None or len(latencies) < count):
+        started = time.perf_counter()
+        with urllib.request.urlopen(f"{url}{path}") as response:
+            response.read()
+        latencies.append((time.perf_counter() - started) * 1000)
+        time.sleep(0.01)
+    return latencies
+
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    return (f"{len(latencies)} requests, p50 {statistics.median(latencies):.1f} ms, "
+            f"p95 {latencies[int(len(latencies) * 0.95) - 1]:.1f} ms, max {latencies[-1]:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Probe latency during a login burst")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--probe", default="/api/health/database")
+    args = parser.parse_args()
+    data = urllib.parse.urlencode({"username": args.username, "password": args.password}).encode()
+
+    login(args.url, data)
+    print(f"baseline:     {summary(probe(args.url, args.probe, threading.Event(), count=100))}")
+
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=args.concurrency + 1) as executor:
+        probing = executor.submit(probe, args.url, args.probe, stop)
+        started = time.perf_counter()
+        list(executor.map(lambda _: login(args.url, data), range(args.logins)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        print(f"during burst: {summary(probing.result())}")
+    print(f"logins:       {args.logins} in {elapsed:.1f}s, {args.logins / elapsed:.1f}/s")
+
+
+if __name__ == "__main__":
+    main()
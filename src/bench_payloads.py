@@ -0,0 +1,60 @@
+"""
+Parse cost of the telemetry payload formats.
+
+    python -m src.bench_payloads [--keys 5] [--samples 50] [--payloads 2000]
+
+Times `parse_payload` on `--payloads` payloads of each format: one flat JSON
+object per sample, then `--samples` samples per payload as a JSON array and as
+MessagePack. Reports parsed samples per second, microseconds per sample and
+bytes per sample, so the numbers compare per reading and not per message.
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from .payloads import encode_samples, parse_payload
+
+
+def make_samples(count: int, keys: int):
+    now = datetime.now(timezone.utc)
+    return [(now - timedelta(seconds=count - i), {f"k{key}": round(random.uniform(0, 100), 2) for key in range(keys)})
+            for i in range(count)]
+
+
+def measure(name: str, payloads, samples_per_payload: int, suffix=None):
+    received_at = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    parsed = 0
+    for payload in payloads:
+        parsed += len(parse_payload(payload, received_at, suffix))
+    elapsed = time.perf_counter() - started
+    assert parsed == len(payloads) * samples_per_payload
+    size = sum(len(payload) for payload in payloads)
+    return {"format": name, "samples_per_payload": samples_per_payload, "samples_per_s": parsed / elapsed,
+            "us_per_sample": elapsed / parsed * 1e6, "bytes_per_sample": size / parsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing of the telemetry payload formats")
+    parser.add_argument("--keys", type=int, default=5)
+    parser.add_argument("--samples", type=int, default=50, help="samples per batched payload")
+    parser.add_argument("--payloads", type=int, default=2000, help="payloads of each format")
+    args = parser.parse_args()
+
+    single = [json.dumps(make_samples(1, args.keys)[0][1]).encode() for _ in range(args.payloads * args.samples)]
+    batches = [make_samples(args.samples, args.keys) for _ in range(args.payloads)]
+    results = [
+        measure("json", single, 1),
+        measure("json", [encode_samples(samples, "json") for samples in batches], args.samples),
+        measure("msgpack", [encode_samples(samples, "msgpack") for samples in batches], args.samples, "msgpack"),
+    ]
+    baseline = results[0]["samples_per_s"]
+    for result in results:
+        result["speedup"] = result["samples_per_s"] / baseline
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,174 @@
 import pathlib
-from cassandra.cluster import Cluster
+import threading
+from collections import deque
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
 from cassandra.auth import PlainTextAuthProvider
 from cassandra.cqlengine import connection
+from cassandra.cqlengine.management import sync_table
+from cassandra.policies import HostDistance
+from cassandra.query import dict_factory, tuple_factory
+from cassandra.protocol import NumpyProtocolHandler
+from cassandra import UnsupportedOperation
 from .config import settings
 
-import json
+# execution profile returning plain tuples, used by bulk reads
+EXEC_PROFILE_TUPLES = "tuples"
 
 BASE_DIR = pathlib.Path(__file__).parent
 CONNECT_BUNDLE = BASE_DIR / "unencrypted" / "astradb_connect.zip"
 
 
-def get_cassandra_session():
-    cloud_config= {
-        'secure_connect_bundle': CONNECT_BUNDLE
-    }
+class CassandraManager:
+    """
+    Process-wide Cassandra cluster and session, connected once and reused by every
+    reader and writer. Call `shutdown()` when the process stops.
+    """
+
+    def __init__(self):
+        self.cluster = None
+        self.session = None
+        self.analytics_session = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if self.session is not None:
+            return self.session
+        with self._lock:
+            if self.session is not None:
+                return self.session
+
+            cloud_config = {
+                'secure_connect_bundle': CONNECT_BUNDLE
+            }
+            auth_provider = PlainTextAuthProvider(settings.astradb_client_id, settings.astradb_client_secret)
+            profile = ExecutionProfile(request_timeout=settings.cassandra_request_timeout,
+                                       row_factory=dict_factory)
+            tuples_profile = ExecutionProfile(request_timeout=settings.cassandra_request_timeout,
+                                              row_factory=tuple_factory)
+            cluster_options = {}
+            if settings.cassandra_protocol_version is not None:
+                cluster_options["protocol_version"] = settings.cassandra_protocol_version
+
+            cluster = Cluster(cloud=cloud_config, auth_provider=auth_provider,
+                              execution_profiles={EXEC_PROFILE_DEFAULT: profile,
+                                                  EXEC_PROFILE_TUPLES: tuples_profile},
+                              executor_threads=settings.cassandra_executor_threads,
+                              connect_timeout=settings.cassandra_connect_timeout,
+                              metrics_enabled=settings.cassandra_metrics_enabled,
+                              **cluster_options)
+            try:
+                # Protocol v3+ multiplexes requests over one connection per host, the
+                # pool size settings only apply to v1/v2
+                cluster.set_core_connections_per_host(HostDistance.LOCAL, settings.cassandra_core_connections)
+                cluster.set_max_connections_per_host(HostDistance.LOCAL, settings.cassandra_max_connections)
+            except UnsupportedOperation:
+                pass
+
+            session = cluster.connect()
+            connection.register_connection(str(session), session=session)
+            connection.set_default_connection(str(session))
+
+            self.cluster = cluster
+            self.session = session
+            print(f"Connected to Cassandra, session: {session}")
+            return session
+
+    def connect_analytics(self):
+        # Separate session for bulk scans: when the driver is built with NumPy support,
+        # each result page is decoded straight into column arrays
+        if self.analytics_session is not None:
+            return self.analytics_session
+        self.connect()
+        with self._lock:
+            if self.analytics_session is None:
+                session = self.cluster.connect()
+                if NumpyProtocolHandler is not None:
+                    session.client_protocol_handler = NumpyProtocolHandler
+                self.analytics_session = session
+            return self.analytics_session
+
+    def _table(self, model):
+        # from the schema metadata the driver loaded on connect, no round trip
+        keyspace = self.connect().cluster.metadata.keyspaces.get(model.__keyspace__)
+        return keyspace.tables.get(model.column_family_name(include_keyspace=False)) if keyspace else None
 
-    CLIENT_ID = settings.astradb_client_id
-    CLIENT_SECRET = settings.astradb_client_secret
+    def schema_current(self, model) -> bool:
+        # every column and index of the model exists, which is all sync_table would add
+        table = self._table(model)
+        if table is None:
+            return False
+        indexed = {index.index_options.get("target", "").strip('"') for index in table.indexes.values()}
+        return all(column.db_field_name in table.columns and (not column.index or column.db_field_name in indexed)
+                   for column in model._columns.values())
+
+    def sync_tables(self, *models, alter: bool = False):
+        # -> names of the tables that were created, or altered with `alter`
+        synced = []
+        for model in models:
+            if self.schema_current(model):
+                continue
+            name = model.column_family_name(include_keyspace=False)
+            if not alter and self._table(model) is not None:
+                print(f"Cassandra table {name} is missing columns or indexes, "
+                      f"set CASSANDRA_SCHEMA_SYNC=alter to add them")
+                continue
+            sync_table(model)
+            synced.append(name)
+        return synced
+
+    def shutdown(self):
+        with self._lock:
+            if self.cluster is not None:
+                self.cluster.shutdown()
+            self.cluster = None
+            self.session = None
+            self.analytics_session = None
+
+    def metrics(self):
+        if self.session is None:
+            return {"connected": False}
+
+        hosts = []
+        for host, state in self.session.get_pool_state().items():
+            hosts.append({
+                "host": str(host.endpoint),
+                "open_connections": state["open_count"],
+                "in_flight": sum(state["in_flights"]),
+                "orphaned": sum(len(orphans) for orphans in state["orphan_requests"]),
+            })
+        result = {
+            "connected": True,
+            "protocol_version": self.cluster.protocol_version,
+            "executor_threads": settings.cassandra_executor_threads,
+            "in_flight": sum(host["in_flight"] for host in hosts),
+            "hosts": hosts,
+        }
+        if self.cluster.metrics is not None:
+            result["stats"] = self.cluster.metrics.get_stats()
+        return result
+
+
+cassandra_manager = CassandraManager()
+
+
+def get_cassandra_session():
+    return cassandra_manager.connect()
 
-    auth_provider = PlainTextAuthProvider(CLIENT_ID, CLIENT_SECRET)
-    cluster = Cluster(cloud=cloud_config, auth_provider=auth_provider)
-    session = cluster.connect()
-    connection.register_connection(str(session), session=session)
-    connection.set_default_connection(str(session))
 
-    return session
+def execute_windowed(session, statements, window: int):
+    """
+    (tag, statement) pairs -> (tag, result) in order, with at most `window` queries
+    in flight so a long range does not send a query per partition up front. The
+    following pages of a result are fetched by the caller.
+    """
+    statements = iter(statements)
+    pending = deque()
+    while True:
+        for tag, statement in statements:
+            pending.append((tag, session.execute_async(statement, execution_profile=EXEC_PROFILE_TUPLES)))
+            if len(pending) >= window:
+                break
+        if not pending:
+            return
+        tag, future = pending.popleft()
+        yield tag, future.result()
@@ -0,0 +1,172 @@
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Optional
+
+from cassandra.query import BatchStatement, BatchType
+
+from . import models
+from .cassandra_db import cassandra_manager
+from .config import settings
+from .ts_history import partition_bucket
+
+WRITE_MODES = ("concurrent", "batch")
+
+
+class CassandraWriter:
+    """
+    Writes telemetry rows into ts_kv_by_key (and the legacy ts_kv table while
+    `legacy_writes` is set) through statements prepared once per session.
+
+    In "concurrent" mode every row is sent with `execute_async`, in "batch" mode rows
+    are grouped into unlogged batches per partition. At most `concurrency` requests
+    are in flight at a time and failed requests are retried up to `max_retries`
+    times with a linear backoff.
+    """
+
+    def __init__(self, manager=cassandra_manager,
+                 mode: str = settings.cassandra_write_mode,
+                 concurrency: int = settings.cassandra_write_concurrency,
+                 max_retries: int = settings.cassandra_write_retries,
+                 batch_max_rows: int = settings.cassandra_batch_max_rows,
+                 legacy_writes: bool = settings.cassandra_legacy_writes):
+        if mode not in WRITE_MODES:
+            raise ValueError(f"Unknown Cassandra write mode '{mode}', expected one of {WRITE_MODES}")
+        self.manager = manager
+        self.mode = mode
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.batch_max_rows = batch_max_rows
+        self.legacy_writes = legacy_writes
+
+        self._session = None
+        self._insert = None
+        self._legacy_insert = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(int)
+
+    def _count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def _prepared_inserts(self):
+        session = self.manager.connect()
+        with self._lock:
+            if self._session is not session:
+                self._insert = session.prepare(
+                    f"INSERT INTO {models.TSKeyValue.__keyspace__}.{models.TSKeyValue.__table_name__} "
+                    f"(device_id, key, bucket, created_at, value) VALUES (?, ?, ?, ?, ?)"
+                )
+                self._legacy_insert = session.prepare(
+                    f"INSERT INTO {models.TSCassandra.__keyspace__}.{models.TSCassandra.__table_name__} "
+                    f"(device_id, created_at, id, key, value) VALUES (?, ?, ?, ?, ?)"
+                )
+                self._session = session
+            return session, self._insert, self._legacy_insert
+
+    def _statements(self, insert, rows, partition_size):
+        # -> [(statement, positions of the rows it writes)], the first `partition_size`
+        # values of a row are its partition key
+        if self.mode == "concurrent":
+            return [(insert.bind(row), (i,)) for i, row in enumerate(rows)]
+
+        by_partition = defaultdict(list)
+        for i, row in enumerate(rows):
+            by_partition[row[:partition_size]].append(i)
+
+        statements = []
+        for positions in by_partition.values():
+            for i in range(0, len(positions), self.batch_max_rows):
+                chunk = positions[i:i + self.batch_max_rows]
+                batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                for position in chunk:
+                    batch.add(insert, rows[position])
+                statements.append((batch, chunk))
+        return statements
+
+    def _execute_all(self, session, statements):
+        failures = []
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.concurrency)
+        done = threading.Event()
+        remaining = [len(statements)]
+
+        def finish():
+            slots.release()
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    done.set()
+
+        def on_error(exc, statement):
+            with lock:
+                failures.append((statement, exc))
+            finish()
+
+        if not statements:
+            return failures
+        for statement in statements:
+            slots.acquire()
+            try:
+                future = session.execute_async(statement)
+            except Exception as e:
+                on_error(e, statement)
+                continue
+            future.add_callbacks(callback=lambda _: finish(), errback=on_error, errback_args=(statement,))
+        done.wait()
+        return failures
+
+    def _write_statements(self, session, statements):
+        # -> positions of the rows that could not be written
+        positions = {id(statement): chunk for statement, chunk in statements}
+        self._count("requests", len(statements))
+        failures = self._execute_all(session, [statement for statement, _ in statements])
+
+        attempt = 0
+        while failures and attempt < self.max_retries:
+            attempt += 1
+            time.sleep(0.1 * attempt)
+            self._count("retried", len(failures))
+            failures = self._execute_all(session, [statement for statement, _ in failures])
+
+        failed_rows = []
+        for statement, exc in failures:
+            failed_rows.extend(positions[id(statement)])
+            print(f"Failed to write telemetry to Cassandra after {self.max_retries} retries: {str(exc)}")
+        return failed_rows
+
+    def write(self, rows, legacy: Optional[bool] = None):
+        # rows: (device_id, key, value, timestamp) -> number of rows written
+        return len(self.write_stored(rows, legacy))
+
+    def write_stored(self, rows, legacy: Optional[bool] = None):
+        # -> the rows written to ts_kv_by_key
+        if not rows:
+            return []
+        session, insert, legacy_insert = self._prepared_inserts()
+        converted = [(uuid.UUID(str(device_id)), key, float(value), timestamp)
+                     for device_id, key, value, timestamp in rows]
+
+        values = [(device_id, key, partition_bucket(timestamp), timestamp, value)
+                  for device_id, key, value, timestamp in converted]
+        failed_rows = set(self._write_statements(session, self._statements(insert, values, 3)))
+        self._count("failed", len(failed_rows))
+        self._count("written", len(rows) - len(failed_rows))
+
+        if self.legacy_writes if legacy is None else legacy:
+            legacy_values = [(device_id, timestamp, uuid.uuid4(), key, value)
+                             for device_id, key, value, timestamp in converted]
+            self._count("legacy_failed", len(self._write_statements(session, self._statements(legacy_insert,
+                                                                                              legacy_values, 1))))
+        return [row for i, row in enumerate(rows) if i not in failed_rows] if failed_rows else list(rows)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update(mode=self.mode, concurrency=self.concurrency, legacy_writes=self.legacy_writes)
+        return stats
+
+
+cassandra_writer = CassandraWriter()
@@ -0,0 +1,90 @@
+"""
+Check that the list endpoints issue a fixed number of SQL statements.
+
+    python -m src.check_queries --url http://localhost:8000 --username tenant --password secret [--rows 20]
+
+Needs a running API with DATABASE_QUERY_COUNT_HEADER=true and an account that
+can see at least `--rows` farms, assets and devices. Every list endpoint is read
+once with a single row and once with `--rows` rows, and the sub lists of farms and
+assets are read for parents with different numbers of children. If the
+X-Query-Count changes with the number of rows, a relationship is loaded lazily
+per row and the check fails.
+"""
+import argparse
+import json
+import sys
+import urllib.parse
+import urllib.request
+
+LIST_ENDPOINTS = ["/api/farms/", "/api/assets/", "/api/devices"]
+FARM_ENDPOINTS = ["/api/farms/{id}/assets", "/api/farms/{id}/assets/greenhouses",
+                  "/api/farms/{id}/assets/outdoor_fields", "/api/farms/{id}/devices"]
+ASSET_ENDPOINTS = ["/api/assets/{id}/devices"]
+
+
+def login(url: str, username: str, password: str) -> str:
+    data = urllib.parse.urlencode({"username": username, "password": password}).encode()
+    with urllib.request.urlopen(urllib.request.Request(f"{url}/api/login", data=data)) as response:
+        return json.load(response)["access_token"]
+
+
+def get(url: str, path: str, token: str, **params):
+    query = f"?{urllib.parse.urlencode(params)}" if params else ""
+    request = urllib.request.Request(f"{url}{path}{query}", headers={"Authorization": f"Bearer {token}"})
+    with urllib.request.urlopen(request) as response:
+        count = response.headers.get("X-Query-Count")
+        if count is None:
+            raise SystemExit("X-Query-Count is missing, start the API with DATABASE_QUERY_COUNT_HEADER=true")
+        return json.load(response), int(count)
+
+
+def report(path: str, counts) -> bool:
+    # counts: (rows, statements) of every read of the endpoint
+    ok = len({statements for _, statements in counts}) == 1
+    print(f"{'ok' if ok else 'FAIL':4} {path}: " + ", ".join(f"{statements} statements for {rows} rows"
+                                                        for rows, statements in sorted(counts)))
+    if len({rows for rows, _ in counts}) < 2:
+        print(f"     every read of {path} returned the same number of rows, add data to make the check meaningful")
+    return ok
+
+
+def check_list(url: str, path: str, token: str, rows: int) -> bool:
+    counts = []
+    for end in (1, rows):
+        items, statements = get(url, path, token, _end=end)
+        counts.append((len(items), statements))
+    return report(path, counts)
+
+
+def check_sub_list(url: str, path: str, token: str, ids) -> bool:
+    # the farm and asset sub lists are not paginated, compare parents with different numbers of children
+    counts = []
+    for parent_id in ids:
+        items, statements = get(url, path.format(id=parent_id), token)
+        counts.append((len(items), statements))
+    return report(path, counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the SQL statement count of the list endpoints")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--rows", type=int, default=20)
+    args = parser.parse_args()
+
+    token = login(args.url, args.username, args.password)
+    ok = all([check_list(args.url, path, token, args.rows) for path in LIST_ENDPOINTS])
+
+    farms, _ = get(args.url, "/api/farms/", token, _end=args.rows)
+    assets, _ = get(args.url, "/api/assets/", token, _end=args.rows)
+    for paths, ids in ((FARM_ENDPOINTS, [farm["farm_id"] for farm in farms]),
+                       (ASSET_ENDPOINTS, [asset["asset_id"] for asset in assets])):
+        for path in paths:
+            if ids:
+                ok = check_sub_list(args.url, path, token, ids) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
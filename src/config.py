@@ -1,3 +1,6 @@
+from datetime import datetime
+from typing import Optional
+
 from pydantic_settings import BaseSettings
 import os
 
@@ -14,13 +17,139 @@ class Settings(BaseSettings):
     secret_key: str
     algorithm: str
     access_token_expire_minutes: int
-    
+
     astradb_keyspace: str
     astradb_client_id: str
     astradb_client_secret: str
 
     admin_password: str
-    
+    # seconds between the startup tasks retrying a dependency that was down
+    startup_retry_interval: float = 5
+
+    # postgres connection pools
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout: float = 30
+    database_pool_recycle: int = 1800
+    database_pool_pre_ping: bool = True
+    ingest_database_pool_size: int = 3
+    ingest_database_max_overflow: int = 2
+
+    # serve the hot read routes through an asyncpg engine
+    database_async_enabled: bool = False
+
+    # report the number of SQL statements of every request in X-Query-Count
+    database_query_count_header: bool = False
+
+    # telemetry ingestion queue
+    ingest_batch_size: int = 500
+    ingest_flush_interval: float = 0.5
+    ingest_queue_size: int = 10000
+    ingest_workers: int = 2
+    ingest_backpressure: str = "block"  # block | drop_oldest | spill
+    ingest_spill_path: str = "ingest_spill.jsonl"
+    # device timestamps further ahead of the server clock are replaced (seconds)
+    ingest_max_clock_skew: float = 300
+
+    # cassandra connection pool
+    cassandra_executor_threads: int = 4
+    cassandra_core_connections: int = 2
+    cassandra_max_connections: int = 8
+    cassandra_protocol_version: Optional[int] = None
+    cassandra_connect_timeout: float = 5
+    cassandra_request_timeout: float = 10
+    cassandra_metrics_enabled: bool = False
+    # connect in the background at startup, otherwise on first use
+    cassandra_connect_on_startup: bool = True
+    # telemetry tables checked against the driver's schema metadata at startup: create adds
+    # the missing ones, alter also adds missing columns and indexes to the existing ones
+    cassandra_schema_sync: str = "create"  # off | create | alter
+
+    # cassandra telemetry writer
+    cassandra_write_mode: str = "concurrent"  # concurrent | batch
+    cassandra_write_concurrency: int = 64
+    cassandra_write_retries: int = 3
+    cassandra_batch_max_rows: int = 50
+    cassandra_ts_partition: str = "day"  # day | month
+    # keep writing the legacy ts_kv table until every reader has moved to ts_kv_by_key
+    cassandra_legacy_writes: bool = True
+
+    # mqtt telemetry subscription
+    mqtt_subscription_mode: str = "wildcard"  # wildcard | per_device
+    mqtt_registry_refresh_interval: float = 60
+    # start ingesting when the API starts, off for tools that drive MQTTSubscriber themselves
+    # and for API processes next to standalone ingest workers (python -m src.ingest_worker)
+    mqtt_autostart: bool = True
+    mqtt_protocol: str = "3.1.1"  # 3.1.1 | 5
+    # consume through $share/<group>/..., only keeps the per device state (rollup buckets,
+    # alert debounce) in one process if the broker pins a topic to one member (e.g. EMQX hash_topic)
+    mqtt_shared_group: Optional[str] = None
+    # this process ingests the devices with crc32(device_id) % ingest_partitions == ingest_partition,
+    # with per_device subscriptions it only subscribes to those
+    ingest_partitions: int = 1
+    ingest_partition: int = 0
+
+    # telemetry history reads
+    telemetry_history_max_limit: int = 10000
+    telemetry_history_max_pages: int = 20
+    telemetry_scan_fetch_size: int = 5000
+    # partition queries in flight per aggregate, downsample or rollup read
+    telemetry_scan_concurrency: int = 16
+    telemetry_max_buckets: int = 5000
+    # LTTB downsamples the raw rows of ranges up to this many seconds, longer ranges
+    # are downsampled from the finest rollups with at most telemetry_downsample_max_buckets
+    # buckets per key
+    telemetry_downsample_raw_range: float = 86400
+    telemetry_downsample_max_buckets: int = 100000
+
+    # pre-aggregated 1m/1h/1d telemetry rollups (seconds)
+    telemetry_rollups_enabled: bool = True
+    telemetry_rollup_flush_interval: float = 10
+    telemetry_rollup_grace: float = 300
+    # telemetry before this time has no rollups (python -m src.ts_migrate --rollups backfills
+    # them), aggregates over older ranges are read from the raw rows
+    telemetry_rollups_since: Optional[datetime] = None
+
+    # telemetry row counters (seconds)
+    telemetry_counters_enabled: bool = True
+    telemetry_counter_flush_interval: float = 10
+    telemetry_count_max_days: int = 366
+
+    # live telemetry websocket
+    realtime_max_pending: int = 1000
+    realtime_send_timeout: float = 5
+    realtime_max_subscriptions: int = 100
+    # API processes and standalone ingest workers running apart: the workers publish their
+    # updates and alerts on realtime_relay_topic for the API processes, and every process
+    # publishes the cache invalidations of its routes on control_topic for the others
+    realtime_relay: bool = False
+    realtime_relay_topic: str = "greenhouse/realtime"
+    control_topic: str = "greenhouse/control"
+
+    # latest telemetry served from memory (seconds)
+    latest_store_enabled: bool = True
+    latest_store_ttl: float = 60
+
+    # largest page of the list endpoints
+    list_max_limit: int = 1000
+
+    # password hashing, 0 workers hashes in the request thread
+    bcrypt_rounds: int = 12
+    password_hash_workers: int = 2
+
+    # users and their accessible farm/asset/device ids (seconds, 0 disables); several API
+    # processes need realtime_relay for revocations to reach the others before it expires
+    auth_cache_ttl: float = 30
+    auth_cache_size: int = 10000
+
+    # threshold alerts: `alert_debounce` readings in a row raise or clear an alert, and
+    # clearing needs the value back inside the range by `alert_hysteresis` of its width
+    alert_debounce: int = 2
+    alert_hysteresis: float = 0.05
+
+    # ingest metadata cache and threshold rules (seconds)
+    metadata_cache_ttl: float = 300
+
     class Config:
         env_file = ".env"
 
@@ -1,18 +1,123 @@
-from sqlalchemy import create_engine
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 from .config import settings
 
 SQLALCHEMY_DATABASE_URL = (f'postgresql://{settings.database_username}:{settings.database_password}'
                            f'@{settings.database_hostname}:{settings.database_port}'
                            f'/{settings.database_name}')
-                            
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
-)
+
+class PoolMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.pool = None
+        self.checkouts = 0
+        self.overflow_events = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def record_checkout(self, wait: float, overflowed: bool):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            if overflowed:
+                self.overflow_events += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            result = {
+                "checkouts": self.checkouts,
+                "overflow_events": self.overflow_events,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+            }
+        if self.pool is not None:
+            result.update(size=self.pool.size(), checked_out=self.pool.checkedout(),
+                          checked_in=self.pool.checkedin(), overflow=self.pool.overflow())
+        return result
+
+
+class MeteredPoolMixin:
+    # Times every checkout (including the wait for a free connection) and counts
+    # overflow connections and checkout timeouts into `metrics`
+    metrics: PoolMetrics = None
+
+    def _do_get(self):
+        overflow = self.overflow()
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.record_timeout()
+            raise
+        # overflow() counts up from -pool_size, it only goes positive past the core pool
+        self.metrics.record_checkout(time.perf_counter() - start, self.overflow() > max(overflow, 0))
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        self.metrics.pool = pool
+        return pool
+
+
+class MeteredQueuePool(MeteredPoolMixin, QueuePool):
+    pass
+
+
+class MeteredAsyncQueuePool(MeteredPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+pool_metrics = {}
+
+
+def _metered(engine, name: str):
+    metrics = PoolMetrics(name)
+    metrics.pool = engine.pool
+    engine.pool.metrics = metrics
+    pool_metrics[name] = metrics
+    return engine
+
+
+def _pool_options(pool_size: int, max_overflow: int):
+    return dict(pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_timeout=settings.database_pool_timeout,
+                pool_recycle=settings.database_pool_recycle,
+                pool_pre_ping=settings.database_pool_pre_ping)
+
+
+# API requests and telemetry ingestion use separate pools so a burst of
+# telemetry cannot starve user requests of connections
+engine = _metered(create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    poolclass=MeteredQueuePool,
+    **_pool_options(settings.database_pool_size, settings.database_max_overflow)
+), "api")
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+ingest_engine = _metered(create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    poolclass=MeteredQueuePool,
+    **_pool_options(settings.ingest_database_pool_size, settings.ingest_database_max_overflow)
+), "ingest")
+IngestSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=ingest_engine)
+
 Base = declarative_base()
 
 
@@ -22,3 +127,54 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# Optional asyncpg engine for the async read routes
+ASYNC_SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace('postgresql://', 'postgresql+asyncpg://', 1)
+
+async_engine = None
+AsyncSessionLocal = None
+
+if settings.database_async_enabled:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+    async_engine = create_async_engine(
+        ASYNC_SQLALCHEMY_DATABASE_URL,
+        poolclass=MeteredAsyncQueuePool,
+        **_pool_options(settings.database_pool_size, settings.database_max_overflow)
+    )
+    _metered(async_engine.sync_engine, "api_async")
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# statements executed while handling the current request, see count_statements
+_statement_counter: ContextVar = ContextVar("statement_counter", default=None)
+
+
+def count_statements():
+    # the returned list is shared with the threads and tasks started from this
+    # context, its single item is the number of statements executed so far
+    counter = [0]
+    _statement_counter.set(counter)
+    return counter
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counter = _statement_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+if settings.database_query_count_header:
+    event.listen(engine, "before_cursor_execute", _count_statement)
+    if async_engine is not None:
+        event.listen(async_engine.sync_engine, "before_cursor_execute", _count_statement)
+
+
+def get_pool_metrics():
+    return {name: metrics.snapshot() for name, metrics in pool_metrics.items()}
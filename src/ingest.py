@@ -0,0 +1,296 @@
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional
+
+import orjson
+
+from .alerts import record_alerts, threshold_engine
+from .config import settings
+from .database import IngestSessionLocal
+from .cassandra_writer import cassandra_writer
+from .latest_store import latest_store
+from .metadata_cache import metadata_cache
+from .realtime import realtime_hub, relay_message
+from .route.telemetry import upsert_latest_values
+from .ts_counter import telemetry_counter
+from .ts_rollup import rollup_accumulator
+
+BACKPRESSURE_POLICIES = ("block", "drop_oldest", "spill")
+
+
+def device_partition(device_id: str, partitions: int) -> int:
+    # stable across processes, unlike hash()
+    return zlib.crc32(device_id.encode()) % partitions
+
+
+class TelemetryMessage(NamedTuple):
+    device_id: str
+    data: dict
+    received_at: datetime
+    # the JSON payload `data` was parsed from, republished as is; not spilled
+    payload: Optional[bytes] = None
+
+    def to_json(self):
+        return json.dumps({"device_id": self.device_id,
+                           "data": self.data,
+                           "received_at": self.received_at.isoformat()})
+
+    @classmethod
+    def from_json(cls, line: str):
+        raw = json.loads(line)
+        return cls(raw["device_id"], raw["data"], datetime.fromisoformat(raw["received_at"]))
+
+
+class CommittedBatch(NamedTuple):
+    # what write_telemetry_batch committed to Postgres, for finish_telemetry_batch
+    messages: List[TelemetryMessage]
+    devices: dict
+    rows: list
+    updates: list
+    alerts: List[dict]
+    new_asset_keys: list
+
+
+class IngestQueue:
+    """
+    Bounded in-process queue between the MQTT network loop and the databases.
+
+    Producers only enqueue parsed messages; a pool of worker threads drains the
+    queue in micro-batches (up to `batch_size` messages or `flush_interval`
+    seconds, whichever comes first) and hands each batch to `handler`, which
+    commits it. A batch the handler fails is retried in halves; what it returns is
+    then handed to `after_commit` once, whose failures are only counted since the
+    batch is committed already. Every worker has a queue of its own and a device
+    always goes to the same one, so the batches of a device commit in the order
+    their alerts were evaluated: an alert is never cleared before it is inserted.
+    When the queue of a worker is full, `backpressure` decides what happens:
+      - block: the producer waits for room (the broker connection slows down)
+      - drop_oldest: the oldest queued message is discarded
+      - spill: the message is appended to `spill_path` and replayed once the
+        queues have drained below half their capacity
+    """
+
+    def __init__(self, handler: Callable[[List[TelemetryMessage]], object],
+                 after_commit: Optional[Callable[[object], None]] = None,
+                 batch_size: int = settings.ingest_batch_size,
+                 flush_interval: float = settings.ingest_flush_interval,
+                 max_size: int = settings.ingest_queue_size,
+                 workers: int = settings.ingest_workers,
+                 backpressure: str = settings.ingest_backpressure,
+                 spill_path: str = settings.ingest_spill_path):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy '{backpressure}', "
+                             f"expected one of {BACKPRESSURE_POLICIES}")
+        self.handler = handler
+        self.after_commit = after_commit
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.workers = workers
+        self.backpressure = backpressure
+        self.spill_path = spill_path
+
+        # max_size is shared by the workers' queues
+        self._queues = [queue.Queue(maxsize=max(1, max_size // workers)) for _ in range(workers)]
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(int)
+
+    def _count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def _queue_of(self, device_id: str) -> queue.Queue:
+        return self._queues[device_partition(device_id, len(self._queues))]
+
+    def depth(self) -> int:
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def put(self, message: TelemetryMessage):
+        worker_queue = self._queue_of(message.device_id)
+        if self.backpressure == "block":
+            worker_queue.put(message)
+        elif self.backpressure == "drop_oldest":
+            while True:
+                try:
+                    worker_queue.put_nowait(message)
+                    break
+                except queue.Full:
+                    try:
+                        worker_queue.get_nowait()
+                        self._count("dropped")
+                    except queue.Empty:
+                        pass
+        else:
+            try:
+                worker_queue.put_nowait(message)
+            except queue.Full:
+                self._spill([message])
+        self._count("enqueued")
+
+    def _spill(self, messages: List[TelemetryMessage]):
+        with self._spill_lock:
+            with open(self.spill_path, "a") as f:
+                for message in messages:
+                    f.write(message.to_json() + "\n")
+        self._count("spilled", len(messages))
+
+    def _replay_spill(self):
+        if self.backpressure != "spill" or self.depth() > self.max_size // 2:
+            return
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return
+            with open(self.spill_path) as f:
+                lines = f.readlines()
+            os.remove(self.spill_path)
+
+        leftover = []
+        for line in lines:
+            message = TelemetryMessage.from_json(line)
+            if leftover:
+                leftover.append(message)
+                continue
+            try:
+                self._queue_of(message.device_id).put_nowait(message)
+                self._count("replayed")
+            except queue.Full:
+                leftover.append(message)
+        if leftover:
+            self._spill(leftover)
+
+    def _next_batch(self, worker_queue: queue.Queue) -> List[TelemetryMessage]:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(worker_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, worker_queue: queue.Queue):
+        while not (self._stopping.is_set() and worker_queue.empty()):
+            batch = self._next_batch(worker_queue)
+            if batch:
+                self._handle(batch)
+            self._replay_spill()
+
+    def _handle(self, batch: List[TelemetryMessage]):
+        try:
+            committed = self.handler(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self._count("failed")
+                print(f"Failed to write telemetry from device {batch[0].device_id}: {str(e)}")
+                return
+            # the batch is retried in halves, so a bad message only costs itself and not
+            # the messages of the other devices batched with it
+            self._count("split")
+            middle = len(batch) // 2
+            self._handle(batch[:middle])
+            self._handle(batch[middle:])
+            return
+        self._count("processed", len(batch))
+        self._count("batches")
+        if self.after_commit is None:
+            return
+        try:
+            self.after_commit(committed)
+        except Exception as e:
+            # never retried, the batch would be upserted and published again
+            self._count("after_commit_failed", len(batch))
+            print(f"Failed to process {len(batch)} committed telemetry messages: {str(e)}")
+
+    def start(self):
+        self._stopping.clear()
+        for i, worker_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(worker_queue,), name=f"ingest-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update(depth=self.depth(), max_size=self.max_size,
+                     backpressure=self.backpressure)
+        return stats
+
+
+def write_telemetry_batch(batch: List[TelemetryMessage]) -> CommittedBatch:
+    # Postgres only, everything that cannot be rolled back is left to after_commit
+    db = IngestSessionLocal()
+    rows = []
+    updates = []
+    undo = None
+    try:
+        devices = metadata_cache.resolve({message.device_id for message in batch}, db)
+
+        for message in batch:
+            device = devices.get(message.device_id)
+            if device is None:
+                print(f"Dropping telemetry from unknown device {message.device_id}")
+                continue
+            updates.append((message.device_id, device.asset_id, message.data, message.received_at))
+            for key, value in message.data.items():
+                rows.append((message.device_id, key, value, message.received_at))
+
+        new_asset_keys = upsert_latest_values(rows, devices, db)
+        alerts, undo = threshold_engine.evaluate(rows, devices, db)
+        record_alerts(alerts, db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        if undo is not None:
+            threshold_engine.restore(undo)
+        raise
+    finally:
+        db.close()
+    return CommittedBatch(batch, devices, rows, updates, alerts, new_asset_keys)
+
+
+def finish_telemetry_batch(committed: CommittedBatch, publish: Callable[[str, str], None]):
+    # only committed telemetry reaches the dashboards and Cassandra
+    devices, rows, updates, alerts = committed.devices, committed.rows, committed.updates, committed.alerts
+    metadata_cache.add_known_keys(committed.new_asset_keys)
+    latest_store.update(rows, devices)
+    try:
+        for message in committed.messages:
+            device = devices.get(message.device_id)
+            if device is not None:
+                # Republish for fe
+                publish(f"assets/{device.asset_id}/telemetry",
+                        message.payload if message.payload is not None else orjson.dumps(message.data))
+        realtime_hub.publish(updates)
+        realtime_hub.publish_alerts(alerts)
+        if settings.realtime_relay and (updates or alerts):
+            publish(settings.realtime_relay_topic,
+                    relay_message(updates, alerts,
+                                  {device_id: devices[device_id].name for device_id, _, _, _ in updates}))
+    except Exception as e:
+        # the history below is written regardless
+        print(f"Failed to publish committed telemetry: {str(e)}")
+
+    stored = cassandra_writer.write_stored(rows)
+    if settings.telemetry_rollups_enabled:
+        rollup_accumulator.add(rows)
+    if settings.telemetry_counters_enabled:
+        # the counts match the rows that can be read back
+        telemetry_counter.add(stored)
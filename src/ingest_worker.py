@@ -0,0 +1,82 @@
+"""
+Standalone telemetry ingest, without the API.
+
+    python -m src.ingest_worker [--partitions 1 --partition 0] [--shared-group GROUP]
+        [--stats-interval 60]
+
+Runs the MQTT subscriber and its ingest pipeline (Postgres, Cassandra, rollups,
+counters, alerts) in a process of its own; the API processes then run with
+MQTT_AUTOSTART=false. Ingest scales out in two ways, which can be combined:
+
+- hash partitions: the worker ingests the devices with
+  crc32(device_id) % partitions == partition, run one worker per partition. With
+  MQTT_SUBSCRIPTION_MODE=per_device it only subscribes to those devices, with a
+  wildcard subscription every worker still receives every message and drops the
+  others'.
+- shared subscriptions: the workers subscribe to $share/GROUP/devices/+/telemetry/#
+  and the broker delivers each message to one member of the group. The rollup
+  buckets and alert debounce state live in the worker, so a device has to stay on
+  one worker: use a broker that pins a topic to a member (EMQX hash_topic),
+  mosquitto hands the messages out round robin. Partitioned workers need a group
+  per partition, e.g. `--shared-group ingest-0`, to run replicas of a partition.
+
+MQTT_PROTOCOL=5 connects with MQTT 5. With REALTIME_RELAY=true the workers publish
+their updates and alerts on REALTIME_RELAY_TOPIC, which API processes with the same
+setting forward to their websocket clients and latest value store, and apply the
+cache invalidations the API routes publish on CONTROL_TOPIC (deleted devices,
+threshold changes, ...) as soon as they are made. Stats are printed every
+`--stats-interval` seconds, SIGINT/SIGTERM drain the ingest queue and stop.
+"""
+import argparse
+import json
+import os
+import signal
+import threading
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the telemetry ingest without the API")
+    parser.add_argument("--partitions", type=int, help="overrides INGEST_PARTITIONS")
+    parser.add_argument("--partition", type=int, help="overrides INGEST_PARTITION")
+    parser.add_argument("--shared-group", help="overrides MQTT_SHARED_GROUP")
+    parser.add_argument("--stats-interval", type=float, default=60)
+    args = parser.parse_args()
+    if args.partitions is not None:
+        os.environ["INGEST_PARTITIONS"] = str(args.partitions)
+    if args.partition is not None:
+        os.environ["INGEST_PARTITION"] = str(args.partition)
+    if args.shared_group is not None:
+        os.environ["MQTT_SHARED_GROUP"] = args.shared_group
+    # imported after the arguments override the settings
+
+    from .alerts import threshold_engine
+    from .cassandra_db import cassandra_manager
+    from .cassandra_writer import cassandra_writer
+    from .config import settings
+    from .mqtt import cluster_channel, mqtt_subscriber, start_ingest
+    from .ts_rollup import rollup_accumulator
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+
+    cassandra_manager.connect()
+    print(f"Ingest partition {mqtt_subscriber.partition + 1}/{mqtt_subscriber.partitions}, "
+          f"MQTT {settings.mqtt_protocol}, topics {mqtt_subscriber.topic()}")
+    start_ingest()
+    if settings.realtime_relay:
+        cluster_channel.start()
+    try:
+        while not stopping.wait(args.stats_interval):
+            print(json.dumps({"queue": mqtt_subscriber.ingest.stats(), "cassandra_writer": cassandra_writer.stats(),
+                              "rollups": rollup_accumulator.stats(), "alerts": threshold_engine.stats()},
+                             default=str))
+    finally:
+        print("Stopping ingest")
+        cluster_channel.stop()
+        mqtt_subscriber.stop()
+        cassandra_manager.shutdown()
+
+
+if __name__ == "__main__":
+    main()
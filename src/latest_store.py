@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, Optional
+from uuid import UUID
+
+from sqlalchemy import select
+
+from . import models
+from .config import settings
+
+
+def device_latest_statement(device_id: UUID):
+    # ts_values_latest already holds one row per (device_id, key)
+    return (select(models.TimeSeries.key, models.TimeSeries.value, models.TimeSeries.device_id,
+                   models.TimeSeries.timestamp)
+            .where(models.TimeSeries.device_id == device_id))
+
+
+def asset_latest_statement(asset_id: UUID):
+    # newest value of every key over the devices of the asset
+    return (select(models.TimeSeries.key, models.TimeSeries.value, models.TimeSeries.device_id,
+                   models.TimeSeries.timestamp, models.Device.name.label('device_name'))
+            .join(models.Device, models.TimeSeries.device_id == models.Device.device_id)
+            .where(models.Device.asset_id == asset_id)
+            .distinct(models.TimeSeries.key)
+            .order_by(models.TimeSeries.key, models.TimeSeries.timestamp.desc()))
+
+
+class _Entry:
+    __slots__ = ("values", "loaded_at")
+
+    def __init__(self, values: dict):
+        # key -> row dict
+        self.values = values
+        self.loaded_at = time.monotonic()
+
+
+class LatestValueStore:
+    """
+    Latest telemetry per device and per asset, served to the `telemetry/latest`
+    routes without touching Postgres.
+
+    Entries are loaded from Postgres on first use and then kept current by the
+    ingest path; an update for an entry that is not loaded is ignored since the
+    next read loads it with the committed value anyway. Entries are reloaded after
+    `ttl` seconds to pick up writes from other processes. When disabled every read
+    misses and loaded rows are passed through.
+    """
+
+    def __init__(self, ttl: float = settings.latest_store_ttl, enabled: bool = settings.latest_store_enabled):
+        self.ttl = ttl
+        self.enabled = enabled
+        self._devices: Dict[str, _Entry] = {}
+        self._assets: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+        self._stats = defaultdict(int)
+
+    def _get(self, entries: dict, entity_id) -> Optional[list]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = entries.get(str(entity_id))
+            if entry is None or time.monotonic() - entry.loaded_at >= self.ttl:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            return list(entry.values.values())
+
+    def _put(self, entries: dict, entity_id, rows: Iterable) -> list:
+        values = {row["key"]: row for row in rows}
+        if not self.enabled:
+            return list(values.values())
+        with self._lock:
+            previous = entries.get(str(entity_id))
+            if previous is not None:
+                # keep what the ingest path wrote while the rows were loading
+                for key, row in previous.values.items():
+                    if key not in values or row["timestamp"] > values[key]["timestamp"]:
+                        values[key] = row
+            entries[str(entity_id)] = _Entry(values)
+        return list(values.values())
+
+    def get_device(self, device_id: UUID) -> Optional[list]:
+        return self._get(self._devices, device_id)
+
+    def put_device(self, device_id: UUID, rows: Iterable) -> list:
+        return self._put(self._devices, device_id, [dict(row._mapping) for row in rows])
+
+    def get_asset(self, asset_id: UUID) -> Optional[list]:
+        return self._get(self._assets, asset_id)
+
+    def put_asset(self, asset_id: UUID, rows: Iterable) -> list:
+        return self._put(self._assets, asset_id, [dict(row._mapping) for row in rows])
+
+    def update(self, rows: Iterable, devices: dict):
+        # rows: (device_id, key, value, timestamp), devices: device_id -> DeviceMetadata
+        with self._lock:
+            for device_id, key, value, timestamp in rows:
+                device = devices[device_id]
+                row = {"key": key, "value": value, "device_id": UUID(device_id), "timestamp": timestamp}
+                entry = self._devices.get(device_id)
+                if entry is not None:
+                    current = entry.values.get(key)
+                    if current is None or timestamp >= current["timestamp"]:
+                        entry.values[key] = row
+                entry = self._assets.get(str(device.asset_id))
+                if entry is not None:
+                    current = entry.values.get(key)
+                    if current is None or timestamp >= current["timestamp"]:
+                        entry.values[key] = dict(row, device_name=device.name)
+
+    def invalidate_device(self, device_id):
+        # the device may have moved between assets, asset entries reload cheaply
+        with self._lock:
+            self._devices.pop(str(device_id), None)
+            self._assets.clear()
+
+    def invalidate_asset(self, asset_id):
+        with self._lock:
+            self._assets.pop(str(asset_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._devices.clear()
+            self._assets.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(devices=len(self._devices), assets=len(self._assets))
+        return stats
+
+
+latest_store = LatestValueStore()
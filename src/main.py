@@ -1,17 +1,26 @@
-from fastapi import FastAPI
+from .startup import startup_timer
+
+import asyncio
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from cassandra.cqlengine.management import sync_table
 
 from . import models, utils
-from .database import SessionLocal, engine
-from .route import device, user, auth, farm, telemetry, asset
+from .database import SessionLocal, engine, async_engine, count_statements
+from .route import device, user, auth, farm, telemetry, asset, health, realtime
+from .mqtt import mqtt_subscriber, cluster_channel, start_ingest
 from .config import settings
-from .cassandra_db import get_cassandra_session
+from .cassandra_db import cassandra_manager
+from .realtime import realtime_hub
 
 app = FastAPI(
     title="Greenhouse",
     description="API for greenhouse project",
-    version="0.1.0"
+    version="0.1.0",
+    # orjson encodes what the routes return, see responses.list_response for the large lists
+    default_response_class=ORJSONResponse
 )
 
 origins = ["*"]
@@ -22,24 +31,41 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["x-total-count"],
+    expose_headers=["x-total-count", "x-next-cursor", "x-query-count"],
 )
 
+if settings.database_query_count_header:
+    @app.middleware("http")
+    async def add_query_count(request: Request, call_next):
+        counter = count_statements()
+        response = await call_next(request)
+        response.headers["X-Query-Count"] = str(counter[0])
+        return response
+
 #models.Base.metadata.create_all(bind=engine)
 
+if settings.database_async_enabled:
+    # same paths as the sync routes, registered first so they take precedence
+    app.include_router(asset.async_router)
+    app.include_router(device.async_router)
+
 app.include_router(auth.router)
 app.include_router(user.router)
 app.include_router(farm.router)
 app.include_router(asset.router)
 app.include_router(device.router)
 app.include_router(telemetry.router)
+app.include_router(health.router)
+app.include_router(realtime.router)
 
 
-@app.on_event("startup")
-def create_admin():
+startup_timer.mark("imported")
+
+
+def ensure_admin():
     db = SessionLocal()
     try:
-        if not db.query(models.User).all():
+        if not db.query(db.query(models.User).exists()).scalar():
             admin_user = models.User(username="admin",
                                      password=utils.get_password_hash(settings.admin_password),
                                      role="admin",
@@ -49,12 +75,80 @@ def create_admin():
             print(admin_user)
     finally:
         db.close()
+
+@app.on_event("startup")
+def create_admin():
+    try:
+        with startup_timer.phase("admin"):
+            ensure_admin()
+    except Exception as e:
+        # Postgres is not up yet: serve anyway, the database routes fail until it is
+        print(f"Failed to check for the admin user, retrying in the background: {str(e)}")
+
+        def retry():
+            while True:
+                time.sleep(settings.startup_retry_interval)
+                try:
+                    return ensure_admin()
+                except Exception as e:
+                    print(f"Failed to check for the admin user: {str(e)}")
+
+        startup_timer.in_background("admin_retry", retry)
         
 @app.on_event("startup")
-def sync_cassandra_table():
-    db = get_cassandra_session()
-    print("Cassandra session: " + str(db))
-    sync_table(models.TSCassandra)
+async def bind_realtime_hub():
+    realtime_hub.bind(asyncio.get_running_loop())
+
+@app.on_event("startup")
+def start_mqtt_ingest():
+    # connects in the background, the broker is not waited for
+    with startup_timer.phase("mqtt"):
+        if settings.mqtt_autostart:
+            start_ingest()
+        if settings.realtime_relay:
+            # the standalone ingest workers publish what this process would have ingested itself
+            cluster_channel.start(relay_realtime=not settings.mqtt_autostart)
+
+@app.on_event("startup")
+def connect_cassandra():
+    # every reader and writer connects on first use, this only gets the connection
+    # (and the schema sync) going before the first request needs it
+    if settings.cassandra_schema_sync not in ("off", "create", "alter"):
+        raise ValueError(f"Unknown Cassandra schema sync '{settings.cassandra_schema_sync}'")
+
+    def connect():
+        cassandra_manager.connect()
+        if settings.cassandra_schema_sync != "off":
+            with startup_timer.phase("cassandra_schema"):
+                synced = cassandra_manager.sync_tables(models.TSCassandra, models.TSKeyValue,
+                                                       models.TSRollup, models.TSCount,
+                                                       alter=settings.cassandra_schema_sync == "alter")
+                print(f"Synced Cassandra tables: {synced or 'none'}")
+
+    if settings.cassandra_connect_on_startup or settings.cassandra_schema_sync != "off":
+        startup_timer.in_background("cassandra", connect)
+
+@app.on_event("startup")
+def report_startup():
+    startup_timer.mark("ready")
+
+@app.on_event("shutdown")
+def stop_mqtt_ingest():
+    mqtt_subscriber.stop()
+    cluster_channel.stop()
+
+@app.on_event("shutdown")
+def close_cassandra():
+    cassandra_manager.shutdown()
+
+@app.on_event("shutdown")
+def stop_password_hasher():
+    utils.shutdown_password_hasher()
+
+@app.on_event("shutdown")
+async def close_async_engine():
+    if async_engine is not None:
+        await async_engine.dispose()
 
 @app.get('/')
 def home():
@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, Optional
+from uuid import UUID
+
+from sqlalchemy.orm import Session
+
+from . import models
+from .config import settings
+
+
+class AssetMetadata:
+    __slots__ = ("asset_id", "known_keys", "loaded_at")
+
+    def __init__(self, asset_id: UUID, known_keys: set):
+        self.asset_id = asset_id
+        self.known_keys = known_keys
+        self.loaded_at = time.monotonic()
+
+
+class DeviceMetadata:
+    __slots__ = ("device_id", "name", "asset")
+
+    def __init__(self, device_id: str, name: str, asset: AssetMetadata):
+        self.device_id = device_id
+        self.name = name
+        self.asset = asset
+
+    @property
+    def asset_id(self):
+        return self.asset.asset_id
+
+
+class MetadataCache:
+    """
+    device_id -> device/asset/known key metadata used by the ingest path.
+
+    Entries expire after `ttl` seconds and are dropped explicitly by the routes
+    that change devices, assets or keys. Unknown device ids are cached
+    too so that a misconfigured device does not cost a query per message.
+    """
+
+    def __init__(self, ttl: float = settings.metadata_cache_ttl):
+        self.ttl = ttl
+        self._devices: Dict[str, Optional[DeviceMetadata]] = {}
+        self._device_loaded_at: Dict[str, float] = {}
+        self._assets: Dict[UUID, AssetMetadata] = {}
+        self._lock = threading.Lock()
+        self._stats = defaultdict(int)
+
+    def _fresh(self, loaded_at: float, now: float):
+        return now - loaded_at < self.ttl
+
+    def resolve(self, device_ids: Iterable[str], db: Session) -> Dict[str, DeviceMetadata]:
+        now = time.monotonic()
+        found = {}
+        missing = set()
+        with self._lock:
+            for device_id in device_ids:
+                loaded_at = self._device_loaded_at.get(device_id)
+                device = self._devices.get(device_id)
+                if (loaded_at is not None and self._fresh(loaded_at, now)
+                        and (device is None or self._fresh(device.asset.loaded_at, now))):
+                    self._stats["hits"] += 1
+                    if device is not None:
+                        found[device_id] = device
+                else:
+                    self._stats["misses"] += 1
+                    missing.add(device_id)
+
+        if missing:
+            found.update(self._load(missing, db))
+        return found
+
+    def _load(self, device_ids: set, db: Session) -> Dict[str, DeviceMetadata]:
+        rows = (db.query(models.Device.device_id, models.Device.name, models.Device.asset_id)
+                .filter(models.Device.device_id.in_([UUID(device_id) for device_id in device_ids])).all())
+
+        now = time.monotonic()
+        with self._lock:
+            stale_assets = {asset_id for _, _, asset_id in rows
+                            if asset_id not in self._assets or not self._fresh(self._assets[asset_id].loaded_at, now)}
+
+        known_keys = defaultdict(set)
+        if stale_assets:
+            for asset_id, ts_key in (db.query(models.key_usages.c.asset_id, models.key_usages.c.ts_key)
+                                     .filter(models.key_usages.c.asset_id.in_(stale_assets))):
+                known_keys[asset_id].add(ts_key)
+
+        loaded = {}
+        with self._lock:
+            for asset_id in stale_assets:
+                previous = self._assets.get(asset_id)
+                if previous is not None:
+                    previous.loaded_at = float("-inf")
+                self._assets[asset_id] = AssetMetadata(asset_id, known_keys[asset_id])
+            for device_id, name, asset_id in rows:
+                if asset_id not in self._assets:
+                    # invalidated while loading, the next lookup reloads it
+                    continue
+                device = DeviceMetadata(str(device_id), name, self._assets[asset_id])
+                self._devices[device.device_id] = device
+                loaded[device.device_id] = device
+            for device_id in device_ids:
+                self._devices.setdefault(device_id, None)
+                self._device_loaded_at[device_id] = now
+        return loaded
+
+    def add_known_keys(self, asset_keys: Iterable):
+        # (asset_id, key) pairs that were just written to key_usages
+        with self._lock:
+            for asset_id, key in asset_keys:
+                asset = self._assets.get(asset_id)
+                if asset is not None:
+                    asset.known_keys.add(key)
+
+    def invalidate_device(self, device_id):
+        with self._lock:
+            self._devices.pop(str(device_id), None)
+            self._device_loaded_at.pop(str(device_id), None)
+            self._stats["invalidations"] += 1
+
+    def invalidate_asset(self, asset_id: UUID):
+        with self._lock:
+            asset = self._assets.pop(asset_id, None)
+            if asset is not None:
+                # devices still holding the stale asset entry have to be reloaded
+                asset.loaded_at = float("-inf")
+            self._stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._devices.clear()
+            self._device_loaded_at.clear()
+            self._assets.clear()
+            self._stats["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(devices=len(self._devices), assets=len(self._assets))
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        stats["hit_ratio"] = stats.get("hits", 0) / lookups if lookups else None
+        return stats
+
+
+metadata_cache = MetadataCache()
@@ -1,6 +1,6 @@
 import uuid
 from sqlalchemy import (Boolean, Column, Integer, String, Float, Table,
-                        func, DateTime, ForeignKey, UniqueConstraint, ARRAY)
+                        func, DateTime, ForeignKey, UniqueConstraint, ARRAY, Index)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from .database import Base
@@ -39,6 +39,11 @@ class Farm(Base):
     owner_id = Column(UUID(as_uuid=True), ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
     owner = relationship('User', foreign_keys=[owner_id], primaryjoin="Farm.owner_id == User.user_id")
     customer = relationship('User', foreign_keys=[assigned_customer], primaryjoin="Farm.assigned_customer == User.user_id")
+    __table_args__ = (
+        Index('ix_farms_owner_created_at', 'owner_id', 'created_at'),
+        Index('ix_farms_assigned_customer', 'assigned_customer'),
+        Index('ix_farms_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
 
 
 class Asset(Base):
@@ -52,6 +57,10 @@ class Asset(Base):
 
     asset_keys = relationship('TimeSeriesKey', secondary='key_usages')
     farm = relationship('Farm')
+    __table_args__ = (
+        Index('ix_assets_owner_created_at', 'owner_id', 'created_at'),
+        Index('ix_assets_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
     
 key_usages = Table('key_usages', Base.metadata,
     Column('asset_id', UUID(as_uuid=True), ForeignKey('assets.asset_id', ondelete="CASCADE")),
@@ -83,6 +92,27 @@ class Threshold(Base):
         UniqueConstraint('asset_id', 'key', name='uq_asset_key_pair'),
     )
 
+
+class Alert(Base):
+    # a threshold breach of one device and key, open until cleared_at is set (see alerts.ThresholdEngine)
+    __tablename__ = 'alerts'
+    alert_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    device_id = Column(UUID(as_uuid=True), ForeignKey("devices.device_id", ondelete="CASCADE"), nullable=False)
+    asset_id = Column(UUID(as_uuid=True), ForeignKey("assets.asset_id", ondelete="CASCADE"), nullable=False)
+    key = Column(String, nullable=False)
+    kind = Column(String(10), nullable=False)  # low | high
+    value = Column(Float, nullable=False)
+    threshold_min = Column(Float)
+    threshold_max = Column(Float)
+    raised_at = Column(DateTime(timezone=True), nullable=False)
+    cleared_at = Column(DateTime(timezone=True))
+    cleared_value = Column(Float)
+    __table_args__ = (
+        Index('ix_alerts_asset_raised_at', 'asset_id', 'raised_at'),
+        Index('ix_alerts_open', 'device_id', postgresql_where=cleared_at.is_(None)),
+    )
+
+
 class DeviceProfile(Base):
     __tablename__ = 'device_profiles'
     profile_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -104,6 +134,11 @@ class Device(Base):
 
     asset = relationship("Asset")
     device_profile = relationship("DeviceProfile")
+    __table_args__ = (
+        Index('ix_devices_asset_created_at', 'asset_id', 'created_at'),
+        Index('ix_devices_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+        Index('ix_devices_label_trgm', 'label', postgresql_using='gin', postgresql_ops={'label': 'gin_trgm_ops'}),
+    )
 
 
 class TimeSeries(Base):
@@ -128,4 +163,48 @@ class TSCassandra(Model):
     key = columns.Text()
     device_id = columns.UUID(partition_key=True)
     value = columns.Float()
-    
\ No newline at end of file
+
+
+class TSKeyValue(Model):
+    # ts_kv partitioned by device, key and time bucket (UTC day or month, see
+    # settings.cassandra_ts_partition) so partitions stay bounded and a single key
+    # range read is one partition slice
+    __keyspace__ = settings.astradb_keyspace
+    __table_name__ = 'ts_kv_by_key'
+
+    device_id = columns.UUID(partition_key=True)
+    key = columns.Text(partition_key=True)
+    bucket = columns.DateTime(partition_key=True)
+    created_at = columns.DateTime(primary_key=True, clustering_order="DESC")
+    value = columns.Float()
+
+
+class TSRollup(Model):
+    # min/max/sum/count/last of ts_kv per device, key and time bucket, one partition
+    # per resolution and period (see ts_rollup.ROLLUP_RESOLUTIONS)
+    __keyspace__ = settings.astradb_keyspace
+    __table_name__ = 'ts_kv_rollup'
+
+    device_id = columns.UUID(partition_key=True)
+    key = columns.Text(partition_key=True)
+    resolution = columns.Text(partition_key=True)
+    period = columns.DateTime(partition_key=True)
+    bucket = columns.DateTime(primary_key=True)
+    min_value = columns.Double()
+    max_value = columns.Double()
+    sum_value = columns.Double()
+    count = columns.BigInt()
+    last_value = columns.Double()
+    last_ts = columns.DateTime()
+    
+
+class TSCount(Model):
+    # stored telemetry rows per device, day and key, day 1970-01-01 holds the
+    # all-time totals (see ts_counter.TelemetryCounter)
+    __keyspace__ = settings.astradb_keyspace
+    __table_name__ = 'ts_kv_counts'
+
+    device_id = columns.UUID(partition_key=True)
+    day = columns.DateTime(primary_key=True)
+    key = columns.Text(primary_key=True)
+    count = columns.Counter()
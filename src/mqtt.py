@@ -1,73 +1,304 @@
 import paho.mqtt.client as mqtt
-from .database import SessionLocal
+from .database import IngestSessionLocal
 from src import models
-import json
-from threading import Thread
-from .route.telemetry import add_ts_postgres, add_ts_cassandra
+import threading
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Optional
+from uuid import UUID
+
+import orjson
+
+from .access_cache import access_cache
+from .alerts import threshold_engine
+from .ingest import IngestQueue, TelemetryMessage, device_partition, finish_telemetry_batch, write_telemetry_batch
+from .latest_store import latest_store
+from .metadata_cache import metadata_cache
+from .payloads import parse_payload
+from .realtime import decode_relay_message, realtime_hub
+from .ts_counter import telemetry_counter
+from .ts_rollup import rollup_accumulator
 from .config import settings
 
+TELEMETRY_TOPIC = "devices/{}/telemetry"
+# also matches devices/{id}/telemetry/json and devices/{id}/telemetry/msgpack
+TELEMETRY_SUBSCRIPTION = TELEMETRY_TOPIC + "/#"
+WILDCARD_TELEMETRY_TOPIC = TELEMETRY_SUBSCRIPTION.format("+")
+MQTT_PROTOCOLS = {"3.1.1": mqtt.MQTTv311, "5": mqtt.MQTTv5}
+
+
 class MQTTSubscriber:
-    def __init__(self):
-        self.client = mqtt.Client()
+    def __init__(self, subscription_mode: str = settings.mqtt_subscription_mode,
+                 shared_group: str = settings.mqtt_shared_group,
+                 partitions: int = settings.ingest_partitions, partition: int = settings.ingest_partition):
+        if subscription_mode not in ("wildcard", "per_device"):
+            raise ValueError(f"Unknown MQTT subscription mode '{subscription_mode}'")
+        if settings.mqtt_protocol not in MQTT_PROTOCOLS:
+            raise ValueError(f"Unknown MQTT protocol '{settings.mqtt_protocol}', expected one of {tuple(MQTT_PROTOCOLS)}")
+        if not 0 <= partition < partitions:
+            raise ValueError(f"Ingest partition {partition} is not in [0, {partitions})")
+        if shared_group and partitions > 1 and subscription_mode == "wildcard":
+            # the broker would hand devices of other partitions to this member, which drops them
+            raise ValueError("A shared wildcard subscription cannot be partitioned, use one group per partition "
+                             "with per_device subscriptions")
+        self.client = mqtt.Client(protocol=MQTT_PROTOCOLS[settings.mqtt_protocol])
+        self.subscription_mode = subscription_mode
+        # the broker hands every message of the shared subscription to one member of the group
+        self.topic_prefix = f"$share/{shared_group}/" if shared_group else ""
+        self.partitions = partitions
+        self.partition = partition
+        self.ingest = IngestQueue(handler=write_telemetry_batch,
+                                  after_commit=lambda committed: finish_telemetry_batch(committed, self.client.publish))
+        # ids of the registered devices of this partition, messages from anything else are ignored
+        self.known_devices = set()
+        self._refresh_timer = None
+        self._refresh_lock = threading.Lock()
+        self.started = False
 
-    def on_connect(self, client, userdata, flags, rc):
+    def owns(self, device_id: str) -> bool:
+        return self.partitions == 1 or device_partition(device_id, self.partitions) == self.partition
+
+    def topic(self, device_id: str = "+") -> str:
+        return self.topic_prefix + TELEMETRY_SUBSCRIPTION.format(device_id)
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        # properties: MQTT 5 only
         if rc == 0:
             print(f"Connected to the MQTT broker {settings.mqtt_hostname}:{settings.mqtt_port}")
             self.subscribe_all()
-   
-       
+
+
     def on_message(self, client, userdata, msg):
-        device_id = msg.topic.split('/')[1]
-        print(f"Received message from device {device_id}, message: {msg.payload.decode()}")
+        # Runs on the paho network thread: parse and enqueue only, the ingest workers do the db work
+        topic = msg.topic.split('/')
+        device_id = topic[1]
+        if device_id not in self.known_devices:
+            if self.owns(device_id):
+                print(f"Ignoring message on topic {msg.topic}: unknown device")
+            return
         try:
-            data = json.loads(msg.payload.decode())
-        except json.JSONDecodeError:
-            print("Failed to parse JSON data")
+            samples = parse_payload(msg.payload, datetime.now(timezone.utc), topic[3] if len(topic) > 3 else None)
+        except Exception as e:
+            # an exception raised here would stop paho's network thread, and the ingest with it
+            print(f"Failed to parse telemetry on topic {msg.topic}: {str(e)}")
             return
 
-        if isinstance(data, dict) and bool(data):
-            print("Received valid JSON object. Inserting into the databases.")
-            try:
-                # Republish for fe
-                db = SessionLocal()
-                device = db.query(models.Device).filter(models.Device.device_id == device_id).first()
-                self.client.publish(f"assets/{device.asset_id}/telemetry", json.dumps(data))
-                # Add ts to databases
-                for key, value in data.items():
-                    if type(value) != int and type(value) != float:
-                        print(f"Invalid value type received for key '{key}':  {type(value)}")
-                        continue
-                    Thread(target=add_ts_cassandra, args=(device_id, key, value)).start()
-                    #Thread(target=add_ts_postgres, args=(device_id, key, value, db)).start()
-                    add_ts_postgres(device_id, key, value, db)
-                    
-            except Exception as e:
-                print(str(e))
-            finally:
-                db.close()
-            
+        for timestamp, values, raw in samples:
+            self.ingest.put(TelemetryMessage(device_id, values, timestamp, raw))
+
+    def load_devices(self):
+        db = IngestSessionLocal()
+        try:
+            self.known_devices = {str(device_id) for device_id, in db.query(models.Device.device_id)
+                                  if self.owns(str(device_id))}
+        finally:
+            db.close()
+
     def subscribe_all(self):
         try:
-            db = SessionLocal()
-            device_ids = [str(device.device_id) for device in db.query(models.Device).all()]
-            for device_id in device_ids:
-                self.client.subscribe(f"devices/{device_id}/telemetry")
-            print(f"Subscribed to {device_ids}")
+            self.load_devices()
+            if self.subscription_mode == "wildcard":
+                self.client.subscribe(self.topic())
+                print(f"Subscribed to {self.topic()} for {len(self.known_devices)} devices")
+            elif self.known_devices:
+                self.client.subscribe([(self.topic(device_id), 0) for device_id in self.known_devices])
+                print(f"Subscribed to {len(self.known_devices)} device topics")
         except Exception as e:
             print(f"Failed to query device IDs and subscribe to topics: {str(e)}")
-        finally:
-            db.close()
-            
-    def on_disconnect(self, client, userdata, rc):
+
+    def register_device(self, device_id):
+        device_id = str(device_id)
+        if not self.owns(device_id):
+            return
+        self.known_devices.add(device_id)
+        if self.subscription_mode == "per_device":
+            self.client.subscribe(self.topic(device_id))
+
+    def unregister_device(self, device_id):
+        device_id = str(device_id)
+        self.known_devices.discard(device_id)
+        if self.subscription_mode == "per_device":
+            self.client.unsubscribe(self.topic(device_id))
+
+    def refresh_registry(self):
+        with self._refresh_lock:
+            previous = self.known_devices
+            self.load_devices()
+            added = self.known_devices - previous
+            removed = previous - self.known_devices
+            # deleted devices must not be resolved from the cache anymore, their rows would
+            # violate the foreign keys of the batch they are written with
+            for device_id in removed:
+                metadata_cache.invalidate_device(device_id)
+            if self.subscription_mode == "per_device":
+                if added:
+                    self.client.subscribe([(self.topic(device_id), 0) for device_id in added])
+                if removed:
+                    self.client.unsubscribe([self.topic(device_id) for device_id in removed])
+
+    def _schedule_refresh(self):
+        # devices registered or deleted through other processes show up after at most one
+        # refresh interval, or right away through the cluster channel
+        def refresh():
+            try:
+                self.refresh_registry()
+            except Exception as e:
+                print(f"Failed to refresh the device registry: {str(e)}")
+            self._schedule_refresh()
+
+        self._refresh_timer = threading.Timer(settings.mqtt_registry_refresh_interval, refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
         if rc != 0:
             print("Unexpected disconnection. Attempting to reconnect...")
             self.client.reconnect()
-        
+
+    def start(self):
+        self.ingest.start()
+        if settings.telemetry_rollups_enabled:
+            rollup_accumulator.start()
+        if settings.telemetry_counters_enabled:
+            telemetry_counter.start()
+        self._schedule_refresh()
+        self.client.loop_start()
+        self.started = True
+
+    def stop(self):
+        self.started = False
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+        self.client.loop_stop()
+        self.ingest.stop()
+        if settings.telemetry_rollups_enabled:
+            rollup_accumulator.stop()
+        if settings.telemetry_counters_enabled:
+            telemetry_counter.stop()
+
+
+class ClusterChannel:
+    """
+    Links the API processes and the standalone ingest workers of a deployment.
+
+    Routes `broadcast` what they invalidated in their own process; every other
+    process applies the same to its access cache, metadata cache, threshold engine,
+    latest value store and device registry. With `relay_realtime` (API processes that do not
+    ingest) the updates and alerts the workers publish on `realtime_relay_topic`
+    feed the websocket hub and the latest value store.
+    """
+
+    def __init__(self, topic: str = settings.control_topic, relay_topic: str = settings.realtime_relay_topic):
+        self.topic = topic
+        self.relay_topic = relay_topic
+        self.relay_realtime = False
+        # own messages are skipped, the route already applied them
+        self.sender = uuid.uuid4().hex
+        self.client = mqtt.Client(protocol=MQTT_PROTOCOLS[settings.mqtt_protocol])
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.started = False
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc == 0:
+            client.subscribe(self.topic)
+            if self.relay_realtime:
+                client.subscribe(self.relay_topic)
+                print(f"Relaying realtime updates from {self.relay_topic}")
+
+    def on_message(self, client, userdata, msg):
+        try:
+            if msg.topic == self.relay_topic:
+                self.relay(msg.payload)
+            else:
+                message = orjson.loads(msg.payload)
+                if message["sender"] != self.sender:
+                    apply_invalidation(message["op"], message.get("id"))
+        except Exception as e:
+            print(f"Failed to handle message on topic {msg.topic}: {str(e)}")
+
+    @staticmethod
+    def relay(payload: bytes):
+        updates, alerts, names = decode_relay_message(payload)
+        realtime_hub.publish(updates)
+        realtime_hub.publish_alerts(alerts)
+        rows = [(device_id, key, value, timestamp)
+                for device_id, _, data, timestamp in updates for key, value in data.items()]
+        devices = {device_id: SimpleNamespace(asset_id=asset_id, name=names[device_id])
+                   for device_id, asset_id, _, _ in updates}
+        latest_store.update(rows, devices)
+
+    def broadcast(self, op: str, entity_id=None):
+        # op: see apply_invalidation
+        if self.started:
+            self.client.publish(self.topic, orjson.dumps({"sender": self.sender, "op": op,
+                                                          "id": str(entity_id) if entity_id is not None else None}),
+                                qos=1)
+
+    def start(self, relay_realtime: bool = False):
+        self.relay_realtime = relay_realtime
+        # connects in the network thread, which also reconnects
+        self.client.connect_async(settings.mqtt_hostname, int(settings.mqtt_port), 10)
+        self.client.loop_start()
+        self.started = True
+
+    def stop(self):
+        if self.started:
+            self.client.disconnect()
+            self.client.loop_stop()
+            self.started = False
+
+
+def apply_invalidation(op: str, entity_id: Optional[str] = None):
+    # what the routes do after changing users, farms, devices, assets and thresholds, for the
+    # caches of this process. Access is dropped for every change that can revoke it, the
+    # authorization checks trust the cached ids
+    if op == "device_created":
+        metadata_cache.invalidate_device(entity_id)
+        access_cache.invalidate_access()
+        mqtt_subscriber.register_device(entity_id)
+    elif op == "device_updated":
+        metadata_cache.invalidate_device(entity_id)
+        latest_store.invalidate_device(entity_id)
+        access_cache.invalidate_access()
+    elif op == "device_deleted":
+        metadata_cache.invalidate_device(entity_id)
+        latest_store.invalidate_device(entity_id)
+        access_cache.invalidate_access()
+        mqtt_subscriber.unregister_device(entity_id)
+    elif op == "asset_updated":
+        metadata_cache.invalidate_asset(UUID(entity_id))
+        access_cache.invalidate_access()
+    elif op == "thresholds_updated":
+        threshold_engine.invalidate()
+    elif op == "access_changed":
+        # farms created, updated or assigned to another customer
+        access_cache.invalidate_access()
+    elif op == "users_changed":
+        access_cache.clear()
+    elif op == "cleared":
+        # farms, assets, profiles or tenants deleted with their devices
+        metadata_cache.clear()
+        latest_store.clear()
+        access_cache.clear()
+        if mqtt_subscriber.started:
+            mqtt_subscriber.refresh_registry()
+    else:
+        raise ValueError(f"Unknown invalidation '{op}'")
+
 
 mqtt_subscriber = MQTTSubscriber()
 mqtt_subscriber.client.on_connect = mqtt_subscriber.on_connect
 mqtt_subscriber.client.on_message = mqtt_subscriber.on_message
-mqtt_subscriber.client.connect(settings.mqtt_hostname, int(settings.mqtt_port), 10)
 mqtt_subscriber.client.on_disconnect = mqtt_subscriber.on_disconnect
+# open alerts of other partitions are not this process's to clear
+threshold_engine.owns = mqtt_subscriber.owns
+
+cluster_channel = ClusterChannel()
+
 
-mqtt_subscriber.client.loop_start()
\ No newline at end of file
+def start_ingest():
+    # connect_async: the network thread connects and reconnects, nothing waits for the broker
+    mqtt_subscriber.client.connect_async(settings.mqtt_hostname, int(settings.mqtt_port), 10)
+    mqtt_subscriber.start()
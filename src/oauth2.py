@@ -4,11 +4,13 @@ from uuid import UUID
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer, SecurityScopes
 from jose import JWTError, jwt
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette import status
 from pydantic import ValidationError
 
 from . import schemas, models, database
+from .access_cache import access_cache
 from .config import settings
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/login")
@@ -26,7 +28,7 @@ def create_access_token(data: dict):
     return encoded_jwt
 
 
-def get_current_user(security_scopes: SecurityScopes, token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+def decode_access_token(security_scopes: SecurityScopes, token: str) -> schemas.TokenData:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -44,14 +46,22 @@ def get_current_user(security_scopes: SecurityScopes, token: str = Depends(oauth
     except (JWTError, ValidationError) as e:
         print(e)
         raise credentials_exception
-    
-    user = db.query(models.User).filter(models.User.username == username).first()
-    
+
     if len(security_scopes.scopes) != 0 and token_data.scope not in security_scopes.scopes:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Not enough permissions",
             headers={"WWW-Authenticate": f"Bearer scope={token_data.scope}"},
         )
-    return user
+    return token_data
+
+
+def get_current_user(security_scopes: SecurityScopes, token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+    token_data = decode_access_token(security_scopes, token)
+    return access_cache.get_user(token_data.username, db)
+
 
+async def get_current_user_async(security_scopes: SecurityScopes, token: str = Depends(oauth2_scheme),
+                                 db: AsyncSession = Depends(database.get_async_db)):
+    token_data = decode_access_token(security_scopes, token)
+    return await access_cache.get_user_async(token_data.username, db)
@@ -0,0 +1,93 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Optional
+from uuid import UUID
+
+from fastapi import HTTPException, Query, Response
+from sqlalchemy import func, select, tuple_
+from starlette import status
+
+from .config import settings
+
+
+def count_statement(statement):
+    return select(func.count()).select_from(statement.order_by(None).subquery())
+
+
+class PageParams:
+    """
+    react-admin style `_start`/`_end` (or `_start`/`_limit`) offset pages, or keyset
+    pages continuing after the `X-Next-Cursor` of the previous page with `_after`.
+
+    The list statement is wrapped so that a single query returns the page together
+    with `count(*) over()` of the whole filtered list for `X-Total-Count`.
+    """
+
+    def __init__(self,
+                 _start: int = Query(0, ge=0, description="Offset of the first row"),
+                 _end: Optional[int] = Query(None, ge=1, description="Offset after the last row"),
+                 _limit: Optional[int] = Query(None, ge=1, le=settings.list_max_limit,
+                                               description="Page size, used when _end is not set"),
+                 _after: Optional[str] = Query(None, description="X-Next-Cursor of the previous page")):
+        self.start = _start
+        if _end is not None:
+            if _end <= _start:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="_end must be after _start")
+            self.limit = min(_end - _start, settings.list_max_limit)
+        else:
+            self.limit = _limit or settings.list_max_limit
+        self.after = _after
+
+    def _decode_cursor(self, sort_column):
+        try:
+            sort_value, key = json.loads(base64.urlsafe_b64decode(self.after.encode()))
+            if sort_value is not None and sort_column.type.python_type is datetime:
+                sort_value = datetime.fromisoformat(sort_value)
+            return sort_value, UUID(key)
+        except (binascii.Error, ValueError, TypeError, AttributeError, NotImplementedError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+    @staticmethod
+    def _encode_cursor(sort_value, key):
+        if isinstance(sort_value, datetime):
+            sort_value = sort_value.isoformat()
+        return base64.urlsafe_b64encode(json.dumps([sort_value, str(key)]).encode()).decode()
+
+    def statement(self, statement, entity, primary_key, sort_column, descending: bool, options=()):
+        # statement: the filtered list, selecting `entity` without ordering or loader options
+        listed = statement.with_only_columns(primary_key.label("key"), sort_column.label("sort_value"),
+                                             func.count().over().label("total")).subquery()
+        paged = (select(entity, listed.c.key, listed.c.sort_value, listed.c.total)
+                 .join(listed, primary_key == listed.c.key)
+                 .options(*options))
+
+        if descending:
+            paged = paged.order_by(listed.c.sort_value.desc(), listed.c.key.desc())
+        else:
+            paged = paged.order_by(listed.c.sort_value, listed.c.key)
+
+        if self.after is not None:
+            if sort_column.class_ is not entity or sort_column.expression.nullable:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail="Cursor pagination needs a sort field without empty values")
+            position = tuple_(listed.c.sort_value, listed.c.key)
+            cursor = tuple_(*self._decode_cursor(sort_column))
+            paged = paged.where(position < cursor if descending else position > cursor)
+        else:
+            paged = paged.offset(self.start)
+        return paged.limit(self.limit)
+
+    def needs_count(self, rows) -> bool:
+        # an empty page past the first one does not carry the window count
+        return not rows and (self.start > 0 or self.after is not None)
+
+    def result(self, rows, response: Response, total: Optional[int] = None):
+        # rows: (entity, key, sort_value, total)
+        if rows:
+            total = rows[0].total
+        response.headers["X-Total-Count"] = str(total or 0)
+        if len(rows) == self.limit:
+            response.headers["X-Next-Cursor"] = self._encode_cursor(rows[-1].sort_value, rows[-1].key)
+        return [row[0] for row in rows]
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+import msgpack
+import orjson
+
+from .config import settings
+
+PAYLOAD_FORMATS = ("json", "msgpack")
+# first bytes of a JSON document, MessagePack maps and arrays start with 0x80-0x9f or 0xdc-0xdf
+JSON_MARKERS = frozenset(b"{[ \t\r\n")
+# 9999-12-31T23:59:59Z, the last second datetime can hold
+MAX_EPOCH_MS = 253402300799000
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def payload_format(payload: bytes, suffix: Optional[str] = None) -> str:
+    # devices/{id}/telemetry/<format> names the format, otherwise it is told by the first byte
+    if suffix is not None:
+        if suffix not in PAYLOAD_FORMATS:
+            raise PayloadError(f"Unknown payload format '{suffix}'")
+        return suffix
+    return "json" if not payload or payload[0] in JSON_MARKERS else "msgpack"
+
+
+def decode(payload: bytes, encoding: str):
+    if encoding == "json":
+        return orjson.loads(payload)
+    # timestamp=3: the MessagePack timestamp extension type decodes to an aware datetime
+    return msgpack.unpackb(payload, timestamp=3)
+
+
+def parse_iso_timestamp(ts: str) -> datetime:
+    # UTC unless it has an offset; fromisoformat only reads a "Z" suffix from Python 3.11 on
+    timestamp = datetime.fromisoformat(ts[:-1] + "+00:00" if ts.endswith("Z") else ts)
+    return timestamp if timestamp.tzinfo is not None else timestamp.replace(tzinfo=timezone.utc)
+
+
+def parse_timestamp(ts) -> datetime:
+    # epoch milliseconds, an ISO 8601 string (UTC unless it has an offset) or a MessagePack timestamp
+    if type(ts) is int or type(ts) is float:
+        # NaN fails both comparisons
+        if not 0 <= ts <= MAX_EPOCH_MS:
+            raise PayloadError(f"Timestamp {ts!r} out of range")
+        try:
+            return datetime.fromtimestamp(ts / 1000, timezone.utc)
+        except (OverflowError, OSError, ValueError) as e:
+            raise PayloadError(f"Invalid timestamp {ts!r}: {str(e)}")
+    if isinstance(ts, str):
+        return parse_iso_timestamp(ts)
+    if isinstance(ts, datetime):
+        return ts
+    raise PayloadError(f"Invalid timestamp {ts!r}")
+
+
+def numeric_values(data: dict) -> dict:
+    for value in data.values():
+        if type(value) is not int and type(value) is not float:
+            break
+    else:
+        return data
+
+    values = {}
+    for key, value in data.items():
+        if type(value) != int and type(value) != float:
+            print(f"Invalid value type received for key '{key}':  {type(value)}")
+            continue
+        values[key] = value
+    return values
+
+
+def parse_payload(payload: bytes, received_at: datetime,
+                  suffix: Optional[str] = None) -> List[Tuple[datetime, dict, Optional[bytes]]]:
+    """
+    -> (timestamp, {key: number}, raw) samples of a telemetry payload, which is either
+      - {key: number, ...}, stamped with `received_at`
+      - {"ts": ..., "values": {key: number, ...}}
+      - [{"ts": ..., "values": {...}}, ...], readings buffered by the device
+    encoded as JSON or MessagePack. `raw` is `payload` itself when it is a flat JSON
+    object kept as is, so it can be republished without encoding it again.
+    Raises ValueError for payloads that do not decode.
+    """
+    encoding = payload_format(payload, suffix)
+    data = decode(payload, encoding)
+    if isinstance(data, dict) and isinstance(data.get("values"), dict):
+        data = [data]
+    if isinstance(data, dict):
+        values = numeric_values(data)
+        raw = payload if encoding == "json" and values is data else None
+        return [(received_at, values, raw)] if values else []
+    if not isinstance(data, list):
+        raise PayloadError("Expected an object or an array of {ts, values} objects")
+
+    # device clocks running ahead of the server get the server time, a reading from
+    # the future would pin the latest value
+    latest = received_at + timedelta(seconds=settings.ingest_max_clock_skew)
+    samples = []
+    for sample in data:
+        if type(sample) is not dict or type(sample.get("values")) is not dict:
+            raise PayloadError("Expected {ts, values} objects")
+        ts = sample.get("ts")
+        timestamp = received_at if ts is None else parse_timestamp(ts)
+        if timestamp > latest:
+            timestamp = received_at
+        values = numeric_values(sample["values"])
+        if values:
+            samples.append((timestamp, values, None))
+    return samples
+
+
+def encode_samples(samples: List[Tuple[datetime, dict]], encoding: str = "json") -> bytes:
+    # the batched payload parse_payload reads, as a device would send it
+    data = [{"ts": int(timestamp.timestamp() * 1000), "values": values} for timestamp, values in samples]
+    if encoding == "json":
+        return orjson.dumps(data)
+    return msgpack.packb(data)
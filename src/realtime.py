@@ -0,0 +1,162 @@
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Set, Tuple
+
+import orjson
+
+from .config import settings
+
+
+def asset_topic(asset_id) -> str:
+    return f"asset:{asset_id}"
+
+
+def device_topic(device_id) -> str:
+    return f"device:{device_id}"
+
+
+class Subscriber:
+    """
+    One live connection. Updates are coalesced per (device_id, key) until the
+    connection's sender takes them, so a burst of readings costs one entry per key;
+    once more than `max_pending` keys or alerts are waiting the client is too slow
+    and gets dropped by the hub. Alerts are never coalesced.
+    """
+
+    def __init__(self, max_pending: int = settings.realtime_max_pending):
+        self.max_pending = max_pending
+        self.topics: Set[str] = set()
+        self.pending: Dict[Tuple[str, str], Tuple[float, datetime]] = {}
+        self.alerts: List[dict] = []
+        self.ready = asyncio.Event()
+        self.dropped = False
+
+    def offer(self, device_id: str, data: dict, timestamp: datetime) -> bool:
+        for key, value in data.items():
+            self.pending[(device_id, key)] = (value, timestamp)
+        if len(self.pending) > self.max_pending:
+            return False
+        self.ready.set()
+        return True
+
+    def offer_alert(self, alert: dict) -> bool:
+        self.alerts.append(alert)
+        if len(self.alerts) > self.max_pending:
+            return False
+        self.ready.set()
+        return True
+
+    def take_alerts(self):
+        alerts, self.alerts = self.alerts, []
+        return alerts
+
+    def take(self):
+        pending, self.pending = self.pending, {}
+        self.ready.clear()
+        return [{"device_id": device_id, "key": key, "value": value, "timestamp": timestamp.isoformat()}
+                for (device_id, key), (value, timestamp) in pending.items()]
+
+
+def relay_message(updates: List[tuple], alerts: List[dict], names: Dict[str, str]) -> bytes:
+    # what RealtimeHub.publish and publish_alerts take, and the device names the
+    # latest value store needs, for an API process that does not ingest itself
+    return orjson.dumps({"updates": updates, "alerts": alerts, "names": names})
+
+
+def decode_relay_message(payload: bytes) -> Tuple[List[tuple], List[dict], Dict[str, str]]:
+    message = orjson.loads(payload)
+    updates = [(device_id, asset_id, data, datetime.fromisoformat(timestamp))
+               for device_id, asset_id, data, timestamp in message["updates"]]
+    alerts = [dict(alert, timestamp=datetime.fromisoformat(alert["timestamp"])) for alert in message["alerts"]]
+    return updates, alerts, message["names"]
+
+
+class RealtimeHub:
+    """
+    In-process fan-out of ingested telemetry to live connections.
+
+    `publish` may be called from any thread (the ingest workers): it hands the
+    batch to the event loop the hub is bound to, and all subscription state is only
+    touched on that loop, so no locking is needed. Publishing costs nothing while
+    nobody is subscribed.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._topics: Dict[str, Set[Subscriber]] = defaultdict(set)
+        self._subscribers: Set[Subscriber] = set()
+        self._stats = defaultdict(int)
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def publish(self, updates: Iterable):
+        # updates: (device_id, asset_id, data, timestamp)
+        if self.loop is None or not self._topics:
+            return
+        self.loop.call_soon_threadsafe(self._dispatch, list(updates))
+
+    def _dispatch(self, updates):
+        for device_id, asset_id, data, timestamp in updates:
+            subscribers = (self._topics.get(device_topic(device_id), set())
+                           | self._topics.get(asset_topic(asset_id), set()))
+            for subscriber in subscribers:
+                if not subscriber.offer(str(device_id), data, timestamp):
+                    self.drop(subscriber)
+            self._stats["published"] += 1
+
+    def publish_alerts(self, events: Iterable[dict]):
+        # events: see alerts.ThresholdEngine
+        if self.loop is None or not self._topics or not events:
+            return
+        alerts = [{"alert_id": str(event["alert_id"]), "device_id": event["device_id"],
+                   "asset_id": str(event["asset_id"]), "key": event["key"], "kind": event["kind"],
+                   "status": event["status"], "value": event["value"], "threshold_min": event["threshold_min"],
+                   "threshold_max": event["threshold_max"], "timestamp": event["timestamp"].isoformat()}
+                  for event in events]
+        self.loop.call_soon_threadsafe(self._dispatch_alerts, alerts)
+
+    def _dispatch_alerts(self, alerts):
+        for alert in alerts:
+            subscribers = (self._topics.get(device_topic(alert["device_id"]), set())
+                           | self._topics.get(asset_topic(alert["asset_id"]), set()))
+            for subscriber in subscribers:
+                if not subscriber.offer_alert(alert):
+                    self.drop(subscriber)
+            self._stats["alerts"] += 1
+
+    def connect(self) -> Subscriber:
+        subscriber = Subscriber()
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def disconnect(self, subscriber: Subscriber):
+        for topic in list(subscriber.topics):
+            self.unsubscribe(subscriber, topic)
+        self._subscribers.discard(subscriber)
+
+    def subscribe(self, subscriber: Subscriber, topic: str):
+        subscriber.topics.add(topic)
+        self._topics[topic].add(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber, topic: str):
+        subscriber.topics.discard(topic)
+        subscribers = self._topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._topics[topic]
+
+    def drop(self, subscriber: Subscriber):
+        # the connection's sender closes the socket when it wakes up
+        self.disconnect(subscriber)
+        subscriber.dropped = True
+        subscriber.ready.set()
+        self._stats["dropped"] += 1
+
+    def stats(self):
+        return dict(self._stats, topics=len(self._topics), connections=len(self._subscribers))
+
+
+realtime_hub = RealtimeHub()
@@ -4,14 +4,24 @@ import json
 import datetime
 
 from fastapi import Depends, APIRouter, HTTPException, Security, Response, Body, Query
-from sqlalchemy import func, select, text
-from sqlalchemy.orm import Session, aliased
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased, joinedload
 from sqlalchemy.exc import IntegrityError
 from starlette import status
 from sqlalchemy import desc
 
 from .. import schemas, models, oauth2
-from ..database import get_db
+from ..access_cache import access_cache
+from ..alerts import threshold_engine
+from ..config import settings
+from ..database import get_db, get_async_db
+from ..latest_store import asset_latest_statement, latest_store
+from ..metadata_cache import metadata_cache
+from ..mqtt import cluster_channel
+from ..pagination import PageParams, count_statement
+from ..responses import list_response
+from .device import DEVICE_RESPONSE_OPTIONS
 router = APIRouter(
     prefix="/api/assets",
     tags=["Assets"]
@@ -34,16 +44,19 @@ def create_asset(asset: schemas.AssetCreate,
     db.add(new_asset)
     db.commit()
     db.refresh(new_asset)
+    access_cache.invalidate_access()
+    cluster_channel.broadcast("access_changed")
     return new_asset
 
-@router.get("/", response_model=List[schemas.AssetResponse])
-def get_list_asset(
-    db: Session = Depends(get_db),
-    current_user: models.User = Security(oauth2.get_current_user, scopes=["tenant", "customer"]),
-    response: Response = None,
-    _order: str = Query("asc", description="Sorting order: asc or desc", regex="^(asc|desc)$"),
-    _sort: str = Query(None, description="Order by a specific field", regex="^[a-zA-Z_]+$")
-):
+# relationships serialized by AssetResponse, all many-to-one so they are joined into the same query
+ASSET_RESPONSE_OPTIONS = (
+    joinedload(models.Asset.farm, innerjoin=True).joinedload(models.Farm.owner, innerjoin=True),
+    joinedload(models.Asset.farm, innerjoin=True).joinedload(models.Farm.customer),
+)
+
+
+def list_assets_statement(current_user: models.User, _sort: str, q: Optional[str] = None):
+    # -> (filtered statement, sort column), ordering and paging are applied by PageParams
     order_mapping = {
         "name": models.Asset.name,
         "type": models.Asset.type,
@@ -56,37 +69,25 @@ def get_list_asset(
     default_order_column = models.Asset.created_at  # Change this to your default field
     order_column = order_mapping.get(_sort, default_order_column)
 
-    # Apply sorting order and join conditions
     if current_user.role == "tenant":
-        assets_query = db.query(models.Asset).filter(models.Asset.owner_id == current_user.user_id)
+        assets_query = select(models.Asset).where(models.Asset.owner_id == current_user.user_id)
+        if _sort == "":
+            assets_query = assets_query.join(models.Farm, models.Asset.farm_id == models.Farm.farm_id, isouter=True)
     elif current_user.role == "customer":
         assets_query = (
-            db.query(models.Asset)
+            select(models.Asset)
             .join(models.Farm, models.Asset.farm_id == models.Farm.farm_id, isouter=True)
-            .filter(models.Farm.assigned_customer == current_user.user_id)
+            .where(models.Farm.assigned_customer == current_user.user_id)
         )
-        
-    if _sort == "":
-        assets_query = assets_query.join(models.Farm, models.Asset.farm_id == models.Farm.farm_id, isouter=True)
 
-    if _order == "asc":
-        assets_query = assets_query.order_by(order_column)
-    else:
-        assets_query = assets_query.order_by(order_column.desc())
+    if q:
+        # served by the trigram index on assets.name
+        assets_query = assets_query.where(models.Asset.name.ilike(f"%{q}%"))
 
-    assets = assets_query.all()
-    total = assets_query.count()
-    
-    response.headers["X-Total-Count"] = str(total)
-
-    return assets
+    return assets_query, order_column
 
 
-@router.get("/{asset_id}", response_model=schemas.AssetResponse)
-def get_asset_by_id(asset_id: UUID, db: Session = Depends(get_db),
-                   current_user: models.User = Security(oauth2.get_current_user,
-                                                        scopes=["tenant", "customer"])):
-    asset = db.query(models.Asset).filter(models.Asset.asset_id == asset_id).first()
+def check_asset_access(asset: models.Asset, current_user: models.User):
     if not asset:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Asset not found") 
@@ -104,11 +105,43 @@ def get_asset_by_id(asset_id: UUID, db: Session = Depends(get_db),
     
     return asset
 
+
+@router.get("/", response_model=List[schemas.AssetResponse])
+def get_list_asset(
+    db: Session = Depends(get_db),
+    current_user: models.User = Security(oauth2.get_current_user, scopes=["tenant", "customer"]),
+    response: Response = None,
+    _order: str = Query("asc", description="Sorting order: asc or desc", pattern="^(asc|desc)$"),
+    _sort: str = Query(None, description="Order by a specific field", pattern="^[a-zA-Z_]+$"),
+    q: Optional[str] = Query(None, description="Search in asset name"),
+    page: PageParams = Depends()
+):
+    statement, order_column = list_assets_statement(current_user, _sort, q)
+    rows = db.execute(page.statement(statement, models.Asset, models.Asset.asset_id, order_column,
+                                     _order == "desc", ASSET_RESPONSE_OPTIONS)).all()
+    total = db.scalar(count_statement(statement)) if page.needs_count(rows) else None
+    return list_response(schemas.AssetResponse, page.result(rows, response, total), response)
+
+
+@router.get("/{asset_id}", response_model=schemas.AssetResponse)
+def get_asset_by_id(asset_id: UUID, db: Session = Depends(get_db),
+                   current_user: models.User = Security(oauth2.get_current_user,
+                                                        scopes=["tenant", "customer"])):
+    asset = db.query(models.Asset).options(*ASSET_RESPONSE_OPTIONS).filter(models.Asset.asset_id == asset_id).first()
+    return check_asset_access(asset, current_user)
+
+def authorize_asset(asset_id: UUID, db: Session, current_user: models.User):
+    # for routes that only check access, get_asset_by_id decides for ids missing from the cache
+    if asset_id not in access_cache.access(current_user, db).assets:
+        get_asset_by_id(asset_id, db, current_user)
+        access_cache.invalidate_access(current_user.user_id)
+
+
 @router.patch("/{asset_id}")
 def update_asset(asset_id: UUID, new_asset: schemas.AssetCreate, db: Session = Depends(get_db),
                 current_user: models.User = Security(oauth2.get_current_user,
                                                     scopes=["tenant"])):
-    get_asset_by_id(asset_id, db, current_user)
+    authorize_asset(asset_id, db, current_user)
     asset = db.query(models.Asset).filter(models.Asset.asset_id == asset_id)
     
     
@@ -121,6 +154,9 @@ def update_asset(asset_id: UUID, new_asset: schemas.AssetCreate, db: Session = D
     asset.update(update_data, synchronize_session=False)
 
     db.commit()
+    metadata_cache.invalidate_asset(asset_id)
+    access_cache.invalidate_access()
+    cluster_channel.broadcast("asset_updated", asset_id)
     return Response(status_code=200, content="Successfully updated asset")
    
 @router.delete("/{asset_id}", status_code=status.HTTP_200_OK)
@@ -134,6 +170,11 @@ def delete_asset(asset_id: UUID, db: Session = Depends(get_db),
     
     asset.delete(synchronize_session=False)
     db.commit()
+    metadata_cache.invalidate_asset(asset_id)
+    # devices of the asset are deleted by cascade
+    latest_store.clear()
+    access_cache.invalidate_access()
+    cluster_channel.broadcast("cleared")
     
     return Response(status_code=200, content="Successfully deleted an asset")
 
@@ -142,10 +183,11 @@ def delete_asset(asset_id: UUID, db: Session = Depends(get_db),
 def get_list_asset_devices(asset_id: UUID, db: Session = Depends(get_db),
                            current_user: models.User = Security(oauth2.get_current_user,
                                                                scopes=["tenant", "customer"])):
-    get_asset_by_id(asset_id, db, current_user)
-    devices = db.query(models.Device).filter(models.Device.asset_id == asset_id).all()
+    authorize_asset(asset_id, db, current_user)
+    devices = (db.query(models.Device).options(*DEVICE_RESPONSE_OPTIONS)
+               .filter(models.Device.asset_id == asset_id).all())
     
-    return devices
+    return list_response(schemas.DeviceResponse, devices)
 
 
 @router.get("/{asset_id}/keys", response_model=List[schemas.TSKeyBase])
@@ -169,6 +211,8 @@ def delete_asset_key(asset_id: UUID, key: str, db: Session = Depends(get_db),
     if existing_key in asset.asset_keys:
         asset.asset_keys.remove(existing_key)
         db.commit()
+        metadata_cache.invalidate_asset(asset_id)
+        cluster_channel.broadcast("asset_updated", asset_id)
         return Response(status_code=200, content=f"Successfully deleted key: {key}")
     
     return Response(status_code=404, content=f"Key: {key} not found on asset")
@@ -177,7 +221,7 @@ def delete_asset_key(asset_id: UUID, key: str, db: Session = Depends(get_db),
 def get_thresholds_of_asset(asset_id: UUID, db: Session = Depends(get_db),
                            current_user: models.User = Security(oauth2.get_current_user,
                                                                   scopes=["tenant", "customer"])):
-    get_asset_by_id(asset_id, db, current_user)
+    authorize_asset(asset_id, db, current_user)
     thresholds = db.query(models.Threshold).filter(models.Threshold.asset_id==asset_id).all()
 
     return thresholds
@@ -187,7 +231,7 @@ def get_threshold_of_asset_by_key(asset_id: UUID, key: str,
                                  db: Session = Depends(get_db),
                                  current_user: models.User = Security(oauth2.get_current_user,
                                                                      scopes=["tenant", "customer"])):
-    get_asset_by_id(asset_id, db, current_user)
+    authorize_asset(asset_id, db, current_user)
     threshold = db.query(models.Threshold).filter(models.Threshold.asset_id==asset_id,
                                                  models.Threshold.key==key).first()
     
@@ -229,6 +273,8 @@ def set_asset_threshold_on_key(asset_id: UUID, key: str,
         db.add(new_threshold)
     
     db.commit()
+    threshold_engine.invalidate()
+    cluster_channel.broadcast("thresholds_updated")
 
     return existing_threshold if existing_threshold else new_threshold
 
@@ -277,6 +323,8 @@ def update_asset_threshold_on_key(asset_id: UUID, key: str,
     
     db.commit()
     db.refresh(existing_threshold)
+    threshold_engine.invalidate()
+    cluster_channel.broadcast("thresholds_updated")
 
     return existing_threshold
 
@@ -287,7 +335,7 @@ def delete_asset_threshold_with_key(asset_id: UUID, key: str,
                                    current_user: models.User = Security(oauth2.get_current_user,
                                                                  scopes=["tenant", "customer"])):
     
-    get_asset_by_id(asset_id, db, current_user)
+    authorize_asset(asset_id, db, current_user)
     existing_threshold = db.query(models.Threshold).filter(models.Threshold.asset_id==asset_id,
                                                            models.Threshold.key==key)
     if not existing_threshold.first():
@@ -297,44 +345,34 @@ def delete_asset_threshold_with_key(asset_id: UUID, key: str,
     existing_threshold.delete(synchronize_session=False)
     
     db.commit()
+    threshold_engine.invalidate()
+    cluster_channel.broadcast("thresholds_updated")
 
     return Response(status_code=200, content=f"Successfully deleted {key} threshold")
 
+@router.get("/{asset_id}/alerts", response_model=List[schemas.AlertResponse])
+def get_asset_alerts(asset_id: UUID,
+                     active: bool = Query(False, description="Only alerts that are not cleared"),
+                     limit: int = Query(100, ge=1, le=settings.list_max_limit),
+                     db: Session = Depends(get_db),
+                     current_user: models.User = Security(oauth2.get_current_user,
+                                                          scopes=["tenant", "customer"])):
+    authorize_asset(asset_id, db, current_user)
+    query = db.query(models.Alert).filter(models.Alert.asset_id == asset_id)
+    if active:
+        query = query.filter(models.Alert.cleared_at.is_(None))
+    return query.order_by(desc(models.Alert.raised_at)).limit(limit).all()
+
+
 @router.get("/{asset_id}/telemetry/latest", response_model=List[schemas.AssetTelemetry])
 def get_latest_asset_telemetry(asset_id: UUID, db: Session = Depends(get_db), 
                               current_user: models.User = Security(oauth2.get_current_user, 
                                                                    scopes=["tenant", "customer"])):
-    asset: models.Asset = get_asset_by_id(asset_id, db, current_user)
-    
-    cte = (
-        db.query(
-            models.TimeSeries.key,
-            models.TimeSeries.value,
-            models.Device.asset_id,
-            models.Device.device_id,
-            models.Device.name.label('device_name'),
-            models.TimeSeries.timestamp,
-            func.row_number().over(partition_by=models.TimeSeries.key, order_by=models.TimeSeries.timestamp.desc()).label('row_num')
-        )
-        .filter(models.Device.asset_id == asset_id)
-        .outerjoin(models.Device, models.TimeSeries.device_id == models.Device.device_id)
-        .cte()
-    )
-
-    query = (
-        db.query(
-            cte.c.key,
-            cte.c.value,
-            cte.c.device_id,
-            cte.c.timestamp,
-            cte.c.device_name
-        )
-        .filter(cte.c.row_num == 1)
-    )
-
-    result = query.all()
-    print(result)
-    return result
+    authorize_asset(asset_id, db, current_user)
+    latest = latest_store.get_asset(asset_id)
+    if latest is None:
+        latest = latest_store.put_asset(asset_id, db.execute(asset_latest_statement(asset_id)).all())
+    return list_response(schemas.AssetTelemetry, latest)
 
 
 @router.post("/{asset_id}/cameras", status_code=status.HTTP_201_CREATED, response_model=schemas.CameraSourceResponse)
@@ -343,7 +381,7 @@ def create_asset_camera_source(asset_id: UUID,
                                db: Session = Depends(get_db),
                                current_user: models.User = Security(oauth2.get_current_user,
                                                      scopes=["tenant"])):
-    get_asset_by_id(asset_id ,db, current_user)
+    authorize_asset(asset_id, db, current_user)
     camera_with_name = db.query(models.CameraSource).filter(models.CameraSource.camera_source_name == camera.camera_source_name, models.CameraSource.asset_id == asset_id).all()
     if camera_with_name:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
@@ -360,7 +398,7 @@ def get_list_asset_cameras(asset_id: UUID,
                            db: Session = Depends(get_db),
                            current_user: models.User = Security(oauth2.get_current_user,
                                                                  scopes=["tenant", "customer"])):
-    get_asset_by_id(asset_id, db, current_user)
+    authorize_asset(asset_id, db, current_user)
     cameras = db.query(models.CameraSource).filter(models.CameraSource.asset_id == asset_id).all()
     return cameras
 
@@ -370,11 +408,61 @@ def delete_asset_camera_source(asset_id: UUID, camera_source_id: UUID,
                                db: Session = Depends(get_db),
                                current_user: models.User = Security(oauth2.get_current_user,
                                                                  scopes=["tenant"])):
-    get_asset_by_id(asset_id, db, current_user)
+    authorize_asset(asset_id, db, current_user)
     camera = db.query(models.CameraSource).filter(models.CameraSource.camera_source_id == camera_source_id)
     if not camera.first():
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Camera not found")
     camera.delete(synchronize_session=False)
     db.commit()
-    return Response(status_code=200, content="Successfully deleted camera")
\ No newline at end of file
+    return Response(status_code=200, content="Successfully deleted camera")
+
+
+# Async variants of the hot read routes, registered ahead of the sync ones when
+# settings.database_async_enabled is set
+async_router = APIRouter(
+    prefix="/api/assets",
+    tags=["Assets"]
+)
+
+
+@async_router.get("/", response_model=List[schemas.AssetResponse], include_in_schema=False)
+async def get_list_asset_async(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Security(oauth2.get_current_user_async, scopes=["tenant", "customer"]),
+    response: Response = None,
+    _order: str = Query("asc", description="Sorting order: asc or desc", pattern="^(asc|desc)$"),
+    _sort: str = Query(None, description="Order by a specific field", pattern="^[a-zA-Z_]+$"),
+    q: Optional[str] = Query(None, description="Search in asset name"),
+    page: PageParams = Depends()
+):
+    statement, order_column = list_assets_statement(current_user, _sort, q)
+    rows = (await db.execute(page.statement(statement, models.Asset, models.Asset.asset_id, order_column,
+                                            _order == "desc", ASSET_RESPONSE_OPTIONS))).all()
+    total = await db.scalar(count_statement(statement)) if page.needs_count(rows) else None
+    return list_response(schemas.AssetResponse, page.result(rows, response, total), response)
+
+
+async def get_asset_by_id_async(asset_id: UUID, db: AsyncSession, current_user: models.User):
+    asset = await db.scalar(select(models.Asset)
+                            .where(models.Asset.asset_id == asset_id)
+                            .options(*ASSET_RESPONSE_OPTIONS))
+    return check_asset_access(asset, current_user)
+
+
+async def authorize_asset_async(asset_id: UUID, db: AsyncSession, current_user: models.User):
+    if asset_id not in (await access_cache.access_async(current_user, db)).assets:
+        await get_asset_by_id_async(asset_id, db, current_user)
+        access_cache.invalidate_access(current_user.user_id)
+
+
+@async_router.get("/{asset_id}/telemetry/latest", response_model=List[schemas.AssetTelemetry],
+                  include_in_schema=False)
+async def get_latest_asset_telemetry_async(asset_id: UUID, db: AsyncSession = Depends(get_async_db),
+                                           current_user: models.User = Security(oauth2.get_current_user_async,
+                                                                                scopes=["tenant", "customer"])):
+    await authorize_asset_async(asset_id, db, current_user)
+    latest = latest_store.get_asset(asset_id)
+    if latest is None:
+        latest = latest_store.put_asset(asset_id, (await db.execute(asset_latest_statement(asset_id))).all())
+    return list_response(schemas.AssetTelemetry, latest)
\ No newline at end of file
@@ -1,4 +1,5 @@
 from fastapi import Depends, APIRouter, HTTPException, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import Response
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
@@ -10,16 +11,29 @@ from ..database import get_db
 router = APIRouter(tags=["Authentication"])
 
 
+def find_user(username: str, db: Session):
+    return db.query(models.User).filter(models.User.username == username).first()
+
+
+def store_password_hash(user: models.User, password_hash: str, db: Session):
+    user.password = password_hash
+    db.commit()
+
+
+# async so that waiting for bcrypt does not hold a request thread, the queries run in the thread pool
 @router.post("/api/login", response_model=schemas.Token)
-def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.username == user_credentials.username).first()
+async def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    user = await run_in_threadpool(find_user, user_credentials.username, db)
     if not user:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid credentials")
 
-    if not utils.verify_password(user_credentials.password, user.password):
+    valid, new_hash = await utils.verify_and_update_password_async(user_credentials.password, user.password)
+    if not valid:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid credentials")
+    if new_hash is not None:
+        # hashed with other bcrypt rounds than configured
+        await run_in_threadpool(store_password_hash, user, new_hash, db)
 
     access_token = oauth2.create_access_token(data={"scope": user.role, "username": user.username, "user_id": str(user.user_id)})
 
     return {"access_token": access_token, "token_type": "bearer", "scope": user.role}
-
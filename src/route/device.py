@@ -1,15 +1,25 @@
 import json
-from typing import List
+from datetime import datetime
+from typing import List, Optional, Union
 from uuid import UUID
-from sqlalchemy.orm import aliased
-from sqlalchemy import func
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from fastapi import Depends, APIRouter, HTTPException, Security, Response, Query
 from sqlalchemy.orm import Session
 from starlette import status
 
 from .. import schemas, models, oauth2, mqtt
-from ..database import get_db
+from ..config import settings
+from ..access_cache import access_cache
+from ..database import get_db, get_async_db
+from ..latest_store import device_latest_statement, latest_store
+from ..metadata_cache import metadata_cache
+from ..pagination import PageParams, count_statement
+from ..responses import list_response
+from ..ts_aggregate import aggregate_reader
+from ..ts_history import history_reader, parse_keys, reported_keys, resolve_time_range
 
 router = APIRouter( 
     prefix="/api",
@@ -42,18 +52,25 @@ def create_device(device: schemas.DeviceCreate, db: Session = Depends(get_db),
     db.add(new_device)
     db.commit()
     db.refresh(new_device)
-    mqtt.mqtt_subscriber.subscribe_all()
+    metadata_cache.invalidate_device(new_device.device_id)
+    access_cache.invalidate_access()
+    mqtt.mqtt_subscriber.register_device(new_device.device_id)
+    mqtt.cluster_channel.broadcast("device_created", new_device.device_id)
     return new_device
 
 
-@router.get('/devices', response_model=List[schemas.DeviceResponse])
-def get_list_devices(
-    db: Session = Depends(get_db),
-    current_user: models.User = Security(oauth2.get_current_user, scopes=["tenant", "customer"]),
-    response: Response = None,
-    _order: str = Query("asc", description="Sorting order: asc or desc", regex="^(asc|desc)$"),
-    _sort: str = Query(None, description="Order by a specific field", regex="^[a-zA-Z_]+$")
-):
+# relationships serialized by DeviceResponse, all many-to-one so they are joined into the same query
+DEVICE_RESPONSE_OPTIONS = (
+    joinedload(models.Device.asset, innerjoin=True).joinedload(models.Asset.farm, innerjoin=True)
+    .joinedload(models.Farm.owner, innerjoin=True),
+    joinedload(models.Device.asset, innerjoin=True).joinedload(models.Asset.farm, innerjoin=True)
+    .joinedload(models.Farm.customer),
+    joinedload(models.Device.device_profile, innerjoin=True),
+)
+
+
+def list_devices_statement(current_user: models.User, _sort: str, q: Optional[str] = None):
+    # -> (filtered statement, sort column), ordering and paging are applied by PageParams
     order_mapping = {
         "name": models.Device.name,
         "label": models.Device.label,
@@ -66,56 +83,81 @@ def get_list_devices(
     order_column = order_mapping.get(_sort, default_order_column)
 
     devices_query = (
-        db.query(models.Device)
+        select(models.Device)
         .join(models.Asset, models.Device.asset_id == models.Asset.asset_id, isouter=True)
         .join(models.DeviceProfile, models.Device.device_profile_id == models.DeviceProfile.profile_id, isouter=True)
     )
 
     if current_user.role == "tenant":
-        devices_query = devices_query.filter(models.Asset.owner_id == current_user.user_id)
+        devices_query = devices_query.where(models.Asset.owner_id == current_user.user_id)
     else:
         devices_query = devices_query.join(models.Farm, models.Asset.farm_id == models.Farm.farm_id, isouter=True)
-        devices_query = devices_query.filter(models.Farm.assigned_customer == current_user.user_id)
+        devices_query = devices_query.where(models.Farm.assigned_customer == current_user.user_id)
 
-    if _order == "asc":
-        devices_query = devices_query.order_by(order_column)
-    else:
-        devices_query = devices_query.order_by(order_column.desc())
+    if q:
+        # served by the trigram indexes on devices.name / devices.label
+        devices_query = devices_query.where(or_(models.Device.name.ilike(f"%{q}%"),
+                                                models.Device.label.ilike(f"%{q}%")))
 
-    devices = devices_query.all()
-    total = devices_query.count()
-    
-    response.headers["X-Total-Count"] = str(total)
+    return devices_query, order_column
 
-    return devices
 
+def device_access_statement(device_id: UUID):
+    return (select(models.Device, models.Farm.owner_id, models.Farm.assigned_customer)
+            .join(models.Asset, models.Device.asset_id == models.Asset.asset_id, isouter=True)
+            .join(models.Farm, models.Asset.farm_id == models.Farm.farm_id, isouter=True)
+            .where(models.Device.device_id == device_id)
+            .options(*DEVICE_RESPONSE_OPTIONS))
 
-@router.get("/devices/{device_id}", response_model=schemas.DeviceResponse)
-def get_device_by_id(device_id: UUID, db: Session = Depends(get_db),
-                     current_user: models.User = Security(oauth2.get_current_user,
-                                                          scopes=["tenant", "customer"])):
-    try:
-        device, tenant_id, customer_id = (db.query(models.Device, models.Farm.owner_id, models.Farm.assigned_customer)
-                                            .join(models.Asset, models.Device.asset_id == models.Asset.asset_id, isouter=True)
-                                            .join(models.Farm, models.Asset.farm_id == models.Farm.farm_id, isouter=True)
-                                            .filter(models.Device.device_id == device_id).first())
-    except TypeError:
+
+def check_device_access(row, current_user: models.User):
+    if row is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device not found")
-    
-    print(device, tenant_id, customer_id)
-    
+
+    device, tenant_id, customer_id = row
     if tenant_id == current_user.user_id or customer_id == current_user.user_id:
         return device
     else:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="Device not found")
 
+
+@router.get('/devices', response_model=List[schemas.DeviceResponse])
+def get_list_devices(
+    db: Session = Depends(get_db),
+    current_user: models.User = Security(oauth2.get_current_user, scopes=["tenant", "customer"]),
+    response: Response = None,
+    _order: str = Query("asc", description="Sorting order: asc or desc", pattern="^(asc|desc)$"),
+    _sort: str = Query(None, description="Order by a specific field", pattern="^[a-zA-Z_]+$"),
+    q: Optional[str] = Query(None, description="Search in device name and label"),
+    page: PageParams = Depends()
+):
+    statement, order_column = list_devices_statement(current_user, _sort, q)
+    rows = db.execute(page.statement(statement, models.Device, models.Device.device_id, order_column,
+                                     _order == "desc", DEVICE_RESPONSE_OPTIONS)).all()
+    total = db.scalar(count_statement(statement)) if page.needs_count(rows) else None
+    return list_response(schemas.DeviceResponse, page.result(rows, response, total), response)
+
+
+@router.get("/devices/{device_id}", response_model=schemas.DeviceResponse)
+def get_device_by_id(device_id: UUID, db: Session = Depends(get_db),
+                     current_user: models.User = Security(oauth2.get_current_user,
+                                                          scopes=["tenant", "customer"])):
+    return check_device_access(db.execute(device_access_statement(device_id)).first(), current_user)
+
+def authorize_device(device_id: UUID, db: Session, current_user: models.User):
+    # for routes that only check access, get_device_by_id decides for ids missing from the cache
+    if device_id not in access_cache.access(current_user, db).devices:
+        get_device_by_id(device_id, db, current_user)
+        access_cache.invalidate_access(current_user.user_id)
+
+
 #patch device
 @router.patch("/devices/{device_id}", status_code=status.HTTP_200_OK)
 def update_device(device_id: UUID, new_device: schemas.DeviceCreate, db: Session = Depends(get_db),
                   current_user: models.User = Security(oauth2.get_current_user,
                                                        scopes=["tenant"])):
-    get_device_by_id(device_id, db, current_user)
+    authorize_device(device_id, db, current_user)
     device = db.query(models.Device).filter(models.Device.device_id == device_id)
     
     update_data = {
@@ -128,6 +170,10 @@ def update_device(device_id: UUID, new_device: schemas.DeviceCreate, db: Session
     device.update(update_data, synchronize_session=False)
 
     db.commit()
+    metadata_cache.invalidate_device(device_id)
+    access_cache.invalidate_access()
+    latest_store.invalidate_device(device_id)
+    mqtt.cluster_channel.broadcast("device_updated", device_id)
     return Response(status_code=200, content="Successfully updated device")
 
 
@@ -137,14 +183,18 @@ def update_device(device_id: UUID, new_device: schemas.DeviceCreate, db: Session
 def delete_device(device_id: UUID, db: Session = Depends(get_db),
                   current_user: models.User = Security(oauth2.get_current_user, 
                                                       scopes = ["tenant"])):
-    device = db.query(models.Device).filter(models.Device.device_id == device_id)
-    if device.first() is None or device.first().asset.farm.owner_id != current_user.user_id:
+    existing = db.execute(device_access_statement(device_id)).first()
+    if existing is None or existing.owner_id != current_user.user_id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Device not found")
     
-    device.delete(synchronize_session=False)
+    db.query(models.Device).filter(models.Device.device_id == device_id).delete(synchronize_session=False)
     db.commit()
-    mqtt.mqtt_subscriber.subscribe_all()
+    metadata_cache.invalidate_device(device_id)
+    access_cache.invalidate_access()
+    latest_store.invalidate_device(device_id)
+    mqtt.mqtt_subscriber.unregister_device(device_id)
+    mqtt.cluster_channel.broadcast("device_deleted", device_id)
 
     return Response(status_code=200, content="Successfully deleted device")
 
@@ -172,8 +222,8 @@ def create_device_profile(profile: schemas.DeviceProfileCreate, db: Session = De
 def get_list_device_profile(
     db: Session = Depends(get_db),
     current_user: models.User = Security(oauth2.get_current_user, scopes=["tenant"]),
-    _order: str = Query("asc", description="Sorting order: asc or desc", regex="^(asc|desc)$"),
-    _sort: str = Query(None, description="Order by a specific field", regex="^[a-zA-Z_]+$")
+    _order: str = Query("asc", description="Sorting order: asc or desc", pattern="^(asc|desc)$"),
+    _sort: str = Query(None, description="Order by a specific field", pattern="^[a-zA-Z_]+$")
 ):
     order_mapping = {
         "name": models.DeviceProfile.name,  
@@ -204,6 +254,10 @@ def delete_device_profile(profile_id: UUID, db: Session = Depends(get_db),
     
     profile.delete(synchronize_session=False)
     db.commit()
+    # devices of this profile are deleted by cascade
+    metadata_cache.clear()
+    latest_store.clear()
+    mqtt.cluster_channel.broadcast("cleared")
     
     return Response(status_code=200, content="Successfully deleted device profile")
 
@@ -212,32 +266,85 @@ def delete_device_profile(profile_id: UUID, db: Session = Depends(get_db),
 def get_latest_device_telemetry(device_id: UUID, db: Session = Depends(get_db), 
                                 current_user: models.User = Security(oauth2.get_current_user, 
                                                                    scopes=["tenant", "customer"])):
-    device: models.Device = get_device_by_id(device_id, db, current_user)
-    
+    authorize_device(device_id, db, current_user)
+    latest = latest_store.get_device(device_id)
+    if latest is None:
+        latest = latest_store.put_device(device_id, db.execute(device_latest_statement(device_id)).all())
+    return list_response(schemas.TelemetryBase, latest)
+
+
+@router.get("/devices/{device_id}/telemetry",
+            response_model=Union[schemas.TelemetryHistory, schemas.TelemetrySeries])
+def get_device_telemetry_history(device_id: UUID,
+                                 keys: Optional[str] = Query(None, description="Comma separated telemetry keys"),
+                                 start: Optional[datetime] = Query(None, description="Defaults to one day before end"),
+                                 end: Optional[datetime] = Query(None, description="Defaults to now"),
+                                 limit: int = Query(1000, ge=1, le=settings.telemetry_history_max_limit),
+                                 page: Optional[str] = Query(None, description="next_page token of the previous response"),
+                                 interval: Optional[str] = Query(None, description="Bucket width, e.g. 30s, 5m, 1h, 1d"),
+                                 agg: str = Query("avg", pattern="^(min|max|avg|sum|count|last)$"),
+                                 points: Optional[int] = Query(None, ge=3, le=settings.telemetry_max_buckets,
+                                                               description="Downsample to at most this many "
+                                                                           "points per key (LTTB)"),
+                                 db: Session = Depends(get_db),
+                                 current_user: models.User = Security(oauth2.get_current_user,
+                                                                      scopes=["tenant", "customer"])):
+    authorize_device(device_id, db, current_user)
+    if page is not None and interval is None and points is None:
+        # start, end and keys of the first page are carried by the token
+        return history_reader.read_next(device_id, page, limit)
+    start, end = resolve_time_range(start, end)
+    # telemetry is partitioned by key, default to every key the device has reported
+    keys = parse_keys(keys) or reported_keys(db, [device_id])[device_id]
+    if interval is not None:
+        return aggregate_reader.aggregate(device_id, keys, start, end, interval, agg)
+    if points is not None:
+        return aggregate_reader.downsample(device_id, keys, start, end, points)
+    return history_reader.read(device_id, keys, start, end, limit)
+
+
+# Async variants of the hot read routes, registered ahead of the sync ones when
+# settings.database_async_enabled is set
+async_router = APIRouter(
+    prefix="/api",
+    tags=["Device"]
+)
 
-    cte = (
-        db.query(
-            models.TimeSeries.key,
-            models.TimeSeries.value,
-            models.Device.device_id,
-            models.TimeSeries.timestamp,
-            func.row_number().over(partition_by=models.TimeSeries.key, order_by=models.TimeSeries.timestamp.desc()).label('row_num')
-        )
-        .filter(models.Device.device_id == device_id)
-        .outerjoin(models.Device, models.TimeSeries.device_id == models.Device.device_id)
-        .cte()
-    )
 
-    query = (
-        db.query(
-            cte.c.key,
-            cte.c.value,
-            cte.c.device_id,
-            cte.c.timestamp,
-        )
-        .filter(cte.c.row_num == 1)
-    )
+@async_router.get('/devices', response_model=List[schemas.DeviceResponse], include_in_schema=False)
+async def get_list_devices_async(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Security(oauth2.get_current_user_async, scopes=["tenant", "customer"]),
+    response: Response = None,
+    _order: str = Query("asc", description="Sorting order: asc or desc", pattern="^(asc|desc)$"),
+    _sort: str = Query(None, description="Order by a specific field", pattern="^[a-zA-Z_]+$"),
+    q: Optional[str] = Query(None, description="Search in device name and label"),
+    page: PageParams = Depends()
+):
+    statement, order_column = list_devices_statement(current_user, _sort, q)
+    rows = (await db.execute(page.statement(statement, models.Device, models.Device.device_id, order_column,
+                                            _order == "desc", DEVICE_RESPONSE_OPTIONS))).all()
+    total = await db.scalar(count_statement(statement)) if page.needs_count(rows) else None
+    return list_response(schemas.DeviceResponse, page.result(rows, response, total), response)
+
+
+async def get_device_by_id_async(device_id: UUID, db: AsyncSession, current_user: models.User):
+    return check_device_access((await db.execute(device_access_statement(device_id))).first(), current_user)
+
+
+async def authorize_device_async(device_id: UUID, db: AsyncSession, current_user: models.User):
+    if device_id not in (await access_cache.access_async(current_user, db)).devices:
+        await get_device_by_id_async(device_id, db, current_user)
+        access_cache.invalidate_access(current_user.user_id)
+
 
-    result = query.all()
-    print(result)
-    return result
\ No newline at end of file
+@async_router.get("/devices/{device_id}/telemetry/latest", response_model=List[schemas.TelemetryBase],
+                  include_in_schema=False)
+async def get_latest_device_telemetry_async(device_id: UUID, db: AsyncSession = Depends(get_async_db),
+                                            current_user: models.User = Security(oauth2.get_current_user_async,
+                                                                                 scopes=["tenant", "customer"])):
+    await authorize_device_async(device_id, db, current_user)
+    latest = latest_store.get_device(device_id)
+    if latest is None:
+        latest = latest_store.put_device(device_id, (await db.execute(device_latest_statement(device_id))).all())
+    return list_response(schemas.TelemetryBase, latest)
@@ -6,13 +6,21 @@ import datetime
 from fastapi import Depends, APIRouter, HTTPException, Security, Response, Body, Query
 from fastapi.responses import JSONResponse
 from sqlalchemy import func, select, text
-from sqlalchemy.orm import Session, aliased
+from sqlalchemy.orm import Session, aliased, joinedload
 from sqlalchemy.exc import IntegrityError
 from starlette import status
 from sqlalchemy import desc
 
 from .. import schemas, models, oauth2
+from ..access_cache import access_cache
 from ..database import get_db
+from ..latest_store import latest_store
+from ..metadata_cache import metadata_cache
+from ..mqtt import cluster_channel
+from ..pagination import PageParams, count_statement
+from ..responses import list_response
+from .asset import ASSET_RESPONSE_OPTIONS
+from .device import DEVICE_RESPONSE_OPTIONS
 from .user import get_customer_by_id
 
 router = APIRouter(
@@ -21,6 +29,13 @@ router = APIRouter(
 )
 
 
+# relationships serialized by FarmResponse
+FARM_RESPONSE_OPTIONS = (
+    joinedload(models.Farm.owner, innerjoin=True),
+    joinedload(models.Farm.customer),
+)
+
+
 @router.post("/", status_code=status.HTTP_201_CREATED)
 def create_farm(farm: schemas.FarmCreate, db: Session = Depends(get_db),
                 current_user: models.User = Security(oauth2.get_current_user,
@@ -43,6 +58,8 @@ def create_farm(farm: schemas.FarmCreate, db: Session = Depends(get_db),
     db.add(new_farm)
     db.commit()
     db.refresh(new_farm)
+    access_cache.invalidate_access()
+    cluster_channel.broadcast("access_changed")
 
     return new_farm
 
@@ -52,8 +69,10 @@ def get_list_farm(
     db: Session = Depends(get_db),
     current_user: models.User = Security(oauth2.get_current_user, scopes=["tenant", "customer"]),
     response: Response = None,
-    _order: str = Query("asc", description="Sorting order: asc or desc", regex="^(asc|desc)$"),
-    _sort: str = Query(None, description="Order by a specific field", regex="^[a-zA-Z_]+$")
+    _order: str = Query("asc", description="Sorting order: asc or desc", pattern="^(asc|desc)$"),
+    _sort: str = Query(None, description="Order by a specific field", pattern="^[a-zA-Z_]+$"),
+    q: Optional[str] = Query(None, description="Search in farm name"),
+    page: PageParams = Depends()
 ):
     order_mapping = {
         "name": models.Farm.name,
@@ -65,32 +84,28 @@ def get_list_farm(
     default_order_column = models.Farm.created_at
     order_column = order_mapping.get(_sort, default_order_column)
 
-    query = db.query(models.Farm).join(models.User, models.Farm.assigned_customer == models.User.user_id, isouter=True)
+    query = select(models.Farm).join(models.User, models.Farm.assigned_customer == models.User.user_id, isouter=True)
 
     if current_user.role == "tenant":
-        query = query.filter(models.Farm.owner_id == current_user.user_id)
+        query = query.where(models.Farm.owner_id == current_user.user_id)
     elif current_user.role == "customer":
-        query = query.filter(models.Farm.assigned_customer == current_user.user_id)
-
-    if _order == "asc":
-        query = query.order_by(order_column)
-    else:
-        query = query.order_by(order_column.desc())
+        query = query.where(models.Farm.assigned_customer == current_user.user_id)
 
-    farms = query.all()
-    
-    total = query.count()
-    
-    response.headers["X-Total-Count"] = str(total)
+    if q:
+        # served by the trigram index on farms.name
+        query = query.where(models.Farm.name.ilike(f"%{q}%"))
 
-    return farms
+    rows = db.execute(page.statement(query, models.Farm, models.Farm.farm_id, order_column, _order == "desc",
+                                     FARM_RESPONSE_OPTIONS)).all()
+    total = db.scalar(count_statement(query)) if page.needs_count(rows) else None
+    return list_response(schemas.FarmResponse, page.result(rows, response, total), response)
 
 
 @router.get("/{farm_id}", response_model=schemas.FarmResponse)
 def get_farm_by_id(farm_id: UUID, db: Session = Depends(get_db),
                    current_user: models.User = Security(oauth2.get_current_user,
                                                         scopes=["tenant", "customer"])):
-    farm = db.query(models.Farm).filter(models.Farm.farm_id == farm_id).first()
+    farm = db.query(models.Farm).options(*FARM_RESPONSE_OPTIONS).filter(models.Farm.farm_id == farm_id).first()
     
     if not farm:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -104,11 +119,18 @@ def get_farm_by_id(farm_id: UUID, db: Session = Depends(get_db),
     return farm
     
 
+def authorize_farm(farm_id: UUID, db: Session, current_user: models.User):
+    # for routes that only check access, get_farm_by_id decides for ids missing from the cache
+    if farm_id not in access_cache.access(current_user, db).farms:
+        get_farm_by_id(farm_id, db, current_user)
+        access_cache.invalidate_access(current_user.user_id)
+
+
 @router.patch("/{farm_id}")
 def update_farm(farm_id: UUID, new_farm: schemas.FarmCreate, db: Session = Depends(get_db),
                 current_user: models.User = Security(oauth2.get_current_user,
                                                     scopes=["tenant"])):
-    get_farm_by_id(farm_id, db, current_user)
+    authorize_farm(farm_id, db, current_user)
     farm = db.query(models.Farm).filter(models.Farm.farm_id == farm_id)
     
     update_data = {
@@ -122,6 +144,8 @@ def update_farm(farm_id: UUID, new_farm: schemas.FarmCreate, db: Session = Depen
     farm.update(update_data, synchronize_session=False)
 
     db.commit()
+    access_cache.invalidate_access()
+    cluster_channel.broadcast("access_changed")
     return Response(status_code=200, content="Successfully updated farm")
 
 
@@ -136,6 +160,11 @@ def delete_farm(farm_id: UUID, db: Session = Depends(get_db),
     
     farm.delete(synchronize_session=False)
     db.commit()
+    # assets and devices of this farm are deleted by cascade
+    metadata_cache.clear()
+    latest_store.clear()
+    access_cache.invalidate_access()
+    cluster_channel.broadcast("cleared")
     
     return Response(status_code=200, content="Successfully deleted farm")
 
@@ -158,6 +187,8 @@ def assign_farm_to_customer(farm_id: UUID, customer_id: UUID, db: Session = Depe
 
     farm.assigned_customer = customer.user_id
     db.commit()
+    access_cache.invalidate_access()
+    cluster_channel.broadcast("access_changed")
     return Response(status_code=status.HTTP_200_OK, 
                     content=json.dumps({"detail": "Successfully assigned farm to customer"}),
                     media_type="application/json")
@@ -167,42 +198,42 @@ def assign_farm_to_customer(farm_id: UUID, customer_id: UUID, db: Session = Depe
 def get_list_farm_asset_greenhouse(farm_id: UUID, db: Session = Depends(get_db),
                                    current_user: models.User = Security(oauth2.get_current_user,
                                                                         scopes=["tenant", "customer"])):
-    farm = get_farm_by_id(farm_id, db, current_user)
-    assets = db.query(models.Asset).filter(models.Asset.farm_id == farm_id).all()
+    authorize_farm(farm_id, db, current_user)
+    assets = db.query(models.Asset).options(*ASSET_RESPONSE_OPTIONS).filter(models.Asset.farm_id == farm_id).all()
     
-    return assets
+    return list_response(schemas.AssetResponse, assets)
 
 
 @router.get("/{farm_id}/assets/greenhouses", response_model=List[schemas.AssetResponse])
 def get_list_farm_asset_greenhouse(farm_id: UUID, db: Session = Depends(get_db),
                          current_user: models.User = Security(oauth2.get_current_user,
                                                               scopes=["tenant", "customer"])):
-    farm = get_farm_by_id(farm_id, db, current_user)
-    greenhouses = db.query(models.Asset).filter(models.Asset.farm_id == farm_id, models.Asset.type == "Greenhouse").all()
+    authorize_farm(farm_id, db, current_user)
+    greenhouses = db.query(models.Asset).options(*ASSET_RESPONSE_OPTIONS).filter(models.Asset.farm_id == farm_id, models.Asset.type == "Greenhouse").all()
     
-    return greenhouses
+    return list_response(schemas.AssetResponse, greenhouses)
 
 
 @router.get("/{farm_id}/assets/outdoor_fields", response_model=List[schemas.AssetResponse])
 def get_list_farm_asset_outdoor_field(farm_id: UUID, db: Session = Depends(get_db),
                          current_user: models.User = Security(oauth2.get_current_user,
                                                               scopes=["tenant", "customer"])):
-    farm = get_farm_by_id(farm_id, db, current_user)
-    outdoor_fields = db.query(models.Asset).filter(models.Asset.farm_id == farm_id, models.Asset.type == "Outdoor Field").all()
+    authorize_farm(farm_id, db, current_user)
+    outdoor_fields = db.query(models.Asset).options(*ASSET_RESPONSE_OPTIONS).filter(models.Asset.farm_id == farm_id, models.Asset.type == "Outdoor Field").all()
     
-    return outdoor_fields
+    return list_response(schemas.AssetResponse, outdoor_fields)
 
 @router.get("/{farm_id}/devices", response_model=List[schemas.DeviceResponse])
 def get_list_farm_devices(farm_id: UUID, db: Session = Depends(get_db),
                           current_user: models.User = Security(oauth2.get_current_user,
                                                                scopes=["tenant", "customer"])):
-    farm = get_farm_by_id(farm_id, db, current_user)
-    devices = (db.query(models.Device).
+    authorize_farm(farm_id, db, current_user)
+    devices = (db.query(models.Device).options(*DEVICE_RESPONSE_OPTIONS).
                   join(models.Asset, models.Device.asset_id == models.Asset.asset_id,
                        isouter=True).
                   filter(models.Asset.farm_id == farm_id).all())
     
-    return devices
+    return list_response(schemas.DeviceResponse, devices)
     
 
 # @router.get("/{farm_id}/telemetry/latest", response_model=List[schemas.TelemetryBase])
@@ -0,0 +1,48 @@
+from fastapi import APIRouter
+
+from ..access_cache import access_cache
+from ..alerts import threshold_engine
+from ..cassandra_db import cassandra_manager
+from ..cassandra_writer import cassandra_writer
+from ..database import get_pool_metrics
+from ..latest_store import latest_store
+from ..metadata_cache import metadata_cache
+from ..mqtt import mqtt_subscriber
+from ..realtime import realtime_hub
+from ..startup import startup_timer
+from ..ts_counter import telemetry_counter
+from ..ts_rollup import rollup_accumulator
+
+router = APIRouter(
+    prefix="/api/health",
+    tags=["Health"]
+)
+
+
+@router.get("/cassandra")
+def get_cassandra_health():
+    return cassandra_manager.metrics()
+
+
+@router.get("/startup")
+def get_startup_health():
+    return startup_timer.stats()
+
+
+@router.get("/database")
+def get_database_health():
+    return dict(get_pool_metrics(), access_cache=access_cache.stats())
+
+
+@router.get("/ingest")
+def get_ingest_health():
+    return {
+        "queue": mqtt_subscriber.ingest.stats(),
+        "cassandra_writer": cassandra_writer.stats(),
+        "metadata_cache": metadata_cache.stats(),
+        "latest_store": latest_store.stats(),
+        "rollups": rollup_accumulator.stats(),
+        "counters": telemetry_counter.stats(),
+        "realtime": realtime_hub.stats(),
+        "alerts": threshold_engine.stats(),
+    }
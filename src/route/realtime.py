@@ -0,0 +1,132 @@
+import asyncio
+import json
+from typing import List, Optional
+from uuid import UUID
+
+from fastapi import APIRouter, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.security import SecurityScopes
+from starlette import status
+
+from .. import models, oauth2
+from ..access_cache import access_cache
+from ..config import settings
+from ..database import SessionLocal
+from ..realtime import Subscriber, asset_topic, device_topic, realtime_hub
+from .asset import authorize_asset
+from .device import authorize_device
+
+router = APIRouter(
+    prefix="/api",
+    tags=["Realtime"]
+)
+
+
+def authorize(username: str, asset_ids: List[UUID], device_ids: List[UUID]) -> models.User:
+    # access is only checked when subscribing, pushed updates never touch Postgres
+    db = SessionLocal()
+    try:
+        user = access_cache.get_user(username, db)
+        if user is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+        for asset_id in asset_ids:
+            authorize_asset(asset_id, db, user)
+        for device_id in device_ids:
+            authorize_device(device_id, db, user)
+        return user
+    finally:
+        db.close()
+
+
+def requested_topics(asset_ids: List[UUID], device_ids: List[UUID]):
+    return [asset_topic(asset_id) for asset_id in asset_ids] + [device_topic(device_id) for device_id in device_ids]
+
+
+async def send_updates(websocket: WebSocket, subscriber: Subscriber):
+    while True:
+        await subscriber.ready.wait()
+        if subscriber.dropped:
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+            return
+        alerts = subscriber.take_alerts()
+        updates = subscriber.take()
+        try:
+            if alerts:
+                await asyncio.wait_for(websocket.send_text(json.dumps({"type": "alert", "data": alerts})),
+                                       timeout=settings.realtime_send_timeout)
+            if updates:
+                await asyncio.wait_for(websocket.send_text(json.dumps({"type": "telemetry", "data": updates})),
+                                       timeout=settings.realtime_send_timeout)
+        except asyncio.TimeoutError:
+            realtime_hub.drop(subscriber)
+
+
+async def receive_commands(websocket: WebSocket, subscriber: Subscriber, username: str):
+    # {"action": "subscribe" | "unsubscribe", "asset_id": ..., "device_id": ...}
+    while True:
+        try:
+            command = json.loads(await websocket.receive_text())
+            asset_ids = [UUID(command["asset_id"])] if command.get("asset_id") else []
+            device_ids = [UUID(command["device_id"])] if command.get("device_id") else []
+            action = command["action"]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            await websocket.send_text(json.dumps({"type": "error", "detail": "Invalid command"}))
+            continue
+
+        topics = requested_topics(asset_ids, device_ids)
+        if action == "unsubscribe":
+            for topic in topics:
+                realtime_hub.unsubscribe(subscriber, topic)
+        elif action == "subscribe":
+            if len(subscriber.topics) + len(topics) > settings.realtime_max_subscriptions:
+                await websocket.send_text(json.dumps({"type": "error", "detail": "Too many subscriptions"}))
+                continue
+            try:
+                await run_in_threadpool(authorize, username, asset_ids, device_ids)
+            except HTTPException as e:
+                await websocket.send_text(json.dumps({"type": "error", "detail": e.detail}))
+                continue
+            for topic in topics:
+                realtime_hub.subscribe(subscriber, topic)
+        else:
+            await websocket.send_text(json.dumps({"type": "error", "detail": "Invalid command"}))
+            continue
+        await websocket.send_text(json.dumps({"type": "subscriptions", "topics": sorted(subscriber.topics)}))
+
+
+@router.websocket("/ws/telemetry")
+async def live_telemetry(websocket: WebSocket,
+                         token: Optional[str] = Query(None, description="Access token, browsers cannot set headers"),
+                         asset_id: List[UUID] = Query([]),
+                         device_id: List[UUID] = Query([])):
+    authorization = websocket.headers.get("authorization", "")
+    if token is None and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    try:
+        if token is None or len(asset_id) + len(device_id) > settings.realtime_max_subscriptions:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+        token_data = oauth2.decode_access_token(SecurityScopes(["tenant", "customer"]), token)
+        await run_in_threadpool(authorize, token_data.username, asset_id, device_id)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    subscriber = realtime_hub.connect()
+    for topic in requested_topics(asset_id, device_id):
+        realtime_hub.subscribe(subscriber, topic)
+
+    sender = asyncio.create_task(send_updates(websocket, subscriber))
+    receiver = asyncio.create_task(receive_commands(websocket, subscriber, token_data.username))
+    try:
+        await asyncio.wait([sender, receiver], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        realtime_hub.disconnect(subscriber)
+        for task in (sender, receiver):
+            try:
+                await task
+            except (asyncio.CancelledError, WebSocketDisconnect, Exception):
+                # the peer went away, nothing left to clean up
+                pass
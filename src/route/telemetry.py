@@ -1,13 +1,18 @@
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, Security
+from fastapi import APIRouter, Depends, HTTPException, Query, Security
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 from starlette import status
-from datetime import datetime, timezone
 
-from .. import models, oauth2
+from .. import models, oauth2, schemas
+from ..config import settings
 from ..database import get_db
-from ..cassandra_db import get_cassandra_session
+from ..responses import list_response
+from ..ts_history import history_reader, parse_keys, reported_keys, resolve_time_range
+from ..ts_counter import telemetry_counter
 
 router = APIRouter( 
     prefix="/api",
@@ -33,78 +38,115 @@ router = APIRouter(
 #     print(f"Received telemetry datas from device with id: {device_id}")
 
 
-def add_ts_postgres(device_id: str, key, value, db: Session):
-    device = db.query(models.Device).filter(models.Device.device_id == device_id).first()
-    existing_key = db.query(models.TimeSeriesKey).filter(models.TimeSeriesKey.ts_key == key).first()
-    if not existing_key:
-        new_key = models.TimeSeriesKey(ts_key=key)
-        db.add(new_key)
-        db.commit()
-        db.refresh(new_key)
-    # existing key    
-    else:
-        new_key = existing_key
-        #check for threshold
-        existing_threshold = db.query(models.Threshold).filter(models.Threshold.asset_id == device.asset_id,
-                                                               models.Threshold.key == new_key.ts_key).first()
-        if existing_threshold:
-            if float(value) < existing_threshold.threshold_min or float(value) > existing_threshold.threshold_max:
-                print(f"Threshold exceeded for key: '{key}' on device: {device.device_id} value: {value} threshold_min: {existing_threshold.threshold_min} threshold_max: {existing_threshold.threshold_max}")
-
-        else:
-            print(f"No threshold set for this '{key}' key")
-    # add new key to asset table
-    current_asset = db.query(models.Asset).filter(models.Asset.asset_id == device.asset_id).first()
-    if new_key not in current_asset.asset_keys:
-        current_asset.asset_keys.append(new_key)
-        db.commit()
-        print(f"Added key: '{key}' on asset: {current_asset.name} id: {current_asset.asset_id}")
-    
-    # add or update latest telemetry
-    existing_ts = db.query(models.TimeSeries).filter_by(device_id=device.device_id, key=key).first()
-    if existing_ts:
-        existing_ts.value = float(value)
-        existing_ts.timestamp = datetime.now()
-        db.commit()
-        print(f"Updated value {value} for key: '{key}' on device: {device.device_id}")
-    
-    else:    
-        ts_data = models.TimeSeries(
-            key=new_key.ts_key,
-            device_id=device.device_id,
-            value=float(value),
-        )
-        
-        db.add(ts_data)
-        db.commit()
-        print(f"Added ts for key: '{key}' on device: {device.device_id}")
+def upsert_latest_values(rows, devices: dict, db: Session):
+    """
+    Write a batch of readings `(device_id, key, value, timestamp)` from any number of
+    devices with a handful of statements: keys the asset has not reported before are
+    inserted into ts_keys/key_usages with ON CONFLICT DO NOTHING and the latest values
+    with a single INSERT ... ON CONFLICT (device_id, key) DO UPDATE.
+    `devices` maps device_id to its cached metadata. The caller commits and returns
+    the (asset_id, key) pairs it got back to the metadata cache.
+    The statements also run on SQLite, which the ingest benchmark uses.
+    """
+    latest = {}
+    for device_id, key, value, timestamp in rows:
+        if device_id not in devices:
+            continue
+        current = latest.get((device_id, key))
+        if current is None or timestamp >= current[1]:
+            latest[(device_id, key)] = (float(value), timestamp)
+    if not latest:
+        return set()
 
-    
-def add_ts_cassandra(device_id: str, key, value):
-    db = get_cassandra_session()
+    new_asset_keys = set()
+    for (device_id, key), (value, _) in latest.items():
+        asset = devices[device_id].asset
+        if key not in asset.known_keys:
+            new_asset_keys.add((asset.asset_id, key))
+
+    insert = sqlite.insert if db.get_bind().dialect.name == "sqlite" else postgresql.insert
+    # rows are locked in sorted order, so concurrent ingest workers upserting the same
+    # keys wait for each other instead of deadlocking
+    if new_asset_keys:
+        db.execute(insert(models.TimeSeriesKey)
+                   .values([{"ts_key": key} for key in sorted({key for _, key in new_asset_keys})])
+                   .on_conflict_do_nothing(index_elements=["ts_key"]))
+        db.execute(insert(models.key_usages)
+                   .values([{"asset_id": asset_id, "ts_key": key}
+                            for asset_id, key in sorted(new_asset_keys, key=lambda pair: (str(pair[0]), pair[1]))])
+                   .on_conflict_do_nothing(index_elements=["asset_id", "ts_key"]))
 
-    timestamp = datetime.utcnow().replace(tzinfo=timezone.utc)
-    models.TSCassandra.create(key=key, device_id=device_id, value=float(value), created_at=timestamp)
+    stmt = insert(models.TimeSeries).values([
+        {"device_id": UUID(device_id), "key": key, "value": value, "timestamp": timestamp}
+        for (device_id, key), (value, timestamp) in sorted(latest.items())
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["device_id", "key"],
+        set_={"value": stmt.excluded.value, "timestamp": stmt.excluded.timestamp},
+        where=stmt.excluded.timestamp >= models.TimeSeries.timestamp,
+    )
+    db.execute(stmt)
+    return new_asset_keys
 
-    print(f"Saved telemetry data to Cassandra: Device: {device_id}, Key: '{key}', Value: {value}")
 
 @router.get("/telemetry/count")
-def count_all_telemetry(db: Session = Depends(get_db), current_user: models.User = Security(oauth2.get_current_user, scopes=["tenant", "customer"])):
-    join = db.query(models.Device).join(models.Asset, models.Device.asset_id == models.Asset.asset_id, isouter=True).join(models.Farm, models.Asset.farm_id == models.Farm.farm_id, isouter=True)
+def count_all_telemetry(by_device: bool = Query(False, description="Include the count of every device"),
+                        by_day: bool = Query(False, description="Include the count of every day in [start, end)"),
+                        start: Optional[date] = Query(None, description="Defaults to 30 days before end"),
+                        end: Optional[date] = Query(None, description="Defaults to tomorrow"),
+                        db: Session = Depends(get_db),
+                        current_user: models.User = Security(oauth2.get_current_user, scopes=["tenant", "customer"])):
+    join = db.query(models.Device.device_id).join(models.Asset, models.Device.asset_id == models.Asset.asset_id, isouter=True).join(models.Farm, models.Asset.farm_id == models.Farm.farm_id, isouter=True)
     if current_user.role == "tenant":
         devices_query = join.filter(models.Farm.owner_id == current_user.user_id)
     else:
         devices_query = join.filter(models.Farm.assigned_customer == current_user.user_id)
 
-    device_ids = [str(device.device_id) for device in devices_query.all()]
-        
+    device_ids = [device_id for device_id, in devices_query]
+    counts = telemetry_counter.count(device_ids)
+    total = sum(counts.values())
+    if not by_device and not by_day:
+        return total
+
+    result = {"count": total}
+    if by_device:
+        result["devices"] = {str(device_id): count for device_id, count in counts.items()}
+    if by_day:
+        end = end or datetime.now(timezone.utc).date() + timedelta(days=1)
+        start = start or end - timedelta(days=30)
+        if not start < end or (end - start).days > settings.telemetry_count_max_days:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"start must be before end and at most "
+                                       f"{settings.telemetry_count_max_days} days apart")
+        result["days"] = {day.isoformat(): count
+                          for day, count in telemetry_counter.count_by_day(device_ids, start, end).items()}
+    return result
+
+
+@router.get("/telemetry/history", response_model=List[schemas.TelemetryHistory])
+def get_devices_telemetry_history(device_ids: str = Query(..., description="Comma separated device ids"),
+                                  keys: Optional[str] = Query(None, description="Comma separated telemetry keys"),
+                                  start: Optional[datetime] = Query(None, description="Defaults to one day before end"),
+                                  end: Optional[datetime] = Query(None, description="Defaults to now"),
+                                  limit: int = Query(1000, ge=1, le=settings.telemetry_history_max_limit),
+                                  db: Session = Depends(get_db),
+                                  current_user: models.User = Security(oauth2.get_current_user,
+                                                                       scopes=["tenant", "customer"])):
     try:
-        cassandra_session = get_cassandra_session()
-        count_query = f"SELECT COUNT(*) FROM {models.TSCassandra.__keyspace__}.{models.TSCassandra.__table_name__} WHERE device_id IN ({','.join(device_ids)});"
-        count_result = cassandra_session.execute(count_query)
-        return count_result.one()['count'] if count_result else 0
+        requested_ids = {UUID(device_id.strip()) for device_id in device_ids.split(",") if device_id.strip()}
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid device id")
 
-    finally:
-        cassandra_session.shutdown()
-    
-    
\ No newline at end of file
+    join = db.query(models.Device.device_id).join(models.Asset, models.Device.asset_id == models.Asset.asset_id, isouter=True).join(models.Farm, models.Asset.farm_id == models.Farm.farm_id, isouter=True)
+    if current_user.role == "tenant":
+        devices_query = join.filter(models.Farm.owner_id == current_user.user_id)
+    else:
+        devices_query = join.filter(models.Farm.assigned_customer == current_user.user_id)
+    allowed_ids = [device_id for device_id, in devices_query.filter(models.Device.device_id.in_(requested_ids))]
+    if len(allowed_ids) != len(requested_ids):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device not found")
+
+    start, end = resolve_time_range(start, end)
+    keys = parse_keys(keys)
+    device_keys = {device_id: keys for device_id in allowed_ids} if keys else reported_keys(db, allowed_ids)
+    return list_response(schemas.TelemetryHistory, history_reader.read_many(device_keys, start, end, limit))
\ No newline at end of file
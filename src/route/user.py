@@ -4,7 +4,11 @@ from starlette import status
 from uuid import UUID
 from typing import List
 from src import schemas, models, utils, oauth2
+from ..access_cache import access_cache
 from ..database import get_db
+from ..latest_store import latest_store
+from ..metadata_cache import metadata_cache
+from ..mqtt import cluster_channel
 
 
 router = APIRouter(
@@ -80,6 +84,9 @@ def delete_customer(customer_id: UUID, db: Session = Depends(get_db),
     customer_query.delete(synchronize_session=False)
     
     db.commit()
+    # assignments to the customer are removed by SET NULL
+    access_cache.clear()
+    cluster_channel.broadcast("users_changed")
     
     return Response(status_code=status.HTTP_200_OK, content="Successfully deleted customer")
 
@@ -94,5 +101,9 @@ def delete_tenant(tenant_id: UUID, db: Session = Depends(get_db),
     tenant.delete(synchronize_session=False)
     
     db.commit()
+    metadata_cache.clear()
+    latest_store.clear()
+    cluster_channel.broadcast("cleared")
+    access_cache.clear()
     
     return Response(status_code=200, content="Successfully deleted tenant")
\ No newline at end of file
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple
 from uuid import UUID
 from enum import Enum
 from pydantic import BaseModel, validator
@@ -159,6 +159,50 @@ class TelemetryBase(BaseModel):
     
 class AssetTelemetry(TelemetryBase):
     device_name: str
+
+
+class TelemetryPoint(BaseModel):
+    key: str
+    value: float
+    timestamp: datetime
+
+
+class TelemetryHistory(BaseModel):
+    device_id: UUID
+    data: List[TelemetryPoint]
+    next_page: Optional[str] = None
+
+
+class TelemetrySeriesPoint(BaseModel):
+    timestamp: datetime
+    value: float
+
+
+class TelemetrySeries(BaseModel):
+    device_id: UUID
+    series: Dict[str, List[TelemetrySeriesPoint]]
+    interval: Optional[int] = None
+    agg: str
+    # rollup resolution the buckets were computed from, "raw" for ts_kv
+    resolution: Optional[str] = None
+
+
+class AlertResponse(BaseModel):
+    alert_id: UUID
+    device_id: UUID
+    asset_id: UUID
+    key: str
+    kind: str
+    value: float
+    threshold_min: Optional[float] = None
+    threshold_max: Optional[float] = None
+    raised_at: datetime
+    cleared_at: Optional[datetime] = None
+    cleared_value: Optional[float] = None
+
+    class Config:
+        from_attributes = True
+
     
 class Token(BaseModel):
     access_token: str
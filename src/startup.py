@@ -0,0 +1,59 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# imported first by main, so "ready" covers the imports too
+PROCESS_STARTED = time.perf_counter()
+
+
+class StartupTimer:
+    """
+    Duration of every startup phase, including the ones that finish in the
+    background after the app already serves requests. Served by /api/health/startup.
+    """
+
+    def __init__(self):
+        self._phases = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            with self._lock:
+                self._failed[name] = str(e)
+            raise
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self._phases[name] = round(elapsed, 1)
+            print(f"Startup phase {name}: {elapsed:.1f} ms")
+
+    def mark(self, name: str):
+        # time since the process started importing the app
+        with self._lock:
+            self._phases[name] = round((time.perf_counter() - PROCESS_STARTED) * 1000, 1)
+        print(f"Startup {name} after {self._phases[name]:.1f} ms")
+
+    def in_background(self, name: str, target):
+        # e.g. connections nothing waits for at startup, the first use waits for them instead
+        def run():
+            try:
+                with self.phase(name):
+                    target()
+            except Exception as e:
+                print(f"Startup phase {name} failed: {str(e)}")
+
+        thread = threading.Thread(target=run, name=f"startup-{name}", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self._lock:
+            return {"phases_ms": dict(self._phases), "failed": dict(self._failed)}
+
+
+startup_timer = StartupTimer()
@@ -0,0 +1,305 @@
+import re
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Set
+from uuid import UUID
+
+import numpy as np
+from fastapi import HTTPException
+from starlette import status
+
+from . import models
+from .cassandra_db import cassandra_manager, execute_windowed
+from .config import settings
+from .ts_history import column_arrays, partition_buckets, to_millis
+from .ts_rollup import ROLLUP_RESOLUTIONS, pick_resolution, rollup_reader
+
+AGGREGATES = ("min", "max", "avg", "sum", "count", "last")
+
+_INTERVAL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_INTERVAL_PATTERN = re.compile(r"^(\d+)([smhd]?)$")
+
+
+def parse_interval(interval: str) -> int:
+    # "30s", "5m", "1h", "1d" or plain seconds -> milliseconds
+    match = _INTERVAL_PATTERN.match(interval.strip().lower())
+    if match is None or int(match.group(1)) == 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Invalid interval '{interval}'")
+    return int(match.group(1)) * _INTERVAL_UNITS[match.group(2) or "s"] * 1000
+
+
+def _from_millis(millis: int) -> datetime:
+    return datetime.fromtimestamp(millis / 1000, tz=timezone.utc)
+
+
+def page_arrays(rows):
+    # (ts, value) rows -> (timestamps in ms, values) arrays
+    return column_arrays(rows, ("ts", "value"), (np.int64, np.float64))
+
+
+class _KeyBuckets:
+    __slots__ = ("mins", "maxs", "sums", "counts", "last_ts", "last_values")
+
+    def __init__(self, size: int):
+        self.mins = np.full(size, np.inf)
+        self.maxs = np.full(size, -np.inf)
+        self.sums = np.zeros(size)
+        self.counts = np.zeros(size, dtype=np.int64)
+        self.last_ts = np.full(size, np.iinfo(np.int64).min, dtype=np.int64)
+        self.last_values = np.zeros(size)
+
+    def add(self, index, timestamps, values):
+        np.minimum.at(self.mins, index, values)
+        np.maximum.at(self.maxs, index, values)
+        np.add.at(self.sums, index, values)
+        self.counts += np.bincount(index, minlength=len(self.counts))
+        self._add_last(index, timestamps, values)
+
+    def merge(self, index, mins, maxs, sums, counts, last_ts, last_values):
+        # pre-aggregated rollup buckets
+        np.minimum.at(self.mins, index, mins)
+        np.maximum.at(self.maxs, index, maxs)
+        np.add.at(self.sums, index, sums)
+        np.add.at(self.counts, index, counts)
+        self._add_last(index, last_ts, last_values)
+
+    def _add_last(self, index, timestamps, values):
+        np.maximum.at(self.last_ts, index, timestamps)
+        latest = timestamps >= self.last_ts[index]
+        self.last_values[index[latest]] = values[latest]
+
+    def result(self, agg: str):
+        filled = self.counts > 0
+        if agg == "min":
+            values = self.mins
+        elif agg == "max":
+            values = self.maxs
+        elif agg == "sum":
+            values = self.sums
+        elif agg == "count":
+            values = self.counts.astype(np.float64)
+        elif agg == "last":
+            values = self.last_values
+        else:
+            values = np.divide(self.sums, self.counts, out=np.zeros_like(self.sums), where=filled)
+        return np.flatnonzero(filled), values[filled]
+
+
+class BucketAggregator:
+    """
+    Fixed-width time buckets over [start, end), aggregated per key. Pages are folded
+    in as they arrive so only the bucket arrays are kept, never the raw rows.
+    """
+
+    def __init__(self, start_ms: int, end_ms: int, interval_ms: int):
+        self.start_ms = start_ms
+        self.interval_ms = interval_ms
+        self.size = -(-(end_ms - start_ms) // interval_ms)
+        self._keys: Dict[str, _KeyBuckets] = {}
+
+    def _index(self, timestamps):
+        index = (timestamps - self.start_ms) // self.interval_ms
+        return index, (index >= 0) & (index < self.size)
+
+    def _buckets(self, key):
+        buckets = self._keys.get(key)
+        if buckets is None:
+            buckets = self._keys[key] = _KeyBuckets(self.size)
+        return buckets
+
+    def add(self, key, timestamps, values):
+        index, in_range = self._index(timestamps)
+        self._buckets(key).add(index[in_range], timestamps[in_range], values[in_range])
+
+    def merge(self, key, bucket_starts, *columns):
+        # columns: min, max, sum, count, last_ts, last_value arrays of rollup buckets
+        index, in_range = self._index(bucket_starts)
+        self._buckets(key).merge(index[in_range], *(column[in_range] for column in columns))
+
+    def result(self, agg: str):
+        series = {}
+        for key, buckets in self._keys.items():
+            index, values = buckets.result(agg)
+            series[key] = (self.start_ms + index * self.interval_ms, values)
+        return series
+
+
+def lttb(timestamps, values, threshold: int):
+    """Largest-Triangle-Three-Buckets downsampling to at most `threshold` points."""
+    size = len(timestamps)
+    if threshold >= size or threshold < 3:
+        return timestamps, values
+
+    x = timestamps.astype(np.float64)
+    y = values
+    edges = np.linspace(1, size - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = size - 1
+
+    previous = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # average of the next bucket (the last point for the final bucket)
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else size
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        area = np.abs((x[previous] - avg_x) * (y[lo:hi] - y[previous])
+                      - (x[previous] - x[lo:hi]) * (avg_y - y[previous]))
+        previous = lo + int(np.argmax(area))
+        selected[i + 1] = previous
+
+    return timestamps[selected], values[selected]
+
+
+class _PointCollector:
+    # raw points per key for LTTB, kept as array chunks
+    def __init__(self):
+        self._chunks = {}
+
+    def add(self, key, timestamps, values):
+        self._chunks.setdefault(key, []).append((timestamps, values))
+
+    def result(self, points: int):
+        series = {}
+        for key, chunks in self._chunks.items():
+            timestamps = np.concatenate([chunk[0] for chunk in chunks])
+            values = np.concatenate([chunk[1] for chunk in chunks])
+            order = np.argsort(timestamps, kind="stable")
+            series[key] = lttb(timestamps[order], values[order], points)
+        return series
+
+
+class AggregateReader:
+    """
+    Streams every page of a ts_kv_by_key time range through the analytics session
+    and reduces it server side, either into fixed interval buckets or with LTTB.
+    Ranges longer than `telemetry_downsample_raw_range` are downsampled from the
+    rollups so neither reduction holds more than a bounded number of points.
+    """
+
+    def __init__(self, manager=cassandra_manager):
+        self.manager = manager
+        self._session = None
+        self._select = None
+        self._lock = threading.Lock()
+
+    def _prepared_select(self):
+        session = self.manager.connect_analytics()
+        with self._lock:
+            if self._session is not session:
+                # bigint milliseconds instead of timestamps so the column decodes
+                # into a native NumPy array
+                self._select = session.prepare(
+                    f"SELECT toUnixTimestamp(created_at) AS ts, value "
+                    f"FROM {models.TSKeyValue.__keyspace__}.{models.TSKeyValue.__table_name__} "
+                    f"WHERE device_id = ? AND key = ? AND bucket = ? AND created_at >= ? AND created_at < ?"
+                )
+                self._session = session
+            return session, self._select
+
+    def _pages(self, device_id: UUID, keys: Set[str], start: datetime, end: datetime):
+        # -> (key, timestamps, values) per result page, the key/bucket partitions are
+        # queried `telemetry_scan_concurrency` at a time
+        session, select = self._prepared_select()
+
+        def statements():
+            for key in keys:
+                for bucket in partition_buckets(start, end):
+                    statement = select.bind((device_id, key, bucket, start, end))
+                    statement.fetch_size = settings.telemetry_scan_fetch_size
+                    yield key, statement
+
+        for key, result in execute_windowed(session, statements(), settings.telemetry_scan_concurrency):
+            while True:
+                if result.current_rows:
+                    yield (key,) + page_arrays(result.current_rows)
+                if not result.has_more_pages:
+                    break
+                result.fetch_next_page()
+
+    @staticmethod
+    def _series(device_id: UUID, series, **extra):
+        return {
+            "device_id": device_id,
+            "series": {
+                key: [{"timestamp": datetime.fromtimestamp(ts / 1000, tz=timezone.utc), "value": float(value)}
+                      for ts, value in zip(timestamps.tolist(), values.tolist())]
+                for key, (timestamps, values) in series.items()
+            },
+            **extra,
+        }
+
+    def aggregate(self, device_id: UUID, keys: Set[str], start: datetime, end: datetime,
+                  interval: str, agg: str):
+        interval_ms = parse_interval(interval)
+        start_ms, end_ms = to_millis(start), to_millis(end)
+        resolution = pick_resolution(interval_ms) if settings.telemetry_rollups_enabled and keys else None
+        raw_ranges = [(start, end)]
+        if resolution is not None:
+            # whole rollup buckets inside [start, end) that the rollups cover, the
+            # partial buckets at the edges and anything older are read raw
+            width = ROLLUP_RESOLUTIONS[resolution][0]
+            covered_ms = start_ms
+            if settings.telemetry_rollups_since is not None:
+                covered_ms = max(covered_ms, to_millis(settings.telemetry_rollups_since))
+            rollup_start_ms = covered_ms + (-covered_ms % width)
+            rollup_end_ms = end_ms - end_ms % width
+            if rollup_start_ms < rollup_end_ms:
+                raw_ranges = [(begin, finish) for begin, finish in
+                              ((start, _from_millis(rollup_start_ms)), (_from_millis(rollup_end_ms), end))
+                              if begin < finish]
+            else:
+                resolution = None
+        # result buckets on the rollup grid, so rollup buckets do not straddle them
+        first_ms = start_ms - start_ms % ROLLUP_RESOLUTIONS[resolution][0] if resolution is not None else start_ms
+        aggregator = BucketAggregator(first_ms, end_ms, interval_ms)
+        if aggregator.size > settings.telemetry_max_buckets:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Interval too small, at most {settings.telemetry_max_buckets} "
+                                       f"buckets per request")
+
+        if resolution is not None:
+            for key, columns in rollup_reader.read(device_id, keys, resolution,
+                                                   rollup_start_ms, rollup_end_ms).items():
+                aggregator.merge(key, *columns)
+        for raw_start, raw_end in raw_ranges:
+            for page in self._pages(device_id, keys, raw_start, raw_end):
+                aggregator.add(*page)
+        return self._series(device_id, aggregator.result(agg), interval=interval_ms // 1000, agg=agg,
+                            resolution=resolution or "raw")
+
+    @staticmethod
+    def _downsample_resolution(start_ms: int, end_ms: int) -> str:
+        # finest rollup with at most telemetry_downsample_max_buckets buckets over the range
+        since = settings.telemetry_rollups_since
+        if not settings.telemetry_rollups_enabled or (since is not None and start_ms < to_millis(since)):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Range too long to downsample, at most "
+                                       f"{settings.telemetry_downsample_raw_range:g} seconds")
+        for resolution, (width, _) in ROLLUP_RESOLUTIONS.items():
+            if -(-(end_ms - start_ms) // width) <= settings.telemetry_downsample_max_buckets:
+                return resolution
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Range too long to downsample")
+
+    def downsample(self, device_id: UUID, keys: Set[str], start: datetime, end: datetime,
+                   points: int):
+        collector = _PointCollector()
+        start_ms, end_ms = to_millis(start), to_millis(end)
+        if end_ms - start_ms <= settings.telemetry_downsample_raw_range * 1000:
+            for page in self._pages(device_id, keys, start, end):
+                collector.add(*page)
+            return self._series(device_id, collector.result(points), agg="lttb", resolution="raw")
+
+        # the bucket averages, stamped with the bucket start
+        resolution = self._downsample_resolution(start_ms, end_ms)
+        width = ROLLUP_RESOLUTIONS[resolution][0]
+        columns = rollup_reader.read(device_id, keys, resolution, start_ms - start_ms % width, end_ms)
+        for key, (buckets, _, _, sums, counts, _, _) in columns.items():
+            filled = counts > 0
+            collector.add(key, buckets[filled], sums[filled] / counts[filled])
+        return self._series(device_id, collector.result(points), agg="lttb", resolution=resolution)
+
+
+aggregate_reader = AggregateReader()
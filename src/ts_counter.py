@@ -0,0 +1,152 @@
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterable, List
+from uuid import UUID
+
+from cassandra.concurrent import execute_concurrent_with_args
+
+from . import models
+from .cassandra_db import cassandra_manager
+from .config import settings
+
+# day of the all-time total rows in ts_kv_counts
+TOTAL_DAY = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _day(timestamp: datetime) -> datetime:
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class TelemetryCounter:
+    """
+    Stored telemetry row counts per device, key and UTC day, plus an all-time total
+    per device and key (day 1970-01-01), in the ts_kv_counts counter table.
+
+    The ingest path only bumps in-memory tallies, a background thread adds them to
+    the counters every `flush_interval` seconds. Counter updates are not
+    idempotent: a write that times out is retried and may count its rows twice.
+    """
+
+    def __init__(self, manager=cassandra_manager,
+                 flush_interval: float = settings.telemetry_counter_flush_interval):
+        self.manager = manager
+        self.flush_interval = flush_interval
+
+        # (device_id, key, day) -> rows
+        self._tallies = defaultdict(int)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        self._session = None
+        self._update = None
+        self._select_totals = None
+        self._select_days = None
+        self._prepare_lock = threading.Lock()
+
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def add(self, rows: Iterable):
+        # rows: (device_id, key, value, timestamp)
+        tallies = defaultdict(int)
+        for device_id, key, _, timestamp in rows:
+            tallies[(str(device_id), key, _day(timestamp))] += 1
+        with self._lock:
+            for counter, count in tallies.items():
+                self._tallies[counter] += count
+
+    def _prepared(self):
+        session = self.manager.connect()
+        with self._prepare_lock:
+            if self._session is not session:
+                table = f"{models.TSCount.__keyspace__}.{models.TSCount.__table_name__}"
+                self._update = session.prepare(
+                    f"UPDATE {table} SET count = count + ? WHERE device_id = ? AND day = ? AND key = ?"
+                )
+                self._select_totals = session.prepare(
+                    f"SELECT count FROM {table} WHERE device_id = ? AND day = ?"
+                )
+                self._select_days = session.prepare(
+                    f"SELECT day, count FROM {table} WHERE device_id = ? AND day >= ? AND day < ?"
+                )
+                self._session = session
+            return session
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                tallies, self._tallies = self._tallies, defaultdict(int)
+            if not tallies:
+                return 0
+
+            totals = defaultdict(int)
+            for (device_id, key, _), count in tallies.items():
+                totals[(device_id, key, TOTAL_DAY)] += count
+            updates = list(tallies.items()) + list(totals.items())
+
+            try:
+                session = self._prepared()
+                results = execute_concurrent_with_args(
+                    session, self._update,
+                    [(count, UUID(device_id), day, key) for (device_id, key, day), count in updates],
+                    concurrency=settings.cassandra_write_concurrency, raise_on_first_error=False)
+                failed = [update for update, (success, _) in zip(updates, results) if not success]
+            except Exception as e:
+                print(f"Failed to flush telemetry counters: {str(e)}")
+                failed = updates
+
+            with self._lock:
+                for counter, count in failed:
+                    self._tallies[counter] += count
+            return len(updates) - len(failed)
+
+    def count(self, device_ids: List[UUID]):
+        # -> {device_id: all-time row count}
+        if not device_ids:
+            return {}
+        session = self._prepared()
+        results = execute_concurrent_with_args(session, self._select_totals,
+                                               [(device_id, TOTAL_DAY) for device_id in device_ids])
+        return {device_id: sum(row["count"] for row in rows)
+                for device_id, (_, rows) in zip(device_ids, results)}
+
+    def count_by_day(self, device_ids: List[UUID], start: date, end: date):
+        # -> {day: row count over all devices} for days in [start, end)
+        counts = {start + timedelta(days=i): 0 for i in range((end - start).days)}
+        if not device_ids or not counts:
+            return counts
+        session = self._prepared()
+        start = datetime.combine(start, datetime.min.time(), tzinfo=timezone.utc)
+        end = datetime.combine(end, datetime.min.time(), tzinfo=timezone.utc)
+        results = execute_concurrent_with_args(session, self._select_days,
+                                               [(device_id, start, end) for device_id in device_ids])
+        for _, rows in results:
+            for row in rows:
+                counts[row["day"].date()] += row["count"]
+        return counts
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="counter-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {"pending": sum(self._tallies.values())}
+
+
+telemetry_counter = TelemetryCounter()
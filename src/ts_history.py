@@ -0,0 +1,225 @@
+import base64
+import binascii
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+from uuid import UUID
+
+import numpy as np
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from starlette import status
+
+from . import models
+from .cassandra_db import cassandra_manager
+from .config import settings
+
+
+def encode_page_state(paging_state: Optional[bytes]) -> Optional[str]:
+    if paging_state is None:
+        return None
+    return base64.urlsafe_b64encode(paging_state).decode()
+
+
+def decode_page_state(page: Optional[str]) -> Optional[bytes]:
+    if not page:
+        return None
+    try:
+        return base64.urlsafe_b64decode(page.encode())
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid page token")
+
+
+def parse_keys(keys: Optional[str]) -> Optional[Set[str]]:
+    if not keys:
+        return None
+    return {key.strip() for key in keys.split(",") if key.strip()}
+
+
+def _as_utc(timestamp: datetime) -> datetime:
+    # the driver returns naive UTC datetimes, and so does a query string without an offset
+    return timestamp.replace(tzinfo=timezone.utc) if timestamp.tzinfo is None else timestamp
+
+
+def resolve_time_range(start: Optional[datetime], end: Optional[datetime]):
+    end = _as_utc(end) if end is not None else datetime.now(timezone.utc)
+    start = _as_utc(start) if start is not None else end - timedelta(days=1)
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="start must be before end")
+    return start, end
+
+
+def to_millis(timestamp: datetime) -> int:
+    return int(_as_utc(timestamp).timestamp() * 1000)
+
+
+def column_arrays(rows, names, dtypes):
+    """
+    One result page -> a NumPy array per column. With the NumPy protocol handler
+    the page already is a dict of column arrays, tuple rows are converted with
+    np.fromiter.
+    """
+    if len(rows) == 1 and isinstance(rows[0], dict):
+        return tuple(np.asarray(rows[0][name], dtype=dtype) for name, dtype in zip(names, dtypes))
+    return tuple(np.fromiter((row[i] for row in rows), dtype=dtype, count=len(rows))
+                 for i, dtype in enumerate(dtypes))
+
+
+def partition_bucket(timestamp: datetime) -> datetime:
+    # start of the ts_kv_by_key partition (UTC day or month) holding `timestamp`
+    timestamp = _as_utc(timestamp)
+    if settings.cassandra_ts_partition == "month":
+        return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def partition_buckets(start: datetime, end: datetime) -> List[datetime]:
+    # partitions overlapping [start, end), newest first
+    buckets = []
+    bucket = partition_bucket(end - timedelta(microseconds=1))
+    first = partition_bucket(start)
+    while bucket >= first:
+        buckets.append(bucket)
+        if settings.cassandra_ts_partition == "month":
+            bucket = partition_bucket(bucket - timedelta(days=1))
+        else:
+            bucket -= timedelta(days=1)
+    return buckets
+
+
+def reported_keys(db: Session, device_ids: Iterable[UUID]) -> Dict[UUID, Set[str]]:
+    # telemetry keys every device has reported, ts_kv_by_key is partitioned by key
+    keys = {device_id: set() for device_id in device_ids}
+    for device_id, key in db.execute(select(models.TimeSeries.device_id, models.TimeSeries.key)
+                                     .where(models.TimeSeries.device_id.in_(keys))):
+        keys[device_id].add(key)
+    return keys
+
+
+class HistoryCursor(NamedTuple):
+    # the range and keys of the first page, which the paging state is only valid for,
+    # and the partition to continue in
+    keys: List[str]
+    start: datetime
+    end: datetime
+    key: str
+    bucket: datetime
+    paging_state: Optional[bytes]
+
+
+def encode_cursor(cursor: HistoryCursor) -> str:
+    # start and end as ISO strings, the first page was bound with their full precision
+    data = {"keys": cursor.keys, "start": cursor.start.isoformat(), "end": cursor.end.isoformat(),
+            "key": cursor.key, "bucket": to_millis(cursor.bucket), "state": encode_page_state(cursor.paging_state)}
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(page: str) -> HistoryCursor:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(page.encode()))
+        return HistoryCursor([str(key) for key in data["keys"]],
+                             _as_utc(datetime.fromisoformat(data["start"])),
+                             _as_utc(datetime.fromisoformat(data["end"])),
+                             data["key"], datetime.fromtimestamp(data["bucket"] / 1000, tz=timezone.utc),
+                             decode_page_state(data["state"]))
+    except (binascii.Error, ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid page token")
+
+
+class HistoryReader:
+    """
+    Time-range reads over ts_kv_by_key. The (key, bucket) partitions overlapping the
+    range are sliced one after the other, key by key and newest first, and each
+    slice is fetched page by page with the driver's paging state. The position of
+    the last returned row is handed back to the client as an opaque `next_page`
+    token, together with the range and keys the following pages are read with.
+    """
+
+    def __init__(self, manager=cassandra_manager):
+        self.manager = manager
+        self._session = None
+        self._select = None
+        self._lock = threading.Lock()
+
+    def _prepared_select(self):
+        session = self.manager.connect()
+        with self._lock:
+            if self._session is not session:
+                self._select = session.prepare(
+                    f"SELECT created_at, value "
+                    f"FROM {models.TSKeyValue.__keyspace__}.{models.TSKeyValue.__table_name__} "
+                    f"WHERE device_id = ? AND key = ? AND bucket = ? AND created_at >= ? AND created_at < ?"
+                )
+                self._session = session
+            return session, self._select
+
+    def _bind(self, device_id: UUID, key: str, bucket: datetime, start: datetime, end: datetime,
+              fetch_size: int):
+        session, select = self._prepared_select()
+        statement = select.bind((device_id, key, bucket, start, end))
+        statement.fetch_size = fetch_size
+        return session, statement
+
+    @staticmethod
+    def _partitions(keys: Set[str], start: datetime, end: datetime):
+        return [(key, bucket) for key in sorted(keys) for bucket in partition_buckets(start, end)]
+
+    def _read(self, device_id: UUID, partitions, start: datetime, end: datetime, limit: int,
+              position: int = 0, paging_state: Optional[bytes] = None, pending=None):
+        # pending: future of the query of partitions[position] already sent with execute_async
+        data = []
+        for _ in range(settings.telemetry_history_max_pages):
+            if position >= len(partitions) or len(data) >= limit:
+                break
+            key, bucket = partitions[position]
+            if pending is not None:
+                result, pending = pending.result(), None
+            else:
+                # the fetch size only covers what is still missing so the paging
+                # state always points right after the last returned row
+                session, statement = self._bind(device_id, key, bucket, start, end, limit - len(data))
+                result = session.execute(statement, paging_state=paging_state)
+            data.extend({"key": key, "value": row["value"], "timestamp": _as_utc(row["created_at"])}
+                        for row in result.current_rows)
+            paging_state = result.paging_state
+            if paging_state is None:
+                position += 1
+
+        next_page = None
+        if position < len(partitions):
+            keys = sorted({key for key, _ in partitions})
+            next_page = encode_cursor(HistoryCursor(keys, start, end, *partitions[position], paging_state))
+        return {"device_id": device_id, "data": data, "next_page": next_page}
+
+    def read(self, device_id: UUID, keys: Set[str], start: datetime, end: datetime, limit: int):
+        return self._read(device_id, self._partitions(keys, start, end), start, end, limit)
+
+    def read_next(self, device_id: UUID, page: str, limit: int):
+        # a following page, with the range and keys of the first one
+        cursor = decode_cursor(page)
+        partitions = self._partitions(set(cursor.keys), cursor.start, cursor.end)
+        try:
+            position = partitions.index((cursor.key, cursor.bucket))
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid page token")
+        return self._read(device_id, partitions, cursor.start, cursor.end, limit, position, cursor.paging_state)
+
+    def read_many(self, device_keys: Dict[UUID, Set[str]], start: datetime, end: datetime, limit: int):
+        # first page of every device: the first partition of each is queried up front with
+        # execute_async, the next ones only when a device needs more rows for the page
+        requests = []
+        for device_id, keys in device_keys.items():
+            partitions = self._partitions(keys, start, end)
+            pending = None
+            if partitions:
+                session, statement = self._bind(device_id, *partitions[0], start, end, limit)
+                pending = session.execute_async(statement)
+            requests.append((device_id, partitions, pending))
+        return [self._read(device_id, partitions, start, end, limit, pending=pending)
+                for device_id, partitions, pending in requests]
+
+
+history_reader = HistoryReader()
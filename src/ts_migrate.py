@@ -0,0 +1,102 @@
+"""
+Backfill of the legacy ts_kv table into ts_kv_by_key.
+
+    python -m src.ts_migrate [--fetch-size 5000] [--resume TOKEN] [--counts] [--rollups]
+        [--before 2024-05-01T12:00:00Z]
+
+The legacy table is scanned page by page and every page is written through the
+regular telemetry writer, without writing it back into ts_kv. The resume token of
+the next page is printed after every page so an interrupted run can continue
+where it stopped. Rows are keyed by (device_id, key, bucket, created_at) in the
+new table, so running the backfill more than once is harmless. With `--counts`
+the copied rows are also added to the ts_kv_counts counters, and with `--rollups`
+to the 1m/1h/1d rollups of ts_kv_rollup. Both need `--before`, the time the
+ingest started maintaining counters and rollups: rows from then on are already
+counted and rolled up, and ts_kv still receives them while legacy writes are on.
+Only rows that were stored in ts_kv_by_key are counted. Neither is idempotent:
+only pass them on a single complete run. Until the rollups are backfilled, set
+TELEMETRY_ROLLUPS_SINCE to the deploy time so older aggregates are read raw.
+"""
+import argparse
+import time
+from datetime import datetime
+
+from cassandra.cqlengine.management import sync_table
+
+from . import models
+from .cassandra_db import cassandra_manager
+from .cassandra_writer import cassandra_writer
+from .payloads import parse_iso_timestamp
+from .ts_counter import telemetry_counter
+from .ts_history import decode_page_state, encode_page_state, to_millis
+from .ts_rollup import rollup_accumulator
+
+
+def backfill(fetch_size: int, resume: str = None, counts: bool = False, rollups: bool = False,
+             before: datetime = None):
+    session = cassandra_manager.connect()
+    sync_table(models.TSKeyValue)
+    if counts:
+        sync_table(models.TSCount)
+    if rollups:
+        sync_table(models.TSRollup)
+    select = session.prepare(
+        f"SELECT device_id, key, value, created_at "
+        f"FROM {models.TSCassandra.__keyspace__}.{models.TSCassandra.__table_name__}"
+    )
+    statement = select.bind(())
+    statement.fetch_size = fetch_size
+
+    before_ms = to_millis(before) if before is not None else None
+    paging_state = decode_page_state(resume)
+    copied = failed = 0
+    started = time.perf_counter()
+    while True:
+        result = session.execute(statement, paging_state=paging_state)
+        rows = [(row["device_id"], row["key"], row["value"], row["created_at"])
+                for row in result.current_rows if row["key"] is not None and row["value"] is not None]
+        stored = cassandra_writer.write_stored(rows, legacy=False)
+        if counts or rollups:
+            # rows from `before` on were counted and rolled up at ingest
+            backfilled = [row for row in stored if to_millis(row[3]) < before_ms]
+        if counts:
+            telemetry_counter.add(backfilled)
+            telemetry_counter.flush()
+        if rollups:
+            rollup_accumulator.add(backfilled)
+            rollup_accumulator.flush()
+        copied += len(stored)
+        failed += len(rows) - len(stored)
+
+        paging_state = result.paging_state
+        print(f"Copied {copied} rows ({failed} failed) in {time.perf_counter() - started:.1f}s, "
+              f"resume token: {encode_page_state(paging_state)}")
+        if paging_state is None:
+            break
+    if rollups:
+        # buckets whose write failed are still dirty
+        rollup_accumulator.flush()
+    return copied, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy ts_kv into ts_kv_by_key")
+    parser.add_argument("--fetch-size", type=int, default=5000)
+    parser.add_argument("--resume", default=None, help="resume token printed by a previous run")
+    parser.add_argument("--counts", action="store_true", help="also add the copied rows to ts_kv_counts")
+    parser.add_argument("--rollups", action="store_true", help="also add the copied rows to ts_kv_rollup")
+    parser.add_argument("--before", type=parse_iso_timestamp,
+                        help="only count and roll up rows created before this time (UTC unless it has an offset), "
+                             "required with --counts and --rollups")
+    args = parser.parse_args()
+    if (args.counts or args.rollups) and args.before is None:
+        parser.error("--counts and --rollups need --before")
+    try:
+        copied, failed = backfill(args.fetch_size, args.resume, args.counts, args.rollups, args.before)
+    finally:
+        cassandra_manager.shutdown()
+    print(f"Backfill finished: {copied} rows copied, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
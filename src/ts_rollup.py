@@ -0,0 +1,269 @@
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+from uuid import UUID
+
+import numpy as np
+from cassandra.concurrent import execute_concurrent_with_args
+
+from . import models
+from .cassandra_db import cassandra_manager, execute_windowed, EXEC_PROFILE_TUPLES
+from .config import settings
+from .ts_history import column_arrays, to_millis
+
+_DAY = 86_400_000
+
+# resolution -> (bucket width, partition period) in milliseconds, finest first
+ROLLUP_RESOLUTIONS = {
+    "1m": (60_000, _DAY),
+    "1h": (3_600_000, 30 * _DAY),
+    "1d": (_DAY, 365 * _DAY),
+}
+
+ROLLUP_COLUMNS = ("bucket", "min_value", "max_value", "sum_value", "count", "last_ts", "last_value")
+ROLLUP_DTYPES = (np.int64, np.float64, np.float64, np.float64, np.int64, np.int64, np.float64)
+
+
+def _from_millis(millis: int) -> datetime:
+    return datetime.fromtimestamp(millis / 1000, tz=timezone.utc)
+
+
+def pick_resolution(interval_ms: int) -> Optional[str]:
+    # coarsest rollup whose buckets tile the requested interval exactly
+    chosen = None
+    for resolution, (width, _) in ROLLUP_RESOLUTIONS.items():
+        if width <= interval_ms and interval_ms % width == 0:
+            chosen = resolution
+    return chosen
+
+
+def rollup_periods(resolution: str, start_ms: int, end_ms: int):
+    period = ROLLUP_RESOLUTIONS[resolution][1]
+    return range(start_ms - start_ms % period, end_ms, period)
+
+
+def _merge(state: list, other: list):
+    # state/other: [min, max, sum, count, last_ts, last_value]
+    state[0] = min(state[0], other[0])
+    state[1] = max(state[1], other[1])
+    state[2] += other[2]
+    state[3] += other[3]
+    if other[4] >= state[4]:
+        state[4], state[5] = other[4], other[5]
+
+
+class RollupAccumulator:
+    """
+    Incremental 1m/1h/1d rollups of the ingested telemetry.
+
+    Rows are folded into in-memory bucket states which a background thread writes
+    to ts_kv_rollup every `flush_interval` seconds. A bucket is written as a whole,
+    so the first time this process touches a bucket its stored row (if any) is
+    merged in before the write. Buckets that closed more than `grace` seconds ago
+    are dropped from memory once flushed; a late row simply reloads them.
+    """
+
+    def __init__(self, manager=cassandra_manager,
+                 flush_interval: float = settings.telemetry_rollup_flush_interval,
+                 grace: float = settings.telemetry_rollup_grace):
+        self.manager = manager
+        self.flush_interval = flush_interval
+        self.grace_ms = int(grace * 1000)
+
+        # (device_id, key, resolution, bucket_ms) -> [min, max, sum, count, last_ts, last_value]
+        self._buckets = {}
+        self._dirty = set()
+        self._unseeded = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        self._session = None
+        self._insert = None
+        self._select = None
+        self._prepare_lock = threading.Lock()
+
+        self._thread = None
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(int)
+
+    def _count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def add(self, rows: Iterable):
+        # rows: (device_id, key, value, timestamp)
+        with self._lock:
+            for device_id, key, value, timestamp in rows:
+                millis = to_millis(timestamp)
+                value = float(value)
+                for resolution, (width, _) in ROLLUP_RESOLUTIONS.items():
+                    bucket = (str(device_id), key, resolution, millis - millis % width)
+                    state = self._buckets.get(bucket)
+                    if state is None:
+                        self._buckets[bucket] = [value, value, value, 1, millis, value]
+                        self._unseeded.add(bucket)
+                    else:
+                        _merge(state, [value, value, value, 1, millis, value])
+                    self._dirty.add(bucket)
+
+    def _prepared(self):
+        session = self.manager.connect()
+        with self._prepare_lock:
+            if self._session is not session:
+                table = f"{models.TSRollup.__keyspace__}.{models.TSRollup.__table_name__}"
+                self._insert = session.prepare(
+                    f"INSERT INTO {table} (device_id, key, resolution, period, bucket, min_value, max_value, "
+                    f"sum_value, count, last_ts, last_value) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                )
+                self._select = session.prepare(
+                    f"SELECT min_value, max_value, sum_value, count, last_ts, last_value FROM {table} "
+                    f"WHERE device_id = ? AND key = ? AND resolution = ? AND period = ? AND bucket = ?"
+                )
+                self._session = session
+            return session, self._insert, self._select
+
+    @staticmethod
+    def _primary_key(bucket):
+        device_id, key, resolution, bucket_ms = bucket
+        period = ROLLUP_RESOLUTIONS[resolution][1]
+        return (UUID(device_id), key, resolution, _from_millis(bucket_ms - bucket_ms % period),
+                _from_millis(bucket_ms))
+
+    def _seed(self, session, select, buckets):
+        # merge the stored rows of buckets this process has not written before
+        results = execute_concurrent_with_args(
+            session, select, [self._primary_key(bucket) for bucket in buckets],
+            concurrency=settings.cassandra_write_concurrency, raise_on_first_error=False,
+            execution_profile=EXEC_PROFILE_TUPLES)
+        failed = []
+        with self._lock:
+            for bucket, (success, rows) in zip(buckets, results):
+                if not success:
+                    failed.append(bucket)
+                    continue
+                for min_value, max_value, sum_value, count, last_ts, last_value in rows:
+                    _merge(self._buckets[bucket],
+                           [min_value, max_value, sum_value, count, to_millis(last_ts), last_value])
+        return failed
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                unseeded = [bucket for bucket in dirty if bucket in self._unseeded]
+            if not dirty:
+                return 0
+
+            try:
+                session, insert, select = self._prepared()
+                retry = set(self._seed(session, select, unseeded)) if unseeded else set()
+                with self._lock:
+                    self._unseeded.difference_update(set(unseeded) - retry)
+                    writes = [bucket for bucket in dirty if bucket not in retry]
+                    values = [self._primary_key(bucket) + (state[0], state[1], state[2], state[3],
+                                                           _from_millis(state[4]), state[5])
+                              for bucket, state in ((bucket, self._buckets[bucket]) for bucket in writes)]
+                results = execute_concurrent_with_args(
+                    session, insert, values,
+                    concurrency=settings.cassandra_write_concurrency, raise_on_first_error=False)
+                for bucket, (success, _) in zip(writes, results):
+                    if not success:
+                        retry.add(bucket)
+            except Exception as e:
+                print(f"Failed to flush telemetry rollups: {str(e)}")
+                retry = dirty
+
+            with self._lock:
+                self._dirty.update(retry)
+            self._count("flushed", len(dirty) - len(retry))
+            self._count("failed", len(retry))
+            self._evict()
+            return len(dirty) - len(retry)
+
+    def _evict(self):
+        now = int(time.time() * 1000)
+        with self._lock:
+            closed = [bucket for bucket in self._buckets
+                      if bucket not in self._dirty
+                      and bucket[3] + ROLLUP_RESOLUTIONS[bucket[2]][0] + self.grace_ms < now]
+            for bucket in closed:
+                del self._buckets[bucket]
+                self._unseeded.discard(bucket)
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="rollup-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        with self._lock:
+            stats.update(buckets=len(self._buckets), dirty=len(self._dirty))
+        return stats
+
+
+class RollupReader:
+    """Reads rollup buckets of one resolution, the key/period partitions queried concurrently."""
+
+    def __init__(self, manager=cassandra_manager):
+        self.manager = manager
+        self._session = None
+        self._select = None
+        self._lock = threading.Lock()
+
+    def _prepared_select(self):
+        session = self.manager.connect_analytics()
+        with self._lock:
+            if self._session is not session:
+                self._select = session.prepare(
+                    f"SELECT toUnixTimestamp(bucket) AS bucket, min_value, max_value, sum_value, count, "
+                    f"toUnixTimestamp(last_ts) AS last_ts, last_value "
+                    f"FROM {models.TSRollup.__keyspace__}.{models.TSRollup.__table_name__} "
+                    f"WHERE device_id = ? AND key = ? AND resolution = ? AND period = ? "
+                    f"AND bucket >= ? AND bucket < ?"
+                )
+                self._session = session
+            return session, self._select
+
+    def read(self, device_id: UUID, keys: Iterable[str], resolution: str, start_ms: int, end_ms: int):
+        # -> {key: (bucket, min, max, sum, count, last_ts, last_value) arrays}
+        session, select = self._prepared_select()
+        start, end = _from_millis(start_ms), _from_millis(end_ms)
+
+        def statements():
+            for key in keys:
+                for period in rollup_periods(resolution, start_ms, end_ms):
+                    statement = select.bind((device_id, key, resolution, _from_millis(period), start, end))
+                    statement.fetch_size = settings.telemetry_scan_fetch_size
+                    yield key, statement
+
+        pages = defaultdict(list)
+        for key, result in execute_windowed(session, statements(), settings.telemetry_scan_concurrency):
+            while True:
+                if result.current_rows:
+                    pages[key].append(column_arrays(result.current_rows, ROLLUP_COLUMNS, ROLLUP_DTYPES))
+                if not result.has_more_pages:
+                    break
+                result.fetch_next_page()
+
+        return {key: tuple(np.concatenate(columns) for columns in zip(*key_pages))
+                for key, key_pages in pages.items()}
+
+
+rollup_accumulator = RollupAccumulator()
+rollup_reader = RollupReader()
@@ -1,16 +1,79 @@
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from uuid import UUID
 
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from .config import settings
 
+# hashes made with other rounds verify fine and are flagged by needs_update
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.bcrypt_rounds)
 
-def get_password_hash(password):
+# bcrypt runs in worker processes so a burst of logins neither holds the GIL nor
+# the request thread pool, at most `password_hash_workers` hashes run at once
+_hasher = None
+_hasher_lock = threading.Lock()
+
+
+def _password_hasher():
+    global _hasher
+    if settings.password_hash_workers <= 0:
+        return None
+    with _hasher_lock:
+        if _hasher is None:
+            # spawn: forking a process that already runs driver threads is unsafe
+            _hasher = ProcessPoolExecutor(max_workers=settings.password_hash_workers,
+                                          mp_context=multiprocessing.get_context("spawn"))
+        return _hasher
+
+
+def shutdown_password_hasher():
+    global _hasher
+    with _hasher_lock:
+        if _hasher is not None:
+            _hasher.shutdown(cancel_futures=True)
+            _hasher = None
+
+
+def _run(function, *args):
+    hasher = _password_hasher()
+    if hasher is None:
+        return function(*args)
+    return hasher.submit(function, *args).result()
+
+
+async def _run_async(function, *args):
+    hasher = _password_hasher()
+    if hasher is None:
+        return function(*args)
+    return await asyncio.wrap_future(hasher.submit(function, *args))
+
+
+def _hash(password):
     return pwd_context.hash(password)
 
 
+def _verify_and_update(plain_password, hashed_password):
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
+def get_password_hash(password):
+    return _run(_hash, password)
+
+
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return _run(_verify_and_update, plain_password, hashed_password)[0]
+
+
+async def get_password_hash_async(password):
+    return await _run_async(_hash, password)
+
+
+async def verify_and_update_password_async(plain_password, hashed_password):
+    # -> (valid, new hash to store or None)
+    return await _run_async(_verify_and_update, plain_password, hashed_password)
 
 
 def is_valid_uuid(uuid_to_test, version=4):
@@ -0,0 +1,75 @@
+"""
+The tests run without Postgres, Cassandra or a broker:
+
+    pip install -r requirements.txt -r requirements-dev.txt
+    python -m pytest
+
+Settings missing from the environment get placeholder values before `src` is
+imported, the route tests run against an in-memory SQLite database.
+"""
+import json
+import os
+import sqlite3
+import uuid
+
+import pytest
+
+for name, value in {"DATABASE_HOSTNAME": "localhost", "DATABASE_PORT": "5432", "DATABASE_NAME": "test",
+                    "DATABASE_USERNAME": "test", "DATABASE_PASSWORD": "test", "MQTT_HOSTNAME": "localhost",
+                    "MQTT_PORT": "1883", "SECRET_KEY": "test", "ALGORITHM": "HS256",
+                    "ACCESS_TOKEN_EXPIRE_MINUTES": "30", "ASTRADB_KEYSPACE": "test", "ASTRADB_CLIENT_ID": "test",
+                    "ASTRADB_CLIENT_SECRET": "test", "ADMIN_PASSWORD": "test"}.items():
+    os.environ.setdefault(name, value)
+
+from sqlalchemy import ARRAY, create_engine, event  # noqa: E402
+from sqlalchemy.dialects.postgresql import UUID  # noqa: E402
+from sqlalchemy.ext.compiler import compiles  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+
+from src import database, models  # noqa: E402
+
+
+@compiles(UUID, "sqlite")
+def _uuid_sqlite(type_, compiler, **kw):
+    return "CHAR(32)"
+
+
+# farms.location is a float[], stored as JSON text and decoded by the declared column type
+@compiles(ARRAY, "sqlite")
+def _array_sqlite(type_, compiler, **kw):
+    return "JSON"
+
+
+sqlite3.register_adapter(list, json.dumps)
+sqlite3.register_converter("JSON", json.loads)
+
+
+@pytest.fixture
+def db_engine():
+    engine = create_engine("sqlite://", poolclass=StaticPool,
+                           connect_args={"check_same_thread": False, "detect_types": sqlite3.PARSE_DECLTYPES})
+    tables = [models.User.__table__, models.Farm.__table__, models.Asset.__table__,
+              models.DeviceProfile.__table__, models.Device.__table__]
+    models.Base.metadata.create_all(engine, tables=tables)
+    event.listen(engine, "before_cursor_execute", database._count_statement)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db_session(db_engine):
+    return sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+
+
+@pytest.fixture
+def tenant(db_session):
+    db = db_session()
+    user = models.User(user_id=uuid.uuid4(), username="tenant", password="x", role="tenant",
+                       created_by=uuid.uuid4())
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+    db.expunge(user)
+    db.close()
+    return user
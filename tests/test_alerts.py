@@ -0,0 +1,89 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from src.alerts import ThresholdEngine, ThresholdRules
+
+ASSET_ID = uuid.uuid4()
+DEVICES = {"d1": SimpleNamespace(asset_id=ASSET_ID, name="sensor"),
+           "d2": SimpleNamespace(asset_id=uuid.uuid4(), name="other")}
+START = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+def make_engine(debounce=2, hysteresis=0.0):
+    engine = ThresholdEngine(ttl=1e9, hysteresis=hysteresis, debounce=debounce)
+    # rules of a single asset, as if loaded from the thresholds table
+    engine._rules = ThresholdRules([(ASSET_ID, "t", 0.0, 10.0), (ASSET_ID, "h", None, 80.0)], hysteresis)
+    engine._seeded = True
+    return engine
+
+
+def readings(values, device_id="d1", key="t"):
+    return [(device_id, key, value, START + timedelta(seconds=i)) for i, value in enumerate(values)]
+
+
+def statuses(events):
+    return [(event["status"], event["kind"], event["value"]) for event in events]
+
+
+def test_debounced_raise_and_clear():
+    engine = make_engine()
+    events, _ = engine.evaluate(readings([5, 11, 5, 12, 13, 14]), DEVICES, None)
+    assert statuses(events) == [("raised", "high", 13.0)]
+    assert events[0]["threshold_min"] == 0.0 and events[0]["threshold_max"] == 10.0
+
+    events, _ = engine.evaluate(readings([5, 12, 5, 6]), DEVICES, None)
+    assert statuses(events) == [("cleared", "high", 6.0)]
+    assert engine.stats()["open_alerts"] == 0
+
+
+def test_missing_bound_and_unruled_readings():
+    engine = make_engine(debounce=1)
+    events, _ = engine.evaluate(readings([-100], key="h") + readings([100], key="other")
+                                + readings([100], device_id="d2"), DEVICES, None)
+    assert events == []
+    events, _ = engine.evaluate(readings([-1], key="t") + readings([81], key="h"), DEVICES, None)
+    assert statuses(events) == [("raised", "low", -1.0), ("raised", "high", 81.0)]
+
+
+def test_hysteresis_keeps_the_alert_open_near_the_bound():
+    # range 0..10 narrowed by 20% of its width: the alert clears at or below 8
+    engine = make_engine(debounce=1, hysteresis=0.2)
+    engine.evaluate(readings([11]), DEVICES, None)
+    events, _ = engine.evaluate(readings([9, 9.5]), DEVICES, None)
+    assert events == []
+    events, _ = engine.evaluate(readings([8]), DEVICES, None)
+    assert statuses(events) == [("cleared", "high", 8.0)]
+
+
+def test_restore_undoes_a_rolled_back_batch():
+    engine = make_engine()
+    events, undo = engine.evaluate(readings([20, 21]), DEVICES, None)
+    assert statuses(events) == [("raised", "high", 21.0)]
+    engine.restore(undo)
+    assert engine.stats()["open_alerts"] == 0
+
+    # the retried batch raises the alert again
+    events, _ = engine.evaluate(readings([20, 21]), DEVICES, None)
+    assert statuses(events) == [("raised", "high", 21.0)]
+
+
+def test_restore_leaves_series_changed_by_later_batches():
+    engine = make_engine(debounce=1)
+    _, undo = engine.evaluate(readings([20]), DEVICES, None)
+    events, _ = engine.evaluate(readings([5]), DEVICES, None)
+    assert statuses(events) == [("cleared", "high", 5.0)]
+    engine.evaluate(readings([-5]), DEVICES, None)
+    engine.restore(undo)
+    # the low alert of the third batch is kept, not the state before the first
+    alerts = [series.alert for series in engine._series.values()]
+    assert [alert["kind"] for alert in alerts] == ["low"]
+
+
+@pytest.mark.parametrize("debounce", [1, 3])
+def test_one_alert_per_breach(debounce):
+    engine = make_engine(debounce=debounce)
+    events, _ = engine.evaluate(readings([20] * 10), DEVICES, None)
+    assert len(events) == 1
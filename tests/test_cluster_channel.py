@@ -0,0 +1,42 @@
+import uuid
+from types import SimpleNamespace
+
+import orjson
+import pytest
+
+from src.access_cache import access_cache
+from src.mqtt import apply_invalidation, cluster_channel
+
+
+@pytest.fixture
+def cached_access():
+    user_id = uuid.uuid4()
+    access_cache._put(access_cache._users, "customer", {"user_id": user_id})
+    access_cache._put(access_cache._access, user_id, SimpleNamespace(farms={uuid.uuid4()}))
+    yield user_id
+    access_cache.clear()
+
+
+def message(op, entity_id=None, sender="other-process"):
+    payload = orjson.dumps({"sender": sender, "op": op, "id": entity_id})
+    return SimpleNamespace(topic=cluster_channel.topic, payload=payload)
+
+
+@pytest.mark.parametrize("op, entity_id", [("access_changed", None), ("device_deleted", str(uuid.uuid4())),
+                                           ("asset_updated", str(uuid.uuid4()))])
+def test_access_changes_drop_the_cached_access(cached_access, op, entity_id):
+    apply_invalidation(op, entity_id)
+    assert access_cache._get(access_cache._access, cached_access) is None
+    assert access_cache._get(access_cache._users, "customer") is not None
+
+
+@pytest.mark.parametrize("op", ["users_changed", "cleared"])
+def test_user_changes_drop_the_cached_users(cached_access, op):
+    cluster_channel.on_message(None, None, message(op))
+    assert access_cache._get(access_cache._access, cached_access) is None
+    assert access_cache._get(access_cache._users, "customer") is None
+
+
+def test_own_messages_are_skipped(cached_access):
+    cluster_channel.on_message(None, None, message("access_changed", sender=cluster_channel.sender))
+    assert access_cache._get(access_cache._access, cached_access) is not None
@@ -0,0 +1,69 @@
+from datetime import datetime, timezone
+
+from src.ingest import IngestQueue, TelemetryMessage
+
+RECEIVED_AT = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+def messages(count):
+    return [TelemetryMessage(f"d{i}", {"t": float(i)}, RECEIVED_AT) for i in range(count)]
+
+
+class RaisingWriter:
+    # cassandra_writer while Cassandra is unreachable
+    def __init__(self):
+        self.calls = 0
+
+    def write_stored(self, rows):
+        self.calls += 1
+        raise ConnectionError("Cassandra is unreachable")
+
+
+def test_after_commit_failures_do_not_retry_the_batch():
+    committed = []
+    writer = RaisingWriter()
+    ingest = IngestQueue(handler=lambda batch: committed.append(batch) or batch,
+                         after_commit=lambda batch: writer.write_stored(batch))
+    batch = messages(8)
+    ingest._handle(batch)
+    assert committed == [batch]
+    assert writer.calls == 1
+    stats = ingest.stats()
+    assert stats["processed"] == 8 and stats["after_commit_failed"] == 8
+    assert "split" not in stats and "failed" not in stats
+
+
+def test_failed_batches_are_retried_in_halves():
+    committed = []
+    finished = []
+
+    def handler(batch):
+        if any(message.device_id == "d5" for message in batch):
+            raise ValueError("bad message")
+        committed.extend(batch)
+        return batch
+
+    ingest = IngestQueue(handler=handler, after_commit=finished.extend)
+    batch = messages(8)
+    ingest._handle(batch)
+    assert sorted(message.device_id for message in committed) == [f"d{i}" for i in range(8) if i != 5]
+    assert finished == committed
+    stats = ingest.stats()
+    assert stats["processed"] == 7 and stats["failed"] == 1 and stats["split"] == 3
+
+
+def test_a_device_always_goes_to_the_same_worker():
+    ingest = IngestQueue(handler=lambda batch: batch, workers=4, max_size=400)
+    for i in range(200):
+        ingest.put(TelemetryMessage(f"d{i % 20}", {"t": float(i)}, RECEIVED_AT))
+    assert ingest.depth() == ingest.stats()["depth"] == 200
+    owners = {}
+    for worker, worker_queue in enumerate(ingest._queues):
+        values = []
+        while not worker_queue.empty():
+            message = worker_queue.get_nowait()
+            assert owners.setdefault(message.device_id, worker) == worker
+            values.append(message.data["t"])
+        # in arrival order within the worker
+        assert values == sorted(values)
+    assert len(owners) == 20 and len(set(owners.values())) > 1
@@ -0,0 +1,72 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from src.latest_store import LatestValueStore
+
+DEVICE_ID = str(uuid.uuid4())
+ASSET_ID = uuid.uuid4()
+DEVICES = {DEVICE_ID: SimpleNamespace(asset_id=ASSET_ID, name="sensor")}
+NOW = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+def row(key, value, timestamp, **extra):
+    return dict(key=key, value=value, device_id=uuid.UUID(DEVICE_ID), timestamp=timestamp, **extra)
+
+
+def values(rows):
+    return {row["key"]: row["value"] for row in rows}
+
+
+def test_reads_miss_until_loaded():
+    store = LatestValueStore(ttl=60, enabled=True)
+    assert store.get_device(DEVICE_ID) is None
+    store._put(store._devices, DEVICE_ID, [row("t", 20.0, NOW)])
+    assert values(store.get_device(DEVICE_ID)) == {"t": 20.0}
+    assert store.stats()["hits"] == 1 and store.stats()["misses"] == 1
+
+
+def test_updates_only_touch_loaded_entries():
+    store = LatestValueStore(ttl=60, enabled=True)
+    store.update([(DEVICE_ID, "t", 21.0, NOW)], DEVICES)
+    assert store.get_device(DEVICE_ID) is None and store.get_asset(ASSET_ID) is None
+
+    store._put(store._devices, DEVICE_ID, [row("t", 20.0, NOW)])
+    store._put(store._assets, ASSET_ID, [row("t", 20.0, NOW, device_name="sensor")])
+    store.update([(DEVICE_ID, "t", 22.0, NOW + timedelta(seconds=1)), (DEVICE_ID, "h", 60.0, NOW)], DEVICES)
+    assert values(store.get_device(DEVICE_ID)) == {"t": 22.0, "h": 60.0}
+    assert {row["device_name"] for row in store.get_asset(ASSET_ID)} == {"sensor"}
+
+
+def test_older_readings_do_not_replace_newer_ones():
+    store = LatestValueStore(ttl=60, enabled=True)
+    store._put(store._devices, DEVICE_ID, [row("t", 20.0, NOW)])
+    store.update([(DEVICE_ID, "t", 19.0, NOW - timedelta(seconds=1))], DEVICES)
+    assert values(store.get_device(DEVICE_ID)) == {"t": 20.0}
+
+
+def test_load_keeps_newer_ingested_values():
+    store = LatestValueStore(ttl=60, enabled=True)
+    store._put(store._devices, DEVICE_ID, [])
+    store.update([(DEVICE_ID, "t", 22.0, NOW + timedelta(seconds=5))], DEVICES)
+    # a reload that read the table before the ingest committed
+    store._put(store._devices, DEVICE_ID, [row("t", 20.0, NOW), row("h", 60.0, NOW)])
+    assert values(store.get_device(DEVICE_ID)) == {"t": 22.0, "h": 60.0}
+
+
+def test_expired_and_invalidated_entries_miss():
+    store = LatestValueStore(ttl=0, enabled=True)
+    store._put(store._devices, DEVICE_ID, [row("t", 20.0, NOW)])
+    assert store.get_device(DEVICE_ID) is None
+
+    store = LatestValueStore(ttl=60, enabled=True)
+    store._put(store._devices, DEVICE_ID, [row("t", 20.0, NOW)])
+    store._put(store._assets, ASSET_ID, [row("t", 20.0, NOW, device_name="sensor")])
+    store.invalidate_device(DEVICE_ID)
+    assert store.get_device(DEVICE_ID) is None and store.get_asset(ASSET_ID) is None
+
+
+def test_disabled_store_passes_rows_through():
+    store = LatestValueStore(ttl=60, enabled=False)
+    assert values(store._put(store._devices, DEVICE_ID, [row("t", 20.0, NOW)])) == {"t": 20.0}
+    assert store.get_device(DEVICE_ID) is None
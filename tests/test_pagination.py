@@ -0,0 +1,54 @@
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+
+from src import models
+from src.config import settings
+from src.pagination import PageParams
+
+
+def page(start=0, end=None, limit=None, after=None):
+    # called directly, the Query defaults have to be passed explicitly
+    return PageParams(_start=start, _end=end, _limit=limit, _after=after)
+
+
+def test_limits():
+    assert page(start=10, end=30).limit == 20
+    assert page(limit=5).limit == 5
+    assert page().limit == settings.list_max_limit
+    assert page(end=settings.list_max_limit + 100).limit == settings.list_max_limit
+    with pytest.raises(HTTPException):
+        page(start=5, end=5)
+
+
+@pytest.mark.parametrize("sort_column, sort_value", [
+    (models.Farm.created_at, datetime(2024, 5, 1, 12, 0, 0, 123456, tzinfo=timezone.utc)),
+    (models.Farm.name, "farm-1"),
+])
+def test_cursor_round_trip(sort_column, sort_value):
+    key = uuid.uuid4()
+    cursor = PageParams._encode_cursor(sort_value, key)
+    assert page(after=cursor)._decode_cursor(sort_column) == (sort_value, key)
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor", "WzEsIDJd", PageParams._encode_cursor("x", "not-a-uuid")])
+def test_invalid_cursor(cursor):
+    with pytest.raises(HTTPException) as error:
+        page(after=cursor)._decode_cursor(models.Farm.name)
+    assert error.value.status_code == 400
+
+
+def test_cursor_needs_a_non_nullable_sort_column():
+    cursor = PageParams._encode_cursor("text", uuid.uuid4())
+    with pytest.raises(HTTPException):
+        page(after=cursor).statement(models.Farm.__table__.select(), models.Farm, models.Farm.farm_id,
+                                     models.Farm.descriptions, False)
+
+
+def test_needs_count():
+    assert not page().needs_count([])
+    assert page(start=20).needs_count([])
+    assert page(after="cursor").needs_count([])
+    assert not page(start=20).needs_count([object()])
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta, timezone
+
+import msgpack
+import orjson
+import pytest
+
+from src.config import settings
+from src.payloads import (MAX_EPOCH_MS, PayloadError, encode_samples, parse_iso_timestamp, parse_payload,
+                          parse_timestamp)
+
+RECEIVED_AT = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def test_flat_json_object_is_stamped_and_kept_raw():
+    payload = b'{"temperature": 21.5, "humidity": 60}'
+    assert parse_payload(payload, RECEIVED_AT) == [(RECEIVED_AT, {"temperature": 21.5, "humidity": 60}, payload)]
+
+
+def test_non_numeric_values_are_dropped():
+    samples = parse_payload(b'{"temperature": 21.5, "status": "ok"}', RECEIVED_AT)
+    assert samples == [(RECEIVED_AT, {"temperature": 21.5}, None)]
+    assert parse_payload(b'{"status": "ok"}', RECEIVED_AT) == []
+
+
+def test_single_sample_with_timestamp():
+    payload = orjson.dumps({"ts": "2024-05-01T11:00:00Z", "values": {"temperature": 20}})
+    assert parse_payload(payload, RECEIVED_AT) == [(RECEIVED_AT - timedelta(hours=1), {"temperature": 20}, None)]
+
+
+@pytest.mark.parametrize("encoding", ["json", "msgpack"])
+def test_batched_samples_round_trip(encoding):
+    samples = [(RECEIVED_AT - timedelta(minutes=2), {"temperature": 20.0}),
+               (RECEIVED_AT - timedelta(minutes=1), {"temperature": 20.5, "humidity": 58.0})]
+    parsed = parse_payload(encode_samples(samples, encoding), RECEIVED_AT)
+    assert [(timestamp, values) for timestamp, values, _ in parsed] == samples
+
+
+def test_suffix_names_the_format():
+    payload = msgpack.packb({"temperature": 21.5})
+    assert parse_payload(payload, RECEIVED_AT, "msgpack") == [(RECEIVED_AT, {"temperature": 21.5}, None)]
+    with pytest.raises(PayloadError):
+        parse_payload(payload, RECEIVED_AT, "xml")
+
+
+def test_future_timestamps_get_the_server_time():
+    ahead = RECEIVED_AT + timedelta(seconds=settings.ingest_max_clock_skew + 60)
+    payload = orjson.dumps([{"ts": int(ahead.timestamp() * 1000), "values": {"temperature": 20}}])
+    assert parse_payload(payload, RECEIVED_AT) == [(RECEIVED_AT, {"temperature": 20}, None)]
+
+
+@pytest.mark.parametrize("payload", [b'[1, 2]', b'[{"ts": 1}]', b'"text"', b'{"ts": 1, "values": {"t": 1}}x'])
+def test_invalid_payloads_raise_value_error(payload):
+    with pytest.raises(ValueError):
+        parse_payload(payload, RECEIVED_AT)
+
+
+def test_parse_timestamp():
+    assert parse_timestamp(0) == datetime(1970, 1, 1, tzinfo=timezone.utc)
+    assert parse_timestamp(1714564800000) == RECEIVED_AT
+    assert parse_timestamp("2024-05-01T14:00:00+02:00") == RECEIVED_AT
+    assert parse_timestamp("2024-05-01T12:00:00") == RECEIVED_AT
+    assert parse_timestamp(RECEIVED_AT) is RECEIVED_AT
+
+
+@pytest.mark.parametrize("ts", [-1, MAX_EPOCH_MS + 1, 10 ** 20, float("nan"), float("inf"), None, [1]])
+def test_parse_timestamp_rejects_out_of_range(ts):
+    with pytest.raises(PayloadError):
+        parse_timestamp(ts)
+
+
+@pytest.mark.parametrize("text", ["2024-05-01T12:00:00Z", "2024-05-01T12:00:00", "2024-05-01T14:00:00+02:00"])
+def test_parse_iso_timestamp(text):
+    # also the ts_migrate --before argument, "Z" is not read by fromisoformat before Python 3.11
+    assert parse_iso_timestamp(text) == RECEIVED_AT
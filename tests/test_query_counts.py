@@ -0,0 +1,89 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from src import models, oauth2
+from src.database import count_statements, get_db
+from src.route import asset, device, farm
+
+ROWS = 5
+
+
+@pytest.fixture
+def seeded(db_session, tenant):
+    # every farm has its own customer, every asset its own device profile, so a
+    # relationship loaded per row issues one statement per row
+    db = db_session()
+    created_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(ROWS):
+        created_at += timedelta(minutes=1)
+        customer = models.User(user_id=uuid.uuid4(), username=f"customer-{i}", password="x", role="customer",
+                               created_by=tenant.user_id)
+        new_farm = models.Farm(farm_id=uuid.uuid4(), name=f"farm-{i}", location=[10.0, 106.0 + i],
+                               owner_id=tenant.user_id, assigned_customer=customer.user_id, created_at=created_at)
+        new_asset = models.Asset(asset_id=uuid.uuid4(), name=f"asset-{i}", type="Greenhouse",
+                                 farm_id=new_farm.farm_id, owner_id=tenant.user_id, created_at=created_at)
+        profile = models.DeviceProfile(profile_id=uuid.uuid4(), name=f"profile-{i}", owner_id=tenant.user_id)
+        new_device = models.Device(device_id=uuid.uuid4(), name=f"device-{i}", asset_id=new_asset.asset_id,
+                                   device_profile_id=profile.profile_id, created_at=created_at)
+        db.add_all([customer, new_farm, new_asset, profile, new_device])
+        db.commit()
+    db.close()
+
+
+@pytest.fixture
+def client(db_session, tenant, seeded):
+    # the routers of main, with its X-Query-Count middleware
+    app = FastAPI()
+
+    @app.middleware("http")
+    async def add_query_count(request: Request, call_next):
+        counter = count_statements()
+        response = await call_next(request)
+        response.headers["X-Query-Count"] = str(counter[0])
+        return response
+
+    for router in (farm.router, asset.router, device.router):
+        app.include_router(router)
+
+    def get_test_db():
+        db = db_session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = get_test_db
+    app.dependency_overrides[oauth2.get_current_user] = lambda: tenant
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("path", ["/api/farms/", "/api/assets/", "/api/devices"])
+def test_list_statements_do_not_grow_with_rows(client, path):
+    counts = {}
+    for end in (1, ROWS):
+        response = client.get(path, params={"_end": end})
+        assert response.status_code == 200, response.text
+        assert len(response.json()) == end
+        assert response.headers["X-Total-Count"] == str(ROWS)
+        counts[end] = int(response.headers["X-Query-Count"])
+    assert counts[1] == counts[ROWS] == 1
+
+
+@pytest.mark.parametrize("path", ["/api/farms/", "/api/assets/", "/api/devices"])
+def test_list_cursor_pages(client, path):
+    seen = []
+    params = {"_limit": 2}
+    while True:
+        response = client.get(path, params=params)
+        assert response.status_code == 200, response.text
+        seen.extend(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        params = {"_limit": 2, "_after": cursor}
+    assert len(seen) == ROWS
+    assert [item["created_at"] for item in seen] == sorted(item["created_at"] for item in seen)
@@ -0,0 +1,127 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from src import ts_aggregate
+from src.cassandra_db import execute_windowed
+from src.config import settings
+from src.ts_aggregate import AggregateReader, BucketAggregator, lttb, parse_interval
+from src.ts_rollup import ROLLUP_RESOLUTIONS
+
+
+def test_parse_interval():
+    assert parse_interval("90") == 90_000
+    assert parse_interval("5m") == 300_000
+    assert parse_interval("1d") == 86_400_000
+
+
+def test_buckets():
+    aggregator = BucketAggregator(0, 3000, 1000)
+    aggregator.add("t", np.array([0, 500, 999, 2500, 3000, -1]), np.array([1.0, 3.0, 2.0, 10.0, 99.0, 99.0]))
+    expected = {"min": [1.0, 10.0], "max": [3.0, 10.0], "sum": [6.0, 10.0], "count": [3.0, 1.0],
+                "avg": [2.0, 10.0], "last": [2.0, 10.0]}
+    for agg, values in expected.items():
+        starts, result = aggregator.result(agg)["t"]
+        assert starts.tolist() == [0, 2000]
+        assert result.tolist() == values, agg
+
+
+def test_pages_fold_in_any_order():
+    aggregator = BucketAggregator(0, 1000, 1000)
+    aggregator.add("t", np.array([800]), np.array([8.0]))
+    aggregator.add("t", np.array([200]), np.array([2.0]))
+    assert aggregator.result("last")["t"][1].tolist() == [8.0]
+    assert aggregator.result("avg")["t"][1].tolist() == [5.0]
+
+
+def test_rollups_merge_with_raw_rows():
+    aggregator = BucketAggregator(0, 2000, 1000)
+    # rollup bucket [0, 1000): min, max, sum, count, last_ts, last_value
+    aggregator.merge("t", np.array([0]), np.array([1.0]), np.array([5.0]), np.array([9.0]), np.array([3]),
+                     np.array([900]), np.array([5.0]))
+    aggregator.add("t", np.array([950, 1500]), np.array([7.0, 4.0]))
+    assert aggregator.result("count")["t"][1].tolist() == [4.0, 1.0]
+    assert aggregator.result("max")["t"][1].tolist() == [7.0, 4.0]
+    assert aggregator.result("last")["t"][1].tolist() == [7.0, 4.0]
+
+
+def test_lttb_keeps_the_ends_and_the_peaks():
+    timestamps = np.arange(100, dtype=np.int64)
+    values = np.zeros(100)
+    values[37] = 50.0
+    values[71] = -50.0
+    sampled_ts, sampled_values = lttb(timestamps, values, 10)
+    assert len(sampled_ts) == 10
+    assert sampled_ts[0] == 0 and sampled_ts[-1] == 99
+    assert np.all(np.diff(sampled_ts) > 0)
+    assert {37, 71} <= set(sampled_ts.tolist())
+    assert sampled_values[sampled_ts.tolist().index(37)] == 50.0
+
+
+@pytest.mark.parametrize("threshold", [2, 100, 500])
+def test_lttb_returns_short_series_as_is(threshold):
+    timestamps = np.arange(100, dtype=np.int64)
+    values = np.arange(100, dtype=np.float64)
+    sampled_ts, sampled_values = lttb(timestamps, values, threshold)
+    assert sampled_ts is timestamps and sampled_values is values
+
+
+class FakeFuture:
+    def __init__(self, session, tag):
+        self.session = session
+        self.tag = tag
+
+    def result(self):
+        self.session.in_flight -= 1
+        return self.tag
+
+
+class FakeSession:
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def execute_async(self, statement, execution_profile=None):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return FakeFuture(self, statement)
+
+
+def test_execute_windowed_bounds_the_queries_in_flight():
+    session = FakeSession()
+    results = list(execute_windowed(session, ((i, f"statement-{i}") for i in range(100)), 8))
+    assert results == [(i, f"statement-{i}") for i in range(100)]
+    assert session.max_in_flight == 8 and session.in_flight == 0
+
+
+@pytest.mark.parametrize("days, resolution", [(7, "1m"), (365, "1h"), (365 * 20, "1d")])
+def test_long_ranges_are_downsampled_from_rollups(monkeypatch, days, resolution):
+    end = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    start = end - timedelta(days=days)
+    read = []
+
+    def read_rollups(device_id, keys, chosen, start_ms, end_ms):
+        read.append(chosen)
+        buckets = np.arange(start_ms, end_ms, ROLLUP_RESOLUTIONS[chosen][0], dtype=np.int64)
+        counts = np.full(len(buckets), 2)
+        zeros = np.zeros(len(buckets))
+        return {"t": (buckets, zeros, zeros, np.full(len(buckets), 4.0), counts, buckets, zeros)}
+
+    reader = AggregateReader()
+    monkeypatch.setattr(ts_aggregate.rollup_reader, "read", read_rollups)
+    monkeypatch.setattr(reader, "_pages", lambda *args: pytest.fail("read raw rows"))
+    result = reader.downsample(uuid.uuid4(), {"t"}, start, end, 100)
+    assert read == [resolution] and result["resolution"] == resolution
+    assert len(result["series"]["t"]) == 100
+    assert {point["value"] for point in result["series"]["t"]} == {2.0}
+
+
+def test_long_ranges_without_rollups_are_rejected(monkeypatch):
+    monkeypatch.setattr(settings, "telemetry_rollups_enabled", False)
+    end = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    with pytest.raises(HTTPException) as error:
+        AggregateReader().downsample(uuid.uuid4(), {"t"}, end - timedelta(days=30), end, 100)
+    assert error.value.status_code == 400
@@ -0,0 +1,75 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from src.ts_history import HistoryReader, decode_cursor
+
+DEVICE_ID = uuid.uuid4()
+START = datetime(2024, 5, 1, 22, 0, 0, 250000, tzinfo=timezone.utc)
+END = datetime(2024, 5, 2, 2, 0, tzinfo=timezone.utc)
+
+
+class FakeStatement:
+    def __init__(self, values):
+        self.values = values
+        self.fetch_size = None
+
+
+class FakeSession:
+    # rows every minute of every (key, bucket) partition, paged by fetch_size with the
+    # offset as paging state; the bound range of every query is recorded
+    def __init__(self):
+        self.bound = []
+
+    def prepare(self, query):
+        return SimpleNamespace(bind=FakeStatement)
+
+    def execute(self, statement, paging_state=None):
+        device_id, key, bucket, start, end = statement.values
+        self.bound.append((key, bucket, start, end))
+        first = max(start, bucket)
+        last = min(end, bucket + timedelta(days=1))
+        minutes = [first + timedelta(minutes=i) for i in range(int((last - first).total_seconds() // 60))]
+        rows = [{"created_at": created_at, "value": 1.0} for created_at in reversed(minutes)]
+        offset = int(paging_state or 0)
+        page = rows[offset:offset + statement.fetch_size]
+        more = offset + statement.fetch_size < len(rows)
+        return SimpleNamespace(current_rows=page,
+                               paging_state=str(offset + statement.fetch_size).encode() if more else None)
+
+
+@pytest.fixture
+def reader():
+    session = FakeSession()
+    return HistoryReader(SimpleNamespace(connect=lambda: session)), session
+
+
+def test_pages_continue_with_the_range_and_keys_of_the_first(reader):
+    reader, session = reader
+    first = reader.read(DEVICE_ID, {"t", "h"}, START, END, 100)
+    assert len(first["data"]) == 100
+    cursor = decode_cursor(first["next_page"])
+    assert (cursor.keys, cursor.start, cursor.end) == (["h", "t"], START, END)
+
+    rows = list(first["data"])
+    page = first["next_page"]
+    while page is not None:
+        result = reader.read_next(DEVICE_ID, page, 100)
+        rows.extend(result["data"])
+        page = result["next_page"]
+    assert {(start, end) for _, _, start, end in session.bound} == {(START, END)}
+    # no row skipped or read twice
+    everything = reader.read(DEVICE_ID, {"t", "h"}, START, END, 10000)
+    assert everything["next_page"] is None
+    assert rows == everything["data"]
+
+
+@pytest.mark.parametrize("page", ["not a token", "e30=", "WzEsIDJd"])
+def test_invalid_page_token(reader, page):
+    reader, _ = reader
+    with pytest.raises(HTTPException) as error:
+        reader.read_next(DEVICE_ID, page, 100)
+    assert error.value.status_code == 400